@@ -0,0 +1,153 @@
+"""Archive of the messages expired by the retention policies of the rooms.
+
+Expired messages are moved out of the messages table into segments, which
+are gzip compressed files of newline delimited JSON, each holding a run of
+consecutive messages of a room, one object per message with its _id, body,
+sender_id, sender_name and created_at:
+    <directory>/<room_id>/<first_id>-<last_id>-<token>.ndjson.gz
+The segments of every room are listed by the 'archive_segments' table of the
+primary, and can be copied as they are to cold storage. The archive of a room
+always holds a prefix of its history, i.e. all its messages up to the last
+id of its last segment, so that the archived messages and the ones still in
+the messages table are told apart by their ids.
+
+Decoded segments are held in an LRU cache, so paging through the archived
+history of a room reads and decompresses each segment once.
+"""
+import gzip
+import json
+import os
+import secrets
+
+from sqlalchemy import func, select
+
+from cache import LRUCache
+
+
+class ArchivedMessage:
+    """Read-only message read from a segment, with the attributes of the rows
+    of the messages table read by the resources."""
+
+    __slots__ = ('_id', 'body', 'sender_id', 'sender_name', 'created_at')
+
+    def __init__(self, _id, body, sender_id, sender_name, created_at):
+        self._id = _id
+        self.body = body
+        self.sender_id = sender_id
+        self.sender_name = sender_name
+        self.created_at = created_at
+
+
+class MessageArchive:
+    """Writes and reads the segments of the archived messages, which are
+    stored under the given directory, and listed by the given table of
+    segments.
+
+    The table has the columns room_id, first_id, last_id, message_count, path
+    (relative to the directory) and archived_at, and a unique index on
+    (room_id, first_id).
+    """
+
+    def __init__(self, directory, segments_table, cache_size=64, cache_ttl=3600):
+        self.directory = directory
+        self.table = segments_table
+        self._segments = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+
+    def last_archived_id(self, connection, room_id):
+        """Return the id of the last archived message of the room with the
+        given id, or 0 if none of its messages is archived."""
+        table = self.table
+        return connection.execute(
+            select([func.max(table.c.last_id)]).where(table.c.room_id == room_id)
+        ).scalar() or 0
+
+    def segments(self, connection, room_id, after_id=None, before_id=None, descending=False):
+        """Return the segments of the room with the given id which hold any
+        message sent after after_id and before before_id, ordered by the ids
+        of their messages."""
+        table = self.table
+        query = select([table.c.first_id, table.c.last_id, table.c.message_count, table.c.path]) \
+            .where(table.c.room_id == room_id)
+        if after_id is not None:
+            query = query.where(table.c.last_id > after_id)
+        if before_id is not None:
+            query = query.where(table.c.first_id < before_id)
+
+        return connection.execute(
+            query.order_by(table.c.first_id.desc() if descending else table.c.first_id)
+        ).fetchall()
+
+    def write_segment(self, room_id, messages):
+        """Write the given messages of a room (dicts holding their _id, body,
+        sender_id, sender_name and created_at, ordered by id) into a new
+        segment, and return its path relative to the directory.
+
+        The file is written under a temporary name and then renamed, so a
+        segment is never read half written.
+        """
+        path = os.path.join(str(room_id),
+            f'{messages[0]["_id"]}-{messages[-1]["_id"]}-{secrets.token_hex(4)}.ndjson.gz'
+        )
+        full_path = os.path.join(self.directory, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        temporary_path = full_path + '.tmp'
+        # A fixed modification time keeps the output the same for the same messages.
+        with gzip.GzipFile(temporary_path, 'wb', mtime=0) as segment:
+            for message in messages:
+                segment.write(json.dumps(message, default=str).encode('utf-8') + b'\n')
+        os.replace(temporary_path, full_path)
+
+        return path
+
+    def remove_segment(self, path):
+        """Remove the file of a segment which couldn't be listed."""
+        try:
+            os.remove(os.path.join(self.directory, path))
+        except FileNotFoundError:
+            pass
+
+    def read_segment(self, path):
+        """Return the list of the ArchivedMessages of the segment with the
+        given path, ordered by id."""
+        messages = self._segments.get(path)
+        if messages is None:
+            with gzip.open(os.path.join(self.directory, path), 'rb') as segment:
+                messages = [
+                    ArchivedMessage(**json.loads(line)) for line in segment if line.strip()
+                ]
+            self._segments.set(path, messages)
+
+        return messages
+
+    def messages(self, connection, room_id, after_id=None, before_id=None, descending=False, limit=None):
+        """Yield the archived messages of the room with the given id sent after
+        after_id and before before_id, ordered by id (the most recent first if
+        descending), at most limit of them if a limit is given."""
+        if limit is not None and limit <= 0:
+            return
+
+        count = 0
+        for segment in self.segments(connection, room_id, after_id=after_id, before_id=before_id, descending=descending):
+            messages = self.read_segment(segment.path)
+            for message in (reversed(messages) if descending else messages):
+                if (after_id is not None and message._id <= after_id) \
+                        or (before_id is not None and message._id >= before_id):
+                    continue
+
+                yield message
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+
+    def stats(self, connection, room_id):
+        """Return the number of segments and of archived messages of the room
+        with the given id, along with the id of its last archived message, as
+        a dict."""
+        table = self.table
+        segments, messages, last_id = connection.execute(
+            select([func.count(), func.coalesce(func.sum(table.c.message_count), 0), func.max(table.c.last_id)])
+                .where(table.c.room_id == room_id)
+        ).first()
+
+        return {'segments': segments, 'archived_messages': int(messages), 'archived_through': last_id}
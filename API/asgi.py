@@ -0,0 +1,802 @@
+"""Alternative ASGI entry point of the TreeChat API.
+
+Serves the users, rooms and messages resources of the Flask app in main.py
+(creating and getting users and rooms, and creating and paging through the
+messages of a room), with the same request parsers, fields, entity tags and
+error messages. The database is accessed with an async driver, so a slow
+round trip to the database doesn't tie up a worker:
+
+    $ uvicorn asgi:app --workers 2
+
+The driver is picked from the scheme of the database URI: aiomysql for
+MySQL and, for local development, aiosqlite for SQLite.
+
+Unlike the Flask app, it doesn't:
+    - stream the listings and the histories as newline delimited JSON, so
+      JSON is returned to the clients accepting application/x-ndjson;
+    - compress the responses (see compression.py);
+    - time the requests in a Server-Timing header, nor profile them (see
+      instrumentation.py);
+    - read from the replicas of DB_REPLICA_URIS.
+The other endpoints, such as the long-poll, search and sync ones, are only
+served by the Flask app, as are all the requests when the messages are
+sharded or written behind.
+"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from datetime import datetime
+from urllib.parse import parse_qsl
+
+from flask_restful import abort
+from flask_restful.utils import http_status_message
+from sqlalchemy.engine.url import make_url
+from werkzeug.datastructures import CombinedMultiDict, MultiDict
+from werkzeug.exceptions import BadRequest, HTTPException, ServiceUnavailable
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.routing import Map, Rule
+
+import codec
+import main
+from codec import marshal
+from credentials import CredentialPoolFull
+
+if main.message_shards is not None:
+    raise ValueError('The ASGI entry point cannot serve sharded messages, unset MESSAGE_SHARD_URIS.')
+if main.message_writer is not None:
+    # Its messages would take ids from the auto-increment of the messages table
+    # rather than from the allocator of the write-behind queue.
+    raise ValueError('The ASGI entry point cannot write messages behind, unset MESSAGE_WRITE_BEHIND.')
+
+
+# Async Database Access
+# ---------------------
+class AsyncSession:
+    """Runs the statements of a request on a single connection, within one
+    transaction. Statements use the '%s' placeholder for their parameters."""
+
+    def __init__(self, connection, placeholder, integrity_error):
+        self._connection = connection
+        self._placeholder = placeholder
+        # Exception raised by the driver when a statement violates a constraint.
+        self.integrity_error = integrity_error
+
+    async def _execute(self, statement, parameters):
+        if self._placeholder != '%s':
+            statement = statement.replace('%s', self._placeholder)
+        cursor = await self._connection.cursor()
+        await cursor.execute(statement, parameters)
+        return cursor
+
+    async def fetch_all(self, statement, parameters=()):
+        """Execute a statement and return all the rows it returned."""
+        cursor = await self._execute(statement, parameters)
+        rows = await cursor.fetchall()
+        await cursor.close()
+        return rows
+
+    async def fetch_one(self, statement, parameters=()):
+        """Execute a statement and return the first row it returned, if any."""
+        cursor = await self._execute(statement, parameters)
+        row = await cursor.fetchone()
+        await cursor.close()
+        return row
+
+    async def execute(self, statement, parameters=()):
+        """Execute a statement and return the id of the row it inserted, if any."""
+        cursor = await self._execute(statement, parameters)
+        row_id = cursor.lastrowid
+        await cursor.close()
+        return row_id
+
+    async def rollback(self):
+        """Roll back the statements executed so far."""
+        await self._connection.rollback()
+
+
+class AsyncDatabase:
+    """Pool of connections to the database opened with an async driver.
+
+    Requests use a connection through session(), which commits the
+    transaction when the request succeeds and rolls it back otherwise.
+    """
+
+    def __init__(self, uri, min_size=1, max_size=10):
+        self.url = make_url(uri)
+        self.min_size = min_size
+        self.max_size = max_size
+        self._pool = None
+
+        if self.url.drivername.startswith('mysql'):
+            self.placeholder = '%s'
+        elif self.url.drivername.startswith('sqlite'):
+            self.placeholder = '?'
+        else:
+            raise ValueError(f'No async driver is available for the database "{self.url.drivername}".')
+
+    async def connect(self):
+        """Open the pool of connections of a MySQL database."""
+        if self.url.drivername.startswith('mysql'):
+            import aiomysql
+
+            self._pool = await aiomysql.create_pool(
+                host=self.url.host or 'localhost', port=self.url.port or 3306,
+                user=self.url.username, password=self.url.password or '',
+                db=self.url.database, unix_socket=self.url.query.get('unix_socket'),
+                minsize=self.min_size, maxsize=self.max_size, autocommit=False
+            )
+
+    async def disconnect(self):
+        """Close all the connections of the pool."""
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+    async def _acquire(self):
+        if self._pool is not None:
+            return await self._pool.acquire()
+
+        # SQLite databases are local files, so a connection is opened per request.
+        import aiosqlite
+        return await aiosqlite.connect(self.url.database or ':memory:')
+
+    async def _release(self, connection):
+        if self._pool is not None:
+            self._pool.release(connection)
+        else:
+            await connection.close()
+
+    @property
+    def integrity_error(self):
+        """Exception class raised by the driver when a constraint is violated."""
+        if self._pool is not None:
+            import aiomysql
+            return aiomysql.IntegrityError
+
+        import aiosqlite
+        return aiosqlite.IntegrityError
+
+    @asynccontextmanager
+    async def session(self):
+        """Async context manager yielding an AsyncSession bound to a connection."""
+        connection = await self._acquire()
+        try:
+            yield AsyncSession(connection, self.placeholder, self.integrity_error)
+            await connection.commit()
+        except BaseException:
+            await connection.rollback()
+            raise
+        finally:
+            await self._release(connection)
+# ---------------------
+
+
+# Request Handling
+# ----------------
+class ASGIRequest:
+    """Holds the details of an HTTP request received by the ASGI app, with
+    the attributes of a flask.Request that are read by the request parsers."""
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        # Address of the client, if the server knows it.
+        self.remote_addr = (scope.get('client') or (None, None))[0]
+        self.headers = {
+            key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']
+        }
+        self.mimetype = self.headers.get('content-type', '').split(';')[0].strip().lower()
+        self.body = body
+
+        self.args = MultiDict(parse_qsl(scope['query_string'].decode('latin-1'), keep_blank_values=True))
+        if self.mimetype == 'application/x-www-form-urlencoded':
+            self.form = MultiDict(parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+        else:
+            self.form = MultiDict()
+        self.values = CombinedMultiDict([self.args, self.form])
+        # Lookup row of the user of the session token of the request, if any.
+        self.user = None
+
+    @property
+    def json(self):
+        """Parsed JSON body of the request, or None if the body isn't JSON.
+        Raises BadRequest if the body can't be decoded, like flask.Request."""
+        if not (self.mimetype == 'application/json'
+                or (self.mimetype.startswith('application/') and self.mimetype.endswith('+json'))):
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise BadRequest()
+
+
+def parse_args(parser, request, strict=False):
+    """Parse the arguments of the request with one of the request parsers
+    of the Flask app, so that invalid requests fail with the same errors."""
+    # The context is pushed and popped without awaiting, so it is never
+    # seen by the other requests served by the event loop.
+    with main.app.app_context():
+        return parser.parse_args(req=request, strict=strict)
+
+
+def dump_json(data):
+    """Encode the data of a response the same way as the Flask app does."""
+    if codec.enabled and not main.app.debug and not main.app.config.get('RESTFUL_JSON'):
+        encoded = codec.dumps(data)
+        return encoded if isinstance(encoded, bytes) else encoded.encode('utf-8')
+
+    settings = dict(main.app.config.get('RESTFUL_JSON', {}))
+    if main.app.debug:
+        settings.setdefault('indent', 4)
+        settings.setdefault('sort_keys', False)
+
+    return (json.dumps(data, **settings) + '\n').encode('utf-8')
+
+
+def not_modified(request, etag):
+    """Mirrors main.not_modified(), returning the 304 response in the form
+    returned by the handlers if the client already holds the version of the
+    response identified by the given entity tag. Otherwise, return None."""
+    if parse_etags(request.headers.get('if-none-match')).contains_weak(etag):
+        return None, 304, {'ETag': quote_etag(etag)}
+
+    return None
+# ----------------
+
+
+# Authentication
+# --------------
+class UserRow:
+    """Read-only row held by the name lookup cache of the users, with the
+    same columns as the ones read by main.UserModel.lookup_by_name()."""
+
+    __slots__ = main.UserModel.lookup_columns
+
+    def __init__(self, *values):
+        for column, value in zip(self.__slots__, values):
+            setattr(self, column, value)
+
+    def _asdict(self):
+        return {column: getattr(self, column) for column in self.__slots__}
+
+
+async def authenticate(session, token):
+    """Mirrors main.authenticate()."""
+    token_session = main.session_tokens.load(token)
+    if token_session is None:
+        return None
+
+    user = main.user_name_cache.get(token_session.name)
+    if user is None:
+        record = await session.fetch_one(
+            f'SELECT {", ".join(UserRow.__slots__)} FROM users WHERE name = %s LIMIT 1', (token_session.name,)
+        )
+        if record is None:
+            return None
+        user = UserRow(*record)
+        main.user_name_cache.set(user.name, user)
+
+    if user._id != token_session.user_id or user.session_epoch != token_session.epoch:
+        return None
+
+    return user
+
+
+async def authenticate_request(session, request, endpoint, method):
+    """Mirrors main.authenticate_request(), returning the user of the session
+    token of the request, or None if it has no token."""
+    header = request.headers.get('authorization')
+    if header is None:
+        # Creating a user is the only public request served by this app.
+        if main.AUTH_REQUIRED and (endpoint, method) != ('user_entity', 'POST'):
+            abort(401, error_code=401, error_msg='A session token is required, log in to get one.')
+        return None
+
+    scheme, _, token = header.partition(' ')
+    user = await authenticate(session, token.strip()) if scheme.lower() == 'bearer' else None
+    if user is None:
+        abort(401, error_code=401, error_msg='The given session token is invalid or has expired.')
+
+    return user
+
+
+def check_acting_user(request, name, error_msg):
+    """Mirrors main.check_acting_user()."""
+    if request.user is not None and request.user.name != name:
+        abort(403, error_code=403, error_msg=error_msg)
+# --------------
+
+
+# Rate Limiting
+# -------------
+async def check_rate_limit(scope, key, cost=1):
+    """Mirrors main.check_rate_limit(), taking the tokens off the event loop
+    when the buckets are stored in the database."""
+    if main.RATE_LIMIT_BACKEND == 'database':
+        await asyncio.get_running_loop().run_in_executor(None, main.check_rate_limit, scope, key, cost)
+    else:
+        main.check_rate_limit(scope, key, cost)
+
+
+async def limit_client_rate(request, endpoint):
+    """Mirrors main.limit_client_rate(), for the request of the given
+    endpoint of the Flask app."""
+    if not main.rate_limiter.enabled:
+        return
+
+    client = f'user:{request.user._id}' if request.user is not None else f'address:{request.remote_addr}'
+    await check_rate_limit('client', client, main.RATE_LIMIT_COSTS.get(endpoint, 1))
+# -------------
+
+
+# API Handlers
+# ------------
+# Each handler mirrors the method of the same resource in main.py.
+async def get_all_users(session, request):
+    """Mirrors UserEntity.get."""
+    fields = main.selected_fields(main.user_list_fields, request.args)
+    version, = await session.fetch_one('SELECT MAX(_id) FROM users')
+    etag = main.make_etag('users', False, fields, version)
+    response = not_modified(request, etag)
+    if response:
+        return response
+
+    results = await session.fetch_all('SELECT _id, name, email FROM users')
+
+    if not results:
+        abort(404, error_code=404, error_msg='No user exists in the database')
+
+    users = {}
+    for _id, name, email in results:
+        users[_id] = main.select_fields({'name': name, 'email': email}, fields)
+
+    return [users], 200, {'ETag': quote_etag(etag)}
+
+
+async def create_user(session, request):
+    """Mirrors UserEntity.post."""
+    new_user_args = parse_args(main.user_post_reqparser, request, strict=True)
+
+    name_record = await session.fetch_one('SELECT _id FROM users WHERE name = %s LIMIT 1', (new_user_args['name'],))
+    if name_record:
+        abort(409, error_code=409,
+            error_msg='Cannot create a new user because an user with the given name already exists.'
+        )
+    if not len(new_user_args['password']):
+        abort(409, error_code=409, error_msg='Cannot create a new user because the password field cannot be empty.')
+
+    # The password is hashed by the workers of the credential pool of main.py,
+    # without blocking the event loop.
+    try:
+        password_hash = await asyncio.wait_for(asyncio.wrap_future(
+            main.credential_pool.submit('hash', main.password_hasher.hash, new_user_args['password'])
+        ), main.KDF_TIMEOUT)
+    except (CredentialPoolFull, asyncio.TimeoutError):
+        # Raised with the body and the Retry-After header of the response of
+        # main.credentials_busy_response(), which dispatch() sends like the
+        # one of the 429 errors.
+        data, _, headers = main.credentials_busy_response()
+        error = ServiceUnavailable(retry_after=headers['Retry-After'])
+        error.data = data
+        raise error
+
+    # The name may have been taken by a concurrent request while the password
+    # was hashed, in which case the unique index of the names rejects the user.
+    try:
+        user_id = await session.execute('INSERT INTO users (name, password, email) VALUES (%s, %s, %s)',
+            (new_user_args['name'], password_hash, new_user_args['email'])
+        )
+        await session.execute('INSERT INTO changes (kind, user_id, created_at) VALUES (%s, %s, %s)',
+            (main.ChangeModel.USER_CREATED, user_id, datetime.utcnow())
+        )
+    except session.integrity_error:
+        await session.rollback()
+        abort(409, error_code=409,
+            error_msg='Cannot create a new user because an user with the given name already exists.'
+        )
+    new_user = {
+        '_id': user_id,
+        'name': new_user_args['name'],
+        'email': new_user_args['email']
+    }
+
+    return marshal(new_user, main.user_fields), 201
+
+
+async def get_user_by_name(session, request, name):
+    """Mirrors UserRecord.get."""
+    record = await session.fetch_one(
+        f'SELECT {", ".join(UserRow.__slots__)} FROM users WHERE name = %s LIMIT 1', (name,)
+    )
+
+    if not record:
+        abort(404, error_code=404,
+            error_msg='No user with the given name exists in the database.'
+        )
+
+    fields = main.selected_fields(tuple(main.user_fields), request.args)
+    etag = main.make_etag('user', fields, *record)
+    response = not_modified(request, etag)
+    if response:
+        return response
+
+    user = main.select_fields(marshal(UserRow(*record)._asdict(), main.user_fields), fields)
+
+    return user, 200, {'ETag': quote_etag(etag)}
+
+
+async def get_all_rooms(session, request):
+    """Mirrors RoomEntity.get."""
+    fields = main.selected_fields(main.room_list_fields, request.args)
+    version, = await session.fetch_one('SELECT MAX(_id) FROM rooms')
+    etag = main.make_etag('rooms', False, fields, version)
+    response = not_modified(request, etag)
+    if response:
+        return response
+
+    results = await session.fetch_all(
+        'SELECT rooms._id, rooms.name, users.name FROM rooms JOIN users ON users._id = rooms.admin_id'
+    )
+
+    if not results:
+        abort(404, error_code=404, error_msg='No room exists in the database')
+
+    rooms = {}
+    for _id, name, room_admin_name in results:
+        rooms[_id] = main.select_fields({'name': name, 'room_admin_name': room_admin_name}, fields)
+
+    return [rooms], 200, {'ETag': quote_etag(etag)}
+
+
+async def create_room(session, request):
+    """Mirrors RoomEntity.post."""
+    new_room_args = parse_args(main.room_post_reqparser, request, strict=True)
+    check_acting_user(request, new_room_args['room_admin_name'],
+        'Cannot create a new room administered by another user than the logged in one.'
+    )
+
+    name_record = await session.fetch_one('SELECT _id FROM rooms WHERE name = %s LIMIT 1', (new_room_args['name'],))
+    if name_record:
+        abort(409, error_code=409,
+            error_msg='Cannot create a new room because a room with the given name already exists.'
+        )
+    room_admin = await session.fetch_one('SELECT _id FROM users WHERE name = %s LIMIT 1',
+        (new_room_args['room_admin_name'],)
+    )
+    if not room_admin:
+        abort(409, error_code=409,
+            error_msg='Cannot create a new room because no user with the given name of the room admin exists.'
+        )
+
+    room_id = await session.execute('INSERT INTO rooms (name, admin_id, member_count) VALUES (%s, %s, 1)',
+        (new_room_args['name'], room_admin[0])
+    )
+    await session.execute('INSERT INTO memberships (room_id, user_id) VALUES (%s, %s)', (room_id, room_admin[0]))
+    await session.execute('INSERT INTO changes (kind, user_id, room_id, created_at) VALUES (%s, %s, %s, %s)',
+        (main.ChangeModel.ROOM_CREATED, room_admin[0], room_id, datetime.utcnow())
+    )
+    new_room = {
+        '_id': room_id,
+        'name': new_room_args['name'],
+        'admin_id': room_admin[0]
+    }
+
+    return marshal(new_room, main.room_fields), 201
+
+
+async def get_room_by_name(session, request, name):
+    """Mirrors RoomRecord.get."""
+    record = await session.fetch_one('SELECT _id, name, admin_id FROM rooms WHERE name = %s LIMIT 1', (name,))
+
+    if not record:
+        abort(404, error_code=404,
+            error_msg='No room with the given name exists in the database.'
+        )
+
+    fields = main.selected_fields(tuple(main.room_fields), request.args)
+    etag = main.make_etag('room', fields, *record)
+    response = not_modified(request, etag)
+    if response:
+        return response
+
+    room = main.select_fields(marshal(dict(zip(('_id', 'name', 'admin_id'), record)), main.room_fields), fields)
+
+    return room, 200, {'ETag': quote_etag(etag)}
+
+
+async def fetch_message_page(session, room_id, after_id=None, before_id=None, limit=main.MESSAGES_PAGE_DEFAULT_LIMIT):
+    """Mirrors main.fetch_message_page()."""
+    conditions = ['messages.room_id = %s']
+    parameters = [room_id]
+    if after_id is not None:
+        conditions.append('messages._id > %s')
+        parameters.append(after_id)
+    if before_id is not None:
+        conditions.append('messages._id < %s')
+        parameters.append(before_id)
+    parameters.append(limit + 1)
+
+    order = 'ASC' if after_id is not None else 'DESC'
+    rows = await session.fetch_all(
+        'SELECT messages._id, messages.body, users.name FROM messages '
+        'JOIN users ON users._id = messages.sender_id '
+        f'WHERE {" AND ".join(conditions)} ORDER BY messages._id {order} LIMIT %s',
+        parameters
+    )
+    records = [main.MessageRow(*row) for row in rows]
+
+    has_more = len(records) > limit
+    if after_id is not None:
+        records = records[:limit]
+        next_cursor = records[-1]._id if has_more else None
+    else:
+        records = records[:limit][::-1]
+        next_cursor = records[0]._id if has_more else None
+
+    return records, next_cursor
+
+
+async def archived_through(session, room_id, oldest_id):
+    """Mirrors main.archived_through()."""
+    key = (room_id, oldest_id)
+    last_id = main.archived_id_cache.get(key)
+    if last_id is None:
+        row = await session.fetch_one('SELECT MAX(last_id) FROM archive_segments WHERE room_id = %s', (room_id,))
+        last_id = row[0] or 0
+        main.archived_id_cache.set(key, last_id)
+
+    return last_id
+
+
+async def archived_messages(session, room_id, after_id=None, before_id=None, descending=False, limit=None):
+    """Mirrors main.message_archive.messages(), returning a list. The segments
+    are read and decompressed off the event loop."""
+    conditions = ['room_id = %s']
+    parameters = [room_id]
+    if after_id is not None:
+        conditions.append('last_id > %s')
+        parameters.append(after_id)
+    if before_id is not None:
+        conditions.append('first_id < %s')
+        parameters.append(before_id)
+
+    segments = await session.fetch_all(
+        f'SELECT path FROM archive_segments WHERE {" AND ".join(conditions)} '
+        f'ORDER BY first_id {"DESC" if descending else "ASC"}',
+        parameters
+    )
+
+    loop = asyncio.get_running_loop()
+    messages = []
+    for path, in segments:
+        segment = await loop.run_in_executor(None, main.message_archive.read_segment, path)
+        for message in (reversed(segment) if descending else segment):
+            if (after_id is not None and message._id <= after_id) or (before_id is not None and message._id >= before_id):
+                continue
+
+            messages.append(message)
+            if limit is not None and len(messages) >= limit:
+                return messages
+
+    return messages
+
+
+async def fetch_history_page(session, room_id, oldest_id, after_id=None, before_id=None,
+        limit=main.MESSAGES_PAGE_DEFAULT_LIMIT):
+    """Mirrors main.fetch_history_page()."""
+    if after_id is not None and (oldest_id is None or after_id < oldest_id):
+        last_archived_id = await archived_through(session, room_id, oldest_id)
+        if after_id < last_archived_id:
+            archived = await archived_messages(session, room_id, after_id=after_id, before_id=before_id, limit=limit + 1)
+            if len(archived) > limit:
+                return archived[:limit], archived[limit - 1]._id
+            if len(archived) == limit:
+                has_more = oldest_id is not None and (before_id is None or oldest_id < before_id)
+                return archived, archived[-1]._id if has_more else None
+
+            records, next_cursor = await fetch_message_page(session, room_id,
+                after_id=last_archived_id, before_id=before_id, limit=limit - len(archived)
+            )
+            return archived + records, next_cursor
+
+    records, next_cursor = await fetch_message_page(session, room_id, after_id=after_id, before_id=before_id, limit=limit)
+
+    if after_id is None and next_cursor is None and await archived_through(session, room_id, oldest_id):
+        missing = limit - len(records)
+        archived = await archived_messages(session, room_id,
+            before_id=records[0]._id if records else before_id, descending=True, limit=missing + 1
+        )
+        records = archived[:missing][::-1] + records
+        next_cursor = records[0]._id if len(archived) > missing else None
+
+    return records, next_cursor
+
+
+async def get_msgs_of_a_room(session, request, room_name):
+    """Mirrors Message.get."""
+    page_args = parse_args(main.message_get_reqparser, request)
+    fields = main.selected_fields(main.message_page_fields, request.args)
+    compact = main.wants_compact(request.args)
+
+    limit = page_args['limit']
+    if limit is None:
+        limit = main.MESSAGES_PAGE_DEFAULT_LIMIT
+    if limit < 1:
+        abort(400, error_code=400, error_msg='The limit of a page of messages must be a positive number.')
+    limit = min(limit, main.MESSAGES_PAGE_MAX_LIMIT)
+
+    room = await session.fetch_one('SELECT _id, name FROM rooms WHERE name = %s LIMIT 1', (room_name,))
+
+    if not room:
+        abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
+
+    oldest_id, newest_id = await session.fetch_one('SELECT MIN(_id), MAX(_id) FROM messages WHERE room_id = %s',
+        (room[0],)
+    )
+    etag = main.make_etag('messages', room[0], False, fields, compact, page_args['after_id'],
+        page_args['before_id'], page_args['limit'], oldest_id, newest_id
+    )
+    response = not_modified(request, etag)
+    if response:
+        return response
+
+    results, next_cursor = await fetch_history_page(session, room[0], oldest_id,
+        after_id=page_args['after_id'], before_id=page_args['before_id'], limit=limit
+    )
+
+    if not results and page_args['after_id'] is None and page_args['before_id'] is None:
+        abort(404, error_code=404, error_msg='No messages exist in the given room.')
+
+    page = main.slim_message_page(main.serialize_message_page(results, room[1]), fields, compact)
+    page['next_cursor'] = next_cursor
+
+    return page, 200, {'ETag': quote_etag(etag)}
+
+
+async def create_message(session, request):
+    """Mirrors Message.post."""
+    new_message_args = parse_args(main.message_post_reqparser, request, strict=True)
+    check_acting_user(request, new_message_args['sender_name'],
+        'Cannot create a new message sent by another user than the logged in one.'
+    )
+    await check_rate_limit('sender', new_message_args['sender_name'])
+    await check_rate_limit('room', new_message_args['room_name'])
+
+    sender = await session.fetch_one('SELECT _id FROM users WHERE name = %s LIMIT 1',
+        (new_message_args['sender_name'],)
+    )
+    if not sender:
+        abort(409, error_code=409,
+            error_msg='Cannot create a new message because the given sender doesn\'t exist in the database.'
+        )
+
+    room = await session.fetch_one('SELECT _id FROM rooms WHERE name = %s LIMIT 1', (new_message_args['room_name'],))
+    if not room:
+        abort(409, error_code=409,
+            error_msg='Cannot create a new message because the given room doesn\'t exist in the database.'
+        )
+
+    if not len(new_message_args['body']):
+        abort(409, error_code=409,
+            error_msg='Cannot create a message with an empty body.'
+        )
+
+    message_id = await session.execute(
+        'INSERT INTO messages (body, sender_id, room_id, created_at) VALUES (%s, %s, %s, %s)',
+        (new_message_args['body'], sender[0], room[0], datetime.utcnow())
+    )
+    new_message = {
+        '_id': message_id,
+        'body': new_message_args['body'],
+        'sender_id': sender[0],
+        'room_id': room[0]
+    }
+
+    return marshal(new_message, main.message_fields), 201
+# ------------
+
+
+# ASGI Application
+# ----------------
+class TreeChatASGI:
+    """ASGI application routing the requests to the handlers of the
+    resources, at the same endpoints as the Flask app."""
+
+    # Handlers of each resource, by HTTP method.
+    resources = {
+        'user_entity': {'GET': get_all_users, 'POST': create_user},
+        'user_record': {'GET': get_user_by_name},
+        'room_entity': {'GET': get_all_rooms, 'POST': create_room},
+        'room_record': {'GET': get_room_by_name},
+        'message': {'GET': get_msgs_of_a_room, 'POST': create_message}
+    }
+
+    # Endpoints of the Flask app served by each handler, which pick the costs
+    # of their requests for the rate limiter.
+    flask_endpoints = {
+        get_all_users: 'get_all_users', create_user: 'create_new_user', get_user_by_name: 'get_user_by_name',
+        get_all_rooms: 'get_all_rooms', create_room: 'create_new_room', get_room_by_name: 'get_room_by_name',
+        get_msgs_of_a_room: 'get_all_msgs_of_a_room', create_message: 'create_new_message'
+    }
+
+    url_map = Map([
+        Rule('/users/new', endpoint='user_entity', methods=['GET', 'POST']),
+        Rule('/users/all', endpoint='user_entity', methods=['GET', 'POST']),
+        Rule('/users/<string:name>', endpoint='user_record', methods=['GET']),
+        Rule('/rooms/new', endpoint='room_entity', methods=['GET', 'POST']),
+        Rule('/rooms/all', endpoint='room_entity', methods=['GET', 'POST']),
+        Rule('/rooms/<string:name>', endpoint='room_record', methods=['GET']),
+        Rule('/messages/new', endpoint='message', methods=['GET', 'POST']),
+        Rule('/messages/<string:room_name>', endpoint='message', methods=['GET', 'POST'])
+    ])
+
+    def __init__(self, database):
+        self.database = database
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            body = b''
+            more_body = True
+            while more_body:
+                message = await receive()
+                body += message.get('body', b'')
+                more_body = message.get('more_body', False)
+
+            status, body, headers = await self.dispatch(ASGIRequest(scope, body))
+            if status != 304:
+                headers = [
+                    (b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode('latin-1')),
+                    *headers
+                ]
+            await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+            await send({'type': 'http.response.body', 'body': body if scope['method'] != 'HEAD' else b''})
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.database.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.database.disconnect()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def dispatch(self, request):
+        """Handle a request and return the status code, the body and the extra
+        headers of its response, rendering errors the same way as Flask-RESTful."""
+        headers = []
+        try:
+            endpoint, view_args = self.url_map.bind('localhost').match(request.path, request.method)
+            method = 'GET' if request.method == 'HEAD' else request.method
+            handler = self.resources[endpoint][method]
+
+            async with self.database.session() as session:
+                request.user = await authenticate_request(session, request, endpoint, method)
+                await limit_client_rate(request, self.flask_endpoints[handler])
+                data, status, *extra = await handler(session, request, **view_args)
+            if extra:
+                headers.extend((key.lower().encode('latin-1'), value.encode('latin-1'))
+                    for key, value in extra[0].items())
+        except HTTPException as error:
+            status = error.code
+            data = getattr(error, 'data', {'message': error.description})
+            retry_after = getattr(error, 'retry_after', None)
+            if retry_after is not None:
+                headers.append((b'retry-after', str(retry_after).encode('latin-1')))
+        except Exception:
+            main.app.logger.exception('Exception on %s [%s]', request.path, request.method)
+            status = 500
+            data = {'message': http_status_message(500)}
+
+        # Like the ones of Flask, 304 responses hold neither a body nor the
+        # headers describing it, which are left out by __call__().
+        return status, dump_json(data) if status != 304 else b'', headers
+
+
+app = TreeChatASGI(AsyncDatabase(main.app.config['SQLALCHEMY_DATABASE_URI']))
+# ----------------
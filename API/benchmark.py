@@ -0,0 +1,647 @@
+"""Non-interactive load testing and benchmarking of the TreeChat API.
+
+Seeds a local stand-in of the database (pointed to by DATABASE_URI) with
+realistic volumes of users, rooms and messages, then drives each endpoint
+with concurrent clients and reports the latency percentiles, throughput and
+queries per request of every endpoint as JSON, which can be diffed between
+releases:
+
+    $ export DATABASE_URI=sqlite:////tmp/treechat-bench.db
+    $ python benchmark.py seed --reset --users 10000 --rooms 500 --messages 2000000
+    $ python benchmark.py run --clients 16 --requests 1000 --output before.json
+
+The requests are served in-process by default, so that the queries issued
+by every request can be counted. Pass --base-url to benchmark a running
+server instead, in which case the queries per request are not reported.
+The session tokens of the authenticated scenarios are signed with the
+SESSION_SECRET_KEY of the benchmark, which must then be the server's one.
+
+The CPU time saved by the compiled codecs (see codec.py) over the parsers
+and fields of Flask-RESTful is measured by a microbenchmark:
+
+    $ python benchmark.py codec --iterations 5000
+
+As is the time added to the requests by the rate limiter (see ratelimit.py),
+with its buckets held in memory, and optionally stored in the database:
+
+    $ python benchmark.py ratelimit --iterations 100000 --database
+
+Every random choice is made by a generator seeded with --seed, so two runs
+with the same arguments seed the same data and issue the same requests.
+"""
+import argparse
+import json
+import math
+import platform
+import random
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+import requests
+from flask import g
+from sqlalchemy import func, select
+
+import codec
+import main
+from main import (app, db, count_queries, current_sync_token, message_shards, password_hasher, session_tokens,
+    UserModel, RoomModel, MessageModel, MembershipModel, RateLimitModel, user_fields, message_fields,
+    user_post_reqparser, message_post_reqparser, message_get_reqparser)
+from migrations import backfill_change_log
+from ratelimit import DatabaseBackend, Limit, MemoryBackend, RateLimiter
+
+# Number of rows inserted per statement while seeding the database.
+SEED_BATCH_SIZE = 10000
+
+# Words the bodies of the seeded messages are made of.
+WORDS = (
+    'hello', 'world', 'chat', 'room', 'message', 'tree', 'deploy', 'release', 'meeting',
+    'lunch', 'today', 'tomorrow', 'review', 'please', 'thanks', 'great', 'idea', 'bug',
+    'fix', 'server', 'database', 'latency', 'cloud', 'python', 'flask', 'weekend'
+)
+
+# Password of all the seeded users, whose hash is computed once, as hashing
+# the password of every user would take most of the time of the seeding.
+SEED_PASSWORD = 'bench-password'
+
+# Number of messages sent per request by the POST /messages/bulk scenario.
+BULK_BATCH_SIZE = 50
+
+# Percentiles of the latencies reported for every endpoint.
+PERCENTILES = (50, 95, 99)
+
+
+# Seeding
+# -------
+def insert_in_batches(table, rows, batch_size=SEED_BATCH_SIZE):
+    """Insert the rows yielded by the given iterable into a table, with one
+    executemany() and commit per batch, into their shards if the rows are
+    sharded messages. Return the number of inserted rows."""
+    def insert(batch):
+        if table is MessageModel.__table__ and message_shards is not None:
+            message_shards.insert(batch)
+        else:
+            db.session.execute(table.insert(), batch)
+            db.session.commit()
+
+    inserted, batch = 0, []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            insert(batch)
+            inserted += len(batch)
+            batch = []
+            print(f'Inserted {inserted} rows into the {table.name} table...', file=sys.stderr)
+
+    if batch:
+        insert(batch)
+        inserted += len(batch)
+
+    return inserted
+
+
+def generate_messages(rng, count, user_ids, room_ids):
+    """Yield count rows of messages sent by random users. The activity of the
+    rooms is skewed like in a real deployment: the n-th busiest room receives
+    about 1/n as many messages as the busiest one."""
+    room_weights = [1 / rank for rank in range(1, len(room_ids) + 1)]
+    while count > 0:
+        batch_size = min(count, SEED_BATCH_SIZE)
+        for room_id in rng.choices(room_ids, weights=room_weights, k=batch_size):
+            yield {
+                'body': ' '.join(rng.choices(WORDS, k=rng.randint(3, 30))),
+                'sender_id': rng.choice(user_ids),
+                'room_id': room_id
+            }
+        count -= batch_size
+
+
+def generate_memberships(rng, rooms, user_ids, members):
+    """Yield the rows of the memberships of the given (room_id, admin_id)
+    rooms: their admin, and up to members - 1 other random users."""
+    for room_id, admin_id in rooms:
+        member_ids = {admin_id, *rng.sample(user_ids, min(max(members - 1, 0), len(user_ids)))}
+        for user_id in sorted(member_ids):
+            yield {'room_id': room_id, 'user_id': user_id}
+
+
+def seed_database(users, rooms, messages, members=20, seed=0, reset=False):
+    """Populate the database with the given number of users, rooms (with about
+    the given number of members each) and messages, after dropping all of its
+    tables if reset is true."""
+    rng = random.Random(seed)
+
+    with app.app_context():
+        if reset:
+            db.drop_all()
+            if message_shards is not None:
+                message_shards.drop_tables()
+        db.create_all()
+        if message_shards is not None:
+            message_shards.create_tables()
+
+        password_hash = password_hasher.hash(SEED_PASSWORD)
+        insert_in_batches(UserModel.__table__, (
+            {'name': f'bench-user-{i}', 'password': password_hash, 'email': f'bench-user-{i}@email.com'}
+            for i in range(1, users + 1)
+        ))
+        user_ids = [user_id for user_id, in db.session.query(UserModel._id).order_by(UserModel._id)]
+
+        insert_in_batches(RoomModel.__table__, (
+            {'name': f'bench-room-{i}', 'admin_id': rng.choice(user_ids)}
+            for i in range(1, rooms + 1)
+        ))
+        room_rows = db.session.query(RoomModel._id, RoomModel.admin_id).order_by(RoomModel._id).all()
+        room_ids = [room_id for room_id, _ in room_rows]
+
+        insert_in_batches(MembershipModel.__table__, generate_memberships(rng, room_rows, user_ids, members))
+        db.session.query(RoomModel).update({RoomModel.member_count: select([func.count()])
+            .where(MembershipModel.room_id == RoomModel._id)
+            .as_scalar()
+        }, synchronize_session=False)
+        db.session.commit()
+        with db.engine.begin() as connection:
+            backfill_change_log(connection)
+
+        message_count = insert_in_batches(MessageModel.__table__, generate_messages(rng, messages, user_ids, room_ids))
+
+    print(
+        f'Seeded the database with {len(user_ids)} users, {len(room_ids)} rooms '
+        f'and {message_count} messages.', file=sys.stderr
+    )
+# -------
+
+
+# Scenarios
+# ---------
+class Dataset:
+    """Names and ids of the records in the database, which the scenarios
+    pick the targets of their requests from."""
+
+    def __init__(self, sample_size=10000):
+        with app.app_context():
+            users = db.session.query(UserModel._id, UserModel.name, UserModel.session_epoch) \
+                .order_by(UserModel._id) \
+                .limit(sample_size) \
+                .all()
+            self.user_names = [name for _, name, _ in users]
+            # Session tokens of the sampled users, used by the authenticated scenarios.
+            self.tokens = {name: session_tokens.issue(user_id, name, epoch) for user_id, name, epoch in users}
+            self.room_names = [name for name, in
+                db.session.query(RoomModel.name).order_by(RoomModel._id).limit(sample_size)]
+            self.max_message_id = db.session.query(func.max(MessageModel._id)).scalar() or 0
+            # Token of the state of the database when the benchmark starts,
+            # so that the syncs return the changes made by the benchmark.
+            self.sync_token = current_sync_token()
+            db.session.remove()
+
+        if not self.user_names or not self.room_names:
+            raise SystemExit('The database holds no users or rooms, seed it first with: python benchmark.py seed')
+
+
+def get_all_users(rng, dataset):
+    return 'GET', '/users/all', None
+
+
+def get_user_by_name(rng, dataset):
+    return 'GET', f'/users/{quote(rng.choice(dataset.user_names))}', None
+
+
+def get_all_rooms(rng, dataset):
+    return 'GET', '/rooms/all', None
+
+
+def get_room_by_name(rng, dataset):
+    return 'GET', f'/rooms/{quote(rng.choice(dataset.room_names))}', None
+
+
+def get_members_of_a_room(rng, dataset):
+    return 'GET', f'/rooms/{quote(rng.choice(dataset.room_names))}/members', None
+
+
+def get_rooms_of_a_user(rng, dataset):
+    return 'GET', f'/users/{quote(rng.choice(dataset.user_names))}/rooms', None
+
+
+def login_user(rng, dataset):
+    return 'POST', '/users/login', {'name': rng.choice(dataset.user_names), 'password': SEED_PASSWORD}
+
+
+def sync_changes_of_a_user(rng, dataset):
+    return 'GET', f'/sync?since={dataset.sync_token}&user_name={quote(rng.choice(dataset.user_names))}', None
+
+
+def get_latest_msgs_of_a_room(rng, dataset):
+    return 'GET', f'/messages/{quote(rng.choice(dataset.room_names))}', None
+
+
+def get_older_msgs_of_a_room(rng, dataset):
+    before_id = rng.randint(1, dataset.max_message_id + 1)
+    return 'GET', f'/messages/{quote(rng.choice(dataset.room_names))}?before_id={before_id}', None
+
+
+def create_new_message(rng, dataset):
+    return 'POST', '/messages/new', {
+        'body': ' '.join(rng.choices(WORDS, k=rng.randint(3, 30))),
+        'sender_name': rng.choice(dataset.user_names),
+        'room_name': rng.choice(dataset.room_names)
+    }
+
+
+def authenticated(scenario):
+    """Return a scenario issuing the requests of the given one with the
+    session token of a random user, who is also the sender of the messages."""
+    def authenticated_scenario(rng, dataset):
+        user_name = rng.choice(dataset.user_names)
+        method, path, json_body = scenario(rng, dataset)
+        if json_body is not None and 'sender_name' in json_body:
+            json_body['sender_name'] = user_name
+
+        return method, path, json_body, {'Authorization': f'Bearer {dataset.tokens[user_name]}'}
+
+    return authenticated_scenario
+
+
+def create_new_msgs_in_bulk(rng, dataset):
+    room_name = rng.choice(dataset.room_names)
+    return 'POST', '/messages/bulk', {
+        'messages': [
+            {
+                'body': ' '.join(rng.choices(WORDS, k=rng.randint(3, 30))),
+                'sender_name': rng.choice(dataset.user_names),
+                'room_name': room_name
+            }
+            for _ in range(BULK_BATCH_SIZE)
+        ]
+    }
+
+
+# Scenarios by name, each returning the method, path and JSON body of the
+# next request to issue, and optionally its headers.
+SCENARIOS = {
+    'GET /users/all': get_all_users,
+    'GET /users/{name}': get_user_by_name,
+    'GET /rooms/all': get_all_rooms,
+    'GET /rooms/{name}': get_room_by_name,
+    'GET /rooms/{name}/members': get_members_of_a_room,
+    'GET /users/{name}/rooms': get_rooms_of_a_user,
+    'GET /sync': sync_changes_of_a_user,
+    'POST /users/login': login_user,
+    'GET /messages/{room_name}': get_latest_msgs_of_a_room,
+    'GET /messages/{room_name}?before_id': get_older_msgs_of_a_room,
+    'POST /messages/new': create_new_message,
+    'GET /messages/{room_name} (token)': authenticated(get_latest_msgs_of_a_room),
+    'POST /messages/new (token)': authenticated(create_new_message),
+    'POST /messages/bulk': create_new_msgs_in_bulk
+}
+# ---------
+
+
+# Clients
+# -------
+class InProcessClient:
+    """Issues the requests to the Flask app in-process, counting the queries
+    executed while serving each of them."""
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, json_body, headers=None):
+        """Issue a request and return its status code and number of queries."""
+        with count_queries() as counter:
+            response = self.client.open(path, method=method, json=json_body, headers=headers)
+            response.get_data()
+            response.close()
+        return response.status_code, counter.count
+
+
+class HTTPClient:
+    """Issues the requests over HTTP to a running server."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+
+    def request(self, method, path, json_body, headers=None):
+        """Issue a request and return its status code. The number of queries
+        isn't known, so it's returned as None."""
+        response = self.session.request(method, self.base_url + path, json=json_body, headers=headers)
+        return response.status_code, None
+# -------
+
+
+# Running
+# -------
+def percentile(sorted_values, percent):
+    """Return the given percentile of a sorted list with the nearest-rank method."""
+    if not sorted_values:
+        return None
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def run_client(make_client, scenario, dataset, request_count, seed):
+    """Issue request_count requests of a scenario with a single client, and
+    return a list of (latency, status code, query count) tuples."""
+    rng = random.Random(seed)
+    client = make_client()
+    samples = []
+    for _ in range(request_count):
+        request = scenario(rng, dataset)
+        started_at = time.perf_counter()
+        status_code, query_count = client.request(*request)
+        samples.append((time.perf_counter() - started_at, status_code, query_count))
+
+    return samples
+
+
+def run_scenario(make_client, scenario, dataset, clients, requests_per_scenario, seed):
+    """Drive a scenario with concurrent clients, and return the report of its
+    latencies, throughput, status codes and queries per request."""
+    per_client = [requests_per_scenario // clients + (i < requests_per_scenario % clients) for i in range(clients)]
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        futures = [
+            executor.submit(run_client, make_client, scenario, dataset, count, seed + i)
+            for i, count in enumerate(per_client) if count
+        ]
+        samples = [sample for future in futures for sample in future.result()]
+    elapsed = time.perf_counter() - started_at
+
+    latencies = sorted(latency * 1000 for latency, _, _ in samples)
+    statuses = Counter(str(status_code) for _, status_code, _ in samples)
+    query_counts = [query_count for _, _, query_count in samples if query_count is not None]
+
+    report = {
+        'requests': len(samples),
+        'errors': sum(count for status, count in statuses.items() if int(status) >= 500),
+        'status_codes': dict(sorted(statuses.items())),
+        'throughput_rps': round(len(samples) / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies), 3) if latencies else None,
+            'max': round(latencies[-1], 3) if latencies else None
+        },
+        'queries_per_request': round(sum(query_counts) / len(query_counts), 3) if query_counts else None
+    }
+    for percent in PERCENTILES:
+        value = percentile(latencies, percent)
+        report['latency_ms'][f'p{percent}'] = round(value, 3) if value is not None else None
+
+    return report
+
+
+def run_benchmark(scenario_names, clients, requests_per_scenario, warmup, seed, base_url=None):
+    """Run the given scenarios one after the other and return the report of
+    the whole benchmark as a dict."""
+    dataset = Dataset()
+    make_client = (lambda: HTTPClient(base_url)) if base_url else InProcessClient
+
+    results = {}
+    for index, name in enumerate(scenario_names):
+        scenario = SCENARIOS[name]
+        print(f'Running {name}...', file=sys.stderr)
+        if warmup:
+            run_client(make_client, scenario, dataset, warmup, seed - index - 1)
+        results[name] = run_scenario(make_client, scenario, dataset, clients, requests_per_scenario,
+            seed + index * clients)
+
+    with app.app_context():
+        database = db.engine.dialect.name
+
+    return {
+        'config': {
+            'target': base_url or 'in-process',
+            'database': database,
+            'python': platform.python_version(),
+            'clients': clients,
+            'requests_per_scenario': requests_per_scenario,
+            'warmup': warmup,
+            'seed': seed,
+            'dataset': {
+                'sampled_users': len(dataset.user_names),
+                'sampled_rooms': len(dataset.room_names),
+                'max_message_id': dataset.max_message_id
+            }
+        },
+        'results': results
+    }
+# -------
+
+
+# Codec Microbenchmark
+# --------------------
+def codec_cases():
+    """Return the operations timed by the codec microbenchmark, by name, as
+    (request context arguments, function) tuples."""
+    new_message = {'body': 'Hello world, the release is out!', 'sender_name': 'bench-user-1',
+        'room_name': 'bench-room-1'}
+    message = MessageModel(_id=1, body=new_message['body'], sender_id=1, room_id=1)
+    user = {'_id': 1, 'name': 'bench-user-1', 'email': 'bench-user-1@email.com'}
+    page = {
+        message_id: {'body': new_message['body'], 'sender_name': new_message['sender_name'],
+            'room_name': new_message['room_name']}
+        for message_id in range(1, 51)
+    }
+
+    return {
+        'parse POST /users/new': (
+            {'path': '/users/new', 'method': 'POST', 'json': {'name': 'bench-user-1', 'password': 'p', 'email': 'e'}},
+            lambda: user_post_reqparser.parse_args(strict=True)
+        ),
+        'parse POST /messages/new': (
+            {'path': '/messages/new', 'method': 'POST', 'json': new_message},
+            lambda: message_post_reqparser.parse_args(strict=True)
+        ),
+        'parse GET /messages/{room_name}': (
+            {'path': '/messages/bench-room-1?after_id=100&limit=50'},
+            lambda: message_get_reqparser.parse_args()
+        ),
+        'marshal user': ({}, lambda: codec.marshal(user, user_fields)),
+        'marshal message': ({}, lambda: codec.marshal(message, message_fields)),
+        'encode message': ({}, lambda: codec.output_json(codec.marshal(message, message_fields), 201)),
+        'encode page of 50 messages': ({}, lambda: codec.output_json({'messages': page, 'next_cursor': 50}, 200))
+    }
+
+
+def time_operation(context_kwargs, operation, iterations, repeats=3):
+    """Return the smallest CPU time (in microseconds) taken by an operation,
+    averaged over iterations runs within a request context."""
+    best = None
+    with app.test_request_context(**context_kwargs):
+        for _ in range(repeats):
+            started_at = time.process_time()
+            for _ in range(iterations):
+                operation()
+            elapsed = (time.process_time() - started_at) / iterations * 1e6
+            best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def benchmark_codecs(iterations):
+    """Time the operations of the codecs with the parsers and fields of
+    Flask-RESTful, then with the compiled codecs, and return the report of
+    the CPU time saved per operation, and per POST /messages/new request."""
+    cases = codec_cases()
+    results = {}
+    enabled = codec.enabled
+    try:
+        for name, (context_kwargs, operation) in cases.items():
+            print(f'Timing {name}...', file=sys.stderr)
+            codec.enabled = False
+            reqparse_us = time_operation(context_kwargs, operation, iterations)
+            codec.enabled = True
+            compiled_us = time_operation(context_kwargs, operation, iterations)
+            results[name] = {
+                'reqparse_us': round(reqparse_us, 3),
+                'compiled_us': round(compiled_us, 3),
+                'saved_us': round(reqparse_us - compiled_us, 3),
+                'speedup': round(reqparse_us / compiled_us, 2) if compiled_us else None
+            }
+    finally:
+        codec.enabled = enabled
+
+    # A POST /messages/new request parses its arguments, then marshals and
+    # encodes the new message.
+    per_request = ('parse POST /messages/new', 'encode message')
+    return {
+        'config': {
+            'python': platform.python_version(),
+            'iterations': iterations,
+            'json_backend': codec.JSON_BACKEND
+        },
+        'results': results,
+        'saved_us_per_post_message': round(sum(results[name]['saved_us'] for name in per_request), 3)
+    }
+# --------------------
+
+
+# Rate Limiter Microbenchmark
+# ---------------------------
+def time_hits(limiter, keys, iterations, repeats=3):
+    """Return the smallest wall time (in microseconds) taken to take a token
+    from the bucket of a client, averaged over iterations hits spread over
+    the given keys."""
+    best = None
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        for i in range(iterations):
+            limiter.hit('client', keys[i % len(keys)])
+        elapsed = (time.perf_counter() - started_at) / iterations * 1e6
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def benchmark_rate_limiter(iterations, key_count, database=False):
+    """Time the hits of the rate limiter, allowed and limited, with its
+    buckets held in memory and optionally stored in the database, then the
+    time the rate limiter adds to a POST /messages/new request, and return
+    the report as a dict."""
+    keys = [f'address:10.0.{i // 256}.{i % 256}' for i in range(key_count)]
+    backends = {'memory': lambda: MemoryBackend(max_keys=key_count)}
+    if database:
+        with app.app_context():
+            RateLimitModel.__table__.create(bind=db.engine, checkfirst=True)
+            db.session.execute(RateLimitModel.__table__.delete())
+            db.session.commit()
+        backends['database'] = lambda: DatabaseBackend(db, RateLimitModel.__table__)
+
+    results = {}
+    for name, make_backend in backends.items():
+        # Hits of the database backend are timed on fewer iterations, as each
+        # of them costs round trips.
+        backend_iterations = iterations if name == 'memory' else max(iterations // 100, key_count)
+        for outcome, limit in (('allowed', Limit(1e9, 1e9)), ('limited', Limit(1e-9, 1))):
+            print(f'Timing {outcome} hits of the {name} backend...', file=sys.stderr)
+            limiter = RateLimiter(make_backend(), {'client': limit})
+            # The first hit of every key fills its bucket.
+            for key in keys:
+                limiter.hit('client', key)
+            results[f'{name} {outcome}'] = {'hit_us': round(time_hits(limiter, keys, backend_iterations), 3)}
+
+    # A POST /messages/new request takes a token from the buckets of its
+    # client, of its sender and of its room.
+    def limit_post_message():
+        g.user = None
+        main.limit_client_rate()
+        main.check_rate_limit('sender', 'bench-user-1')
+        main.check_rate_limit('room', 'bench-room-1')
+
+    limiter = main.rate_limiter
+    saved = (limiter.enabled, limiter.backend, limiter.limits)
+    try:
+        limiter.enabled = True
+        limiter.backend = MemoryBackend(max_keys=key_count)
+        limiter.limits = {scope: Limit(1e9, 1e9) for scope in saved[2]}
+        per_request_us = time_operation({'path': '/messages/new', 'method': 'POST'}, limit_post_message, iterations)
+    finally:
+        limiter.enabled, limiter.backend, limiter.limits = saved
+
+    return {
+        'config': {
+            'python': platform.python_version(),
+            'iterations': iterations,
+            'keys': key_count
+        },
+        'results': results,
+        'added_cpu_us_per_post_message': round(per_request_us, 3)
+    }
+# ---------------------------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Seed and benchmark the TreeChat API.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    seed_parser = subparsers.add_parser('seed', help='Populate the database with generated data.')
+    seed_parser.add_argument('--users', type=int, default=1000, help='Number of users to create.')
+    seed_parser.add_argument('--rooms', type=int, default=100, help='Number of rooms to create.')
+    seed_parser.add_argument('--messages', type=int, default=100000, help='Number of messages to create.')
+    seed_parser.add_argument('--members', type=int, default=20, help='Number of members of each room.')
+    seed_parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator.')
+    seed_parser.add_argument('--reset', action='store_true', help='Drop all the tables before seeding.')
+
+    run_parser = subparsers.add_parser('run', help='Benchmark the endpoints and print the report as JSON.')
+    run_parser.add_argument('--clients', type=int, default=8, help='Number of concurrent clients.')
+    run_parser.add_argument('--requests', type=int, default=200, help='Number of requests per scenario.')
+    run_parser.add_argument('--warmup', type=int, default=10, help='Number of untimed requests per scenario.')
+    run_parser.add_argument('--seed', type=int, default=0, help='Seed of the random generator.')
+    run_parser.add_argument('--scenario', action='append', choices=list(SCENARIOS), dest='scenarios',
+        help='Scenario to run, may be repeated (default: all of them).')
+    run_parser.add_argument('--base-url', help='URL of a running server to benchmark, instead of the app in-process.')
+    run_parser.add_argument('--output', help='File to write the report to (default: standard output).')
+
+    codec_parser = subparsers.add_parser('codec',
+        help='Compare the CPU time of the compiled codecs with reqparse and marshal.')
+    codec_parser.add_argument('--iterations', type=int, default=2000, help='Number of runs of each operation.')
+    codec_parser.add_argument('--output', help='File to write the report to (default: standard output).')
+
+    ratelimit_parser = subparsers.add_parser('ratelimit', help='Time the hits of the rate limiter.')
+    ratelimit_parser.add_argument('--iterations', type=int, default=100000, help='Number of hits timed.')
+    ratelimit_parser.add_argument('--keys', type=int, default=1000, help='Number of clients the hits are spread over.')
+    ratelimit_parser.add_argument('--database', action='store_true',
+        help='Also time the buckets stored in the rate_limits table of the database.')
+    ratelimit_parser.add_argument('--output', help='File to write the report to (default: standard output).')
+    args = parser.parse_args()
+
+    if args.command == 'seed':
+        seed_database(args.users, args.rooms, args.messages, members=args.members, seed=args.seed, reset=args.reset)
+    else:
+        if args.command == 'run':
+            report = run_benchmark(args.scenarios or list(SCENARIOS), args.clients, args.requests,
+                args.warmup, args.seed, base_url=args.base_url)
+        elif args.command == 'codec':
+            report = benchmark_codecs(args.iterations)
+        elif args.command == 'ratelimit':
+            report = benchmark_rate_limiter(args.iterations, args.keys, database=args.database)
+
+        report_json = json.dumps(report, indent=2)
+        if args.output:
+            with open(args.output, 'w') as report_file:
+                report_file.write(report_json + '\n')
+        else:
+            print(report_json)
@@ -0,0 +1,171 @@
+import threading
+import time
+from collections import deque
+
+
+class _RoomChannel:
+    """Holds the recently published messages of a room along with the
+    condition on which the subscribers of the room wait for new ones."""
+
+    def __init__(self, backlog, position):
+        self.condition = threading.Condition()
+        # Position of the last message published to the room, see
+        # MessageBroadcaster.position().
+        self.position = position
+        # Recently published messages as (position, previous_position,
+        # message_id, payload) tuples, where previous_position is the position
+        # of the message published to the room before this one.
+        self.events = deque(maxlen=backlog)
+        # Number of subscribers waiting on the condition.
+        self.waiters = 0
+        # When the last message was published to the room, or the channel created.
+        self.published_at = time.monotonic()
+        # Whether the channel was dropped by MessageBroadcaster._sweep().
+        self.closed = False
+
+
+class MessageBroadcaster:
+    """In-process fan-out of newly created messages to the clients waiting
+    for the messages of a room.
+
+    A single call to publish() wakes every subscriber of the room, which then
+    read the new messages from the backlog kept in memory, so waiting clients
+    never poll the database. Waiting only holds a lock on the condition of
+    the room, so a worker can hold thousands of idle subscribers when it is
+    served by a cooperative (e.g. gevent) worker class.
+
+    Only the messages created by the current process are published. A
+    subscriber that was woken up but can't be served from the backlog
+    (because it overflowed, or a message was published without a payload)
+    is told to read the messages from the database instead.
+
+    The channel of a room is dropped once it has no subscribers and no
+    message was published to it for idle_timeout seconds, so the memory used
+    doesn't grow with the number of rooms ever polled. Positions are counted
+    across all the rooms, so a subscriber holding a position taken from a
+    dropped channel reads the messages from the database rather than missing
+    some.
+    """
+
+    def __init__(self, backlog=64, idle_timeout=60):
+        self.backlog = backlog
+        self.idle_timeout = idle_timeout
+        # Number of messages published to all the rooms so far by this process.
+        self._position = 0
+        self._channels = {}
+        self._swept_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _channel(self, room_id):
+        """Return the channel of the given room, creating it if needed."""
+        channel = self._channels.get(room_id)
+        if channel is None:
+            with self._lock:
+                channel = self._channels.get(room_id)
+                if channel is None:
+                    self._sweep()
+                    channel = self._channels[room_id] = _RoomChannel(self.backlog, self._position)
+        return channel
+
+    def _sweep(self):
+        """Drop the idle channels, at most once every idle_timeout seconds.
+        Must be called with the lock held."""
+        now = time.monotonic()
+        if now - self._swept_at < self.idle_timeout:
+            return
+        self._swept_at = now
+
+        for room_id, channel in list(self._channels.items()):
+            if channel.waiters or now - channel.published_at < self.idle_timeout:
+                continue
+            # The condition is held while publishing, which takes the lock, so
+            # a busy channel is skipped rather than waited for.
+            if not channel.condition.acquire(blocking=False):
+                continue
+            try:
+                if not channel.waiters:
+                    channel.closed = True
+                    del self._channels[room_id]
+            finally:
+                channel.condition.release()
+
+    def _open_channel(self, room_id):
+        """Return the channel of the given room, with its condition acquired.
+        The channel is created again if it was dropped in the meantime."""
+        while True:
+            channel = self._channel(room_id)
+            channel.condition.acquire()
+            if not channel.closed:
+                return channel
+            channel.condition.release()
+
+    def position(self, room_id):
+        """Return the position of the last message published to the given room.
+
+        A subscriber should take the position *before* reading the database,
+        and pass it to wait(), so that a message committed in between is
+        never missed.
+        """
+        return self._channel(room_id).position
+
+    def publish(self, room_id, message_id, payload=None):
+        """Publish a newly created message to the subscribers of the given room.
+
+        The payload is the dict returned to the subscribers for the message.
+        If it is None, the subscribers are only woken up and read the new
+        messages from the database, e.g. after a batch of messages is inserted.
+        """
+        channel = self._open_channel(room_id)
+        try:
+            with self._lock:
+                self._position += 1
+                position = self._position
+            channel.events.append((position, channel.position, message_id, payload))
+            channel.position = position
+            channel.published_at = time.monotonic()
+            channel.condition.notify_all()
+        finally:
+            channel.condition.release()
+
+    def wait(self, room_id, position, since_id, timeout):
+        """Block until a message whose id is greater than since_id is published
+        to the given room after the given position, or until timeout seconds
+        have elapsed.
+
+        Return a list of (message_id, payload) tuples of the published messages
+        whose id is greater than since_id, which is empty if the wait timed out.
+        Return None if the new messages can't be served from the backlog, in
+        which case they must be read from the database.
+        """
+        channel = self._open_channel(room_id)
+        channel.waiters += 1
+        channel.condition.release()
+        try:
+            return self._wait(channel, position, since_id, timeout)
+        finally:
+            with channel.condition:
+                channel.waiters -= 1
+
+    def _wait(self, channel, position, since_id, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with channel.condition:
+                if not channel.condition.wait_for(lambda: channel.position > position,
+                        max(deadline - time.monotonic(), 0)):
+                    return []
+
+                events = [event for event in channel.events if event[0] > position]
+
+            # Some of the messages published since the given position were dropped
+            # from the backlog, or from a dropped channel of the room, or were
+            # published without a payload.
+            if not events or events[0][1] > position or any(event[3] is None for event in events):
+                return None
+
+            messages = [(message_id, payload) for _, _, message_id, payload in events if message_id > since_id]
+            if messages:
+                return messages
+
+            # Only messages the subscriber already has were published, so it
+            # keeps waiting for new ones until the timeout.
+            position = events[-1][0]
@@ -0,0 +1,297 @@
+"""Precompiled request parsers, response serializers and JSON encoding.
+
+Flask-RESTful's reqparse and marshal resolve every argument and every field
+through several layers of reflection on each request. The codecs here are
+compiled once from the same parser arguments and fields, into plain loops
+over the arguments and fields actually used by the API, and produce the same
+values, the same output and the same error messages:
+
+    CompiledRequestParser - A RequestParser which parses the arguments of
+        requests with a JSON object body (or a query string) itself, and
+        falls back to reqparse for anything else, e.g. form bodies.
+    marshal / marshal_with - Drop-in replacements for the ones of
+        Flask-RESTful, compiling each dict of fields on first use.
+    output_json - Representation of the JSON responses, encoding them with
+        the configured backend.
+
+The codecs are configured with the following environment variables:
+    CODEC        - 'compiled' (default), or 'reqparse' to always use the
+                   parsers and fields of Flask-RESTful.
+    JSON_BACKEND - 'json' (default) to encode the responses with the standard
+                   library, with exactly the same output as Flask-RESTful, or
+                   'orjson' to encode them with orjson, if it is installed.
+                   orjson writes the same JSON values, but compact and without
+                   escaping non-ASCII characters.
+"""
+import json
+import os
+from functools import wraps
+
+import flask_restful
+from flask import current_app, request
+from flask_restful import fields as restful_fields
+from flask_restful.reqparse import Argument, Namespace, _friendly_location
+from flask_restful.representations.json import output_json as restful_output_json
+from flask_restful.utils import unpack
+from werkzeug.exceptions import BadRequest
+
+from instrumentation import RequestParser, phase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CODEC = os.getenv('CODEC', 'compiled').strip().lower()
+JSON_BACKEND = os.getenv('JSON_BACKEND', 'json').strip().lower()
+
+if CODEC not in ('compiled', 'reqparse'):
+    raise ValueError(f'Unknown CODEC: {CODEC}')
+if JSON_BACKEND not in ('json', 'orjson'):
+    raise ValueError(f'Unknown JSON_BACKEND: {JSON_BACKEND}')
+if JSON_BACKEND == 'orjson' and orjson is None:
+    raise ValueError('JSON_BACKEND is set to orjson, but orjson is not installed.')
+
+# Whether the compiled codecs are used, which can be switched off at runtime
+# to compare them with the ones of Flask-RESTful.
+enabled = CODEC == 'compiled'
+
+# Types of the arguments the compiled parsers convert. Calling any of them
+# with the value alone gives the same result as reqparse's conversion.
+COMPILED_ARGUMENT_TYPES = (str, int, float, list)
+
+# Locations of the arguments the compiled parsers read.
+DEFAULT_LOCATION = ('json', 'values')
+COMPILED_LOCATIONS = ('json', 'args', DEFAULT_LOCATION)
+
+
+# Request Parsers
+# ---------------
+def _compile_argument(argument):
+    """Return a (name, dest, location, convert, required, default, help,
+    missing_msg) tuple for the argument, or None if it uses options that
+    only reqparse supports."""
+    location = tuple(argument.location) if isinstance(argument.location, (list, tuple)) else argument.location
+    if argument.type not in COMPILED_ARGUMENT_TYPES or location not in COMPILED_LOCATIONS \
+            or argument.action != 'store' or argument.choices or argument.ignore or argument.trim \
+            or not argument.case_sensitive or tuple(argument.operators) != ('=',) or not argument.store_missing:
+        return None
+
+    if isinstance(location, str):
+        missing_msg = f'Missing required parameter in {_friendly_location.get(location, location)}'
+    else:
+        missing_msg = 'Missing required parameter in ' + ' or '.join(_friendly_location.get(l, l) for l in location)
+
+    argument_type, nullable = argument.type, argument.nullable
+
+    def convert(value):
+        if value is None:
+            if nullable:
+                return None
+            raise ValueError('Must not be null!')
+        return argument_type(value)
+
+    return (argument.name, argument.dest or argument.name, location, convert,
+        argument.required, argument.default, argument.help, missing_msg)
+
+
+def _abort_invalid(name, help_text, error):
+    error_str = str(error)
+    flask_restful.abort(400, message={name: help_text.format(error_msg=error_str) if help_text else error_str})
+
+
+class CompiledRequestParser(RequestParser):
+    """RequestParser compiling its arguments on first use, which parses the
+    arguments of the requests whose body is a JSON object, or which only
+    have a query string, without going through reqparse.
+
+    Only the options of the arguments used by the API are compiled. Parsers
+    with other options, and requests that reqparse would read differently
+    (e.g. a JSON body holding lists in a parser reading the query string
+    too), are parsed by reqparse.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._plan = None
+
+    def add_argument(self, *args, **kwargs):
+        self._plan = None
+        return super().add_argument(*args, **kwargs)
+
+    def _compile(self):
+        if self.bundle_errors or self.trim or self.argument_class is not Argument \
+                or self.namespace_class is not Namespace:
+            return False
+
+        plan = [_compile_argument(argument) for argument in self.args]
+        return plan if all(plan) else False
+
+    def parse_args(self, req=None, strict=False, http_error_code=400):
+        if self._plan is None:
+            self._plan = self._compile()
+
+        if enabled and self._plan and req is None and http_error_code == 400 \
+                and not current_app.config.get('BUNDLE_ERRORS', False):
+            with phase('parse'):
+                namespace = self._parse_compiled(strict)
+            if namespace is not None:
+                return namespace
+
+        return super().parse_args(req, strict, http_error_code)
+
+    def _parse_compiled(self, strict):
+        """Parse the arguments of the current request, or return None if the
+        request must be parsed by reqparse."""
+        plan = self._plan
+        body = None
+        if strict or any(location != 'args' for _, _, location, *_ in plan):
+            if request.values:
+                return None
+            # Raises a 400 error for a malformed body, like reqparse.
+            body = request.get_json()
+            if not isinstance(body, dict):
+                return None
+            if any(location == DEFAULT_LOCATION for _, _, location, *_ in plan) \
+                    and any(isinstance(value, (list, tuple)) for value in body.values()):
+                return None
+        if strict and any(location == 'args' for _, _, location, *_ in plan):
+            return None
+
+        namespace = Namespace()
+        for name, dest, location, convert, required, default, help_text, missing_msg in plan:
+            if location == 'args':
+                values = request.args.getlist(name)
+            elif name in body:
+                values = [body[name]]
+            else:
+                values = ()
+
+            result = found = None
+            for value in values:
+                try:
+                    value = convert(value)
+                except Exception as error:
+                    _abort_invalid(name, help_text, error)
+                if not found:
+                    result, found = value, True
+
+            if not found:
+                if required:
+                    _abort_invalid(name, help_text, ValueError(missing_msg))
+                result = default() if callable(default) else default
+            namespace[dest] = result
+
+        if strict:
+            unknown = [key for key in body if key not in {name for name, *_ in plan}]
+            if unknown:
+                raise BadRequest('Unknown arguments: %s' % ', '.join(unknown))
+
+        return namespace
+# ---------------
+
+
+# Serializers
+# -----------
+class MarshallingError(Exception):
+    """Raised when a dict of fields can't be compiled."""
+
+
+def _compile_fields(fields):
+    """Return a function converting a dict (or an object, through its
+    attributes) into the dict of the given fields, with the same values as
+    flask_restful.marshal(), or raise MarshallingError if some of the
+    fields are neither String nor Integer fields."""
+    formats = []
+    for key, field in fields.items():
+        field_type = field if isinstance(field, type) else type(field)
+        field = field() if isinstance(field, type) else field
+        if field_type not in (restful_fields.String, restful_fields.Integer) or field.attribute is not None \
+                or not isinstance(key, str) or hasattr(dict, key):
+            raise MarshallingError(key)
+        formats.append((key, field_type is restful_fields.Integer, field.default))
+
+    def serialize(data):
+        get = data.get if type(data) is dict else (lambda key: getattr(data, key, None))
+        output = {}
+        for key, is_integer, default in formats:
+            value = get(key)
+            if value is None:
+                output[key] = default
+            elif is_integer:
+                try:
+                    output[key] = int(value)
+                except ValueError as error:
+                    raise restful_fields.MarshallingException(error)
+            else:
+                output[key] = str(value)
+        return output
+
+    return serialize
+
+
+# Compiled serializers by id of their dict of fields, along with the dict
+# itself so that its id isn't reused. None for the dicts that can't be compiled.
+_serializers = {}
+
+
+def marshal(data, fields, envelope=None):
+    """Drop-in replacement of flask_restful.marshal(), serializing dicts and
+    objects without an __iter__ method with the compiled fields."""
+    if enabled and envelope is None and (type(data) is dict or not hasattr(data, '__iter__')):
+        entry = _serializers.get(id(fields))
+        if entry is None:
+            try:
+                entry = _serializers[id(fields)] = (fields, _compile_fields(fields))
+            except MarshallingError:
+                entry = _serializers[id(fields)] = (fields, None)
+        if entry[1] is not None:
+            return entry[1](data)
+
+    return flask_restful.marshal(data, fields, envelope)
+
+
+class marshal_with(flask_restful.marshal_with):
+    """marshal_with decorator marshalling with the compiled fields, timed as
+    the 'serialize' phase."""
+
+    def __call__(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            resp = f(*args, **kwargs)
+            with phase('serialize'):
+                if isinstance(resp, tuple):
+                    data, code, headers = unpack(resp)
+                    return marshal(data, self.fields, self.envelope), code, headers
+                return marshal(resp, self.fields, self.envelope)
+
+        return wrapper
+# -----------
+
+
+# JSON Encoding
+# -------------
+# Reused encoder with the default settings of json.dumps().
+_json_encoder = json.JSONEncoder()
+
+
+def dumps(data):
+    """Encode data into a JSON document ending with a new line, with the
+    configured backend."""
+    if JSON_BACKEND == 'orjson':
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return _json_encoder.encode(data) + '\n'
+
+
+def output_json(data, code, headers=None):
+    """Representation of the JSON responses, which encodes them with the
+    configured backend. Falls back to the representation of Flask-RESTful
+    when the encoding is customized by the RESTFUL_JSON setting of the app,
+    or in debug mode."""
+    if not enabled or current_app.debug or current_app.config.get('RESTFUL_JSON'):
+        return restful_output_json(data, code, headers)
+
+    response = current_app.response_class(dumps(data), status=code)
+    response.headers.extend(headers or {})
+    return response
+# -------------
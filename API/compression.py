@@ -0,0 +1,152 @@
+"""Negotiated compression of the response bodies of the Flask app.
+
+The body of a response is compressed when the client accepts one of the
+supported encodings in its Accept-Encoding header, and the body is of a
+compressible type (JSON, newline delimited JSON or text):
+    br   - Brotli, preferred when the client accepts it, if the brotli
+           module is installed.
+    gzip - gzip, always available.
+Bodies smaller than min_size bytes are sent as they are, as compressing them
+costs more CPU than it saves bytes on the wire. Streamed bodies are
+compressed while they're being sent, whatever their size.
+
+A compressed response carries a Vary: Accept-Encoding header, and its ETag
+is made weak, as the bytes of the body depend on the encoding while the
+content they hold stays the same. The weak ETags still match the
+If-None-Match headers of the conditional requests.
+"""
+import gzip
+import threading
+import zlib
+
+from flask import request
+
+from instrumentation import phase
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Mimetypes of the bodies that are compressed.
+COMPRESSIBLE_MIMETYPES = frozenset((
+    'application/json', 'application/x-ndjson', 'text/plain', 'text/html', 'text/csv'
+))
+
+# Status codes of the responses which have no body to compress.
+EMPTY_BODY_STATUS_CODES = frozenset((204, 304))
+
+
+def _compress_stream(chunks, encoding, level, brotli_quality):
+    """Yield the given chunks of a streamed body, compressed with the given
+    encoding. Output is only yielded once the compressor has some, so that
+    the chunks are compressed together rather than one by one."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=brotli_quality)
+        compress, finish = compressor.process, compressor.finish
+    else:
+        # wbits of 31 writes a gzip header and trailer around the stream.
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        compress, finish = compressor.compress, compressor.flush
+
+    try:
+        for chunk in chunks:
+            data = compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield finish()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+class Compression:
+    """Flask extension compressing the bodies of the responses of an app.
+
+    min_size is the size (in bytes) below which bodies aren't compressed,
+    level is the gzip compression level (1-9) and brotli_quality is the
+    Brotli quality (0-11). Compression is timed as the 'compress' phase of
+    the requests.
+    """
+
+    def __init__(self, app=None, enabled=True, min_size=1024, level=6, brotli_quality=4):
+        self.enabled = enabled
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+        self._stats = {
+            encoding: {'responses': 0, 'bytes_in': 0, 'bytes_out': 0} for encoding in self.encodings
+        }
+        self._lock = threading.Lock()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.enabled:
+            app.after_request(self._compress_response)
+
+    def negotiate(self):
+        """Return the encoding preferred by the client among the supported
+        ones, or None if it accepts none of them."""
+        return request.accept_encodings.best_match(self.encodings)
+
+    def compress(self, data, encoding):
+        """Return the given bytes compressed with the given encoding."""
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+
+        # A fixed modification time keeps the output the same for the same body.
+        return gzip.compress(data, compresslevel=self.level, mtime=0)
+
+    def _compress_response(self, response):
+        if response.direct_passthrough or response.status_code in EMPTY_BODY_STATUS_CODES \
+                or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_MIMETYPES:
+            return response
+
+        # The response depends on the Accept-Encoding header, even when this
+        # one isn't compressed.
+        response.vary.add('Accept-Encoding')
+
+        if not response.is_streamed and response.calculate_content_length() < self.min_size:
+            return response
+
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = _compress_stream(response.response, encoding, self.level, self.brotli_quality)
+            response.headers.pop('Content-Length', None)
+        else:
+            data = response.get_data()
+            with phase('compress'):
+                compressed = self.compress(data, encoding)
+            if len(compressed) >= len(data):
+                return response
+
+            response.set_data(compressed)
+            self._record(encoding, len(data), len(compressed))
+
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+
+        return response
+
+    def _record(self, encoding, bytes_in, bytes_out):
+        with self._lock:
+            stats = self._stats[encoding]
+            stats['responses'] += 1
+            stats['bytes_in'] += bytes_in
+            stats['bytes_out'] += bytes_out
+
+    def stats(self):
+        """Return the number of responses compressed with each encoding, along
+        with the size of their bodies before and after compression, as a dict.
+        Streamed responses aren't counted."""
+        with self._lock:
+            return {encoding: dict(stats) for encoding, stats in self._stats.items()}
@@ -0,0 +1,233 @@
+"""Hashing and verification of the passwords of the users.
+
+Passwords are stored hashed with a slow key derivation function (KDF), in
+the format '<scheme>$<cost parameters>$<salt>$<hash>', where the salt and
+the hash are encoded in base64:
+    scrypt        - 'scrypt$<n>$<r>$<p>$<salt>$<hash>', the default.
+    pbkdf2_sha256 - 'pbkdf2_sha256$<iterations>$<salt>$<hash>'.
+Passwords stored before hashing was introduced are still verified, and are
+hashed on the next successful login, as are the hashes made with a scheme
+or a cost other than the configured ones.
+
+The KDF work runs in a CredentialPool: a bounded pool of worker threads,
+off the threads serving the requests, which is never given more than
+max_pending passwords at once. hashlib releases the GIL while deriving a
+key, so the workers run in parallel with each other and with the requests,
+while the number of workers caps the CPU taken by bursts of logins. Once
+the pool is full, new requests are rejected right away rather than queued
+behind the burst, and the requests serving the chat keep their share of
+the CPU.
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from instrumentation import phase
+
+# Schemes of the hashes of the passwords.
+SCHEME_SCRYPT = 'scrypt'
+SCHEME_PBKDF2 = 'pbkdf2_sha256'
+
+# Length (in bytes) of the salts and of the derived keys.
+SALT_SIZE = 16
+KEY_SIZE = 32
+
+
+class CredentialPoolFull(Exception):
+    """Raised when a password is submitted while the credential pool already
+    holds max_pending passwords."""
+
+
+def _encode(data):
+    return base64.b64encode(data).decode('ascii').rstrip('=')
+
+
+def _decode(text):
+    return base64.b64decode(text + '=' * (-len(text) % 4))
+
+
+class PasswordHasher:
+    """Hashes passwords with the configured scheme and cost, and verifies
+    them against hashes of any supported scheme and cost."""
+
+    def __init__(self, scheme=SCHEME_SCRYPT, scrypt_n=2 ** 14, scrypt_r=8, scrypt_p=1, pbkdf2_iterations=600000):
+        if scheme not in (SCHEME_SCRYPT, SCHEME_PBKDF2):
+            raise ValueError(f'Unknown PASSWORD_SCHEME: {scheme}')
+
+        self.scheme = scheme
+        self.scrypt_n = scrypt_n
+        self.scrypt_r = scrypt_r
+        self.scrypt_p = scrypt_p
+        self.pbkdf2_iterations = pbkdf2_iterations
+
+    def _parameters(self):
+        if self.scheme == SCHEME_SCRYPT:
+            return [self.scrypt_n, self.scrypt_r, self.scrypt_p]
+        return [self.pbkdf2_iterations]
+
+    @staticmethod
+    def _derive(scheme, parameters, password, salt):
+        password = password.encode('utf-8')
+        if scheme == SCHEME_SCRYPT:
+            n, r, p = parameters
+            # Memory used by scrypt, plus some headroom for OpenSSL.
+            maxmem = 128 * r * (n + p + 2) + 2 ** 20
+            return hashlib.scrypt(password, salt=salt, n=n, r=r, p=p, maxmem=maxmem, dklen=KEY_SIZE)
+
+        iterations, = parameters
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations, dklen=KEY_SIZE)
+
+    @staticmethod
+    def _split(encoded):
+        """Return the scheme, the cost parameters, the salt and the key of the
+        given hash, or None if it isn't a hash of a supported scheme."""
+        scheme, _, rest = encoded.partition('$')
+        fields = rest.split('$')
+        expected = {SCHEME_SCRYPT: 5, SCHEME_PBKDF2: 3}.get(scheme)
+        if expected is None or len(fields) != expected:
+            return None
+
+        try:
+            return scheme, [int(value) for value in fields[:-2]], _decode(fields[-2]), _decode(fields[-1])
+        except ValueError:
+            return None
+
+    def hash(self, password):
+        """Return the hash of the given password, with a new random salt."""
+        salt = secrets.token_bytes(SALT_SIZE)
+        parameters = self._parameters()
+        key = self._derive(self.scheme, parameters, password, salt)
+
+        return '$'.join([self.scheme, *(str(value) for value in parameters), _encode(salt), _encode(key)])
+
+    def verify(self, password, encoded):
+        """Return True if the given password matches the given hash, or the
+        given password stored before hashing was introduced."""
+        parts = self._split(encoded)
+        if parts is None:
+            return hmac.compare_digest(password.encode('utf-8'), encoded.encode('utf-8'))
+
+        scheme, parameters, salt, key = parts
+        return hmac.compare_digest(self._derive(scheme, parameters, password, salt), key)
+
+    def is_hash(self, encoded):
+        """Return True if the given value is a hash of a supported scheme,
+        rather than a password stored before hashing was introduced."""
+        return self._split(encoded) is not None
+
+    def needs_rehash(self, encoded):
+        """Return True if the given hash isn't made with the configured scheme
+        and cost, e.g. a password stored before hashing was introduced."""
+        parts = self._split(encoded)
+        return parts is None or parts[0] != self.scheme or parts[1] != self._parameters()
+
+
+def default_workers():
+    """Return the default number of workers of a CredentialPool: half of the
+    CPUs, leaving the other half to the requests serving the chat."""
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+class CredentialPool:
+    """Bounded pool of workers hashing and verifying passwords.
+
+    workers is the number of passwords hashed at once, max_pending the
+    number of passwords the pool holds at once (hashed or waiting for a
+    worker), and timeout the number of seconds a request waits for its
+    password to be hashed. The time spent waiting is timed as the 'kdf'
+    phase of the requests, and the durations of the hashes and of the waits
+    for a worker are recorded into the given metrics registry, if any.
+    """
+
+    def __init__(self, hasher, workers=2, max_pending=64, timeout=10.0, metrics=None):
+        self.hasher = hasher
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.metrics = metrics
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='credentials')
+        self._pending = 0
+        self._completed = 0
+        self._rejected = 0
+        self._lock = threading.Lock()
+        # Hash checked against the passwords of unknown users, so that their
+        # logins take as long as the ones of existing users.
+        self._dummy_hash = None
+
+        if metrics is not None:
+            metrics.describe('treechat_kdf_duration_seconds', 'Time spent hashing passwords, by operation.')
+            metrics.describe('treechat_kdf_wait_seconds', 'Time passwords waited for a worker, by operation.')
+
+    def submit(self, operation, function, *args):
+        """Run function(*args) on a worker and return its Future, labelling its
+        timings with the given operation.
+
+        Raise CredentialPoolFull if the pool already holds max_pending passwords.
+        """
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._rejected += 1
+                raise CredentialPoolFull()
+            self._pending += 1
+
+        submitted_at = time.perf_counter()
+
+        def run():
+            started_at = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                finished_at = time.perf_counter()
+                with self._lock:
+                    self._pending -= 1
+                    self._completed += 1
+                if self.metrics is not None:
+                    labels = (('operation', operation),)
+                    self.metrics.observe('treechat_kdf_wait_seconds', labels, started_at - submitted_at)
+                    self.metrics.observe('treechat_kdf_duration_seconds', labels, finished_at - started_at)
+
+        return self._executor.submit(run)
+
+    def hash(self, password):
+        """Return the hash of the given password, once a worker has made it.
+
+        Raise CredentialPoolFull if the pool is full, and
+        concurrent.futures.TimeoutError if the hash takes longer than timeout.
+        """
+        with phase('kdf'):
+            return self.submit('hash', self.hasher.hash, password).result(timeout=self.timeout)
+
+    def verify(self, password, encoded):
+        """Return True if the given password matches the given hash, once a
+        worker has checked it. If encoded is None, i.e. the user doesn't exist,
+        the password is checked against a dummy hash, and False is returned.
+
+        Raise CredentialPoolFull if the pool is full, and
+        concurrent.futures.TimeoutError if the check takes longer than timeout.
+        """
+        if encoded is None:
+            if self._dummy_hash is None:
+                self._dummy_hash = self.hash(secrets.token_hex(SALT_SIZE))
+            encoded, password = self._dummy_hash, None
+
+        with phase('kdf'):
+            matches = self.submit('verify', self.hasher.verify, password or '', encoded).result(timeout=self.timeout)
+
+        return matches and password is not None
+
+    def stats(self):
+        """Return the number of workers of the pool, along with the number of
+        passwords pending, completed and rejected so far, as a dict."""
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'max_pending': self.max_pending,
+                'pending': self._pending,
+                'completed': self._completed,
+                'rejected': self._rejected
+            }
@@ -0,0 +1,312 @@
+"""Per-request timings, SQL statistics and sampled profiles of the Flask app.
+
+Every request is timed as a whole and split into phases:
+    parse     - Parsing of the arguments by the request parsers.
+    db        - Queries and hydration of their results, including name lookups.
+    serialize - Marshalling and encoding of the response body.
+    commit    - Commits of the session.
+    kdf       - Hashing and verification of passwords (see credentials.py).
+    compress  - Compression of the response body (see compression.py).
+The number and the duration of the SQL statements executed while serving
+the request are recorded by engine events.
+
+The timings of a request are returned in its Server-Timing header, and the
+aggregated timings of all the requests of the process are exposed in the
+Prometheus text format by the /metrics endpoint. A sample of the requests
+can also be profiled with cProfile, each profile being dumped to a file
+which can be read with pstats or snakeviz.
+
+The bodies of streamed responses are produced after their headers are sent,
+so their serialization isn't part of their timings.
+"""
+import cProfile
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_app_context, request
+from flask_restful import reqparse
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Upper bounds (in seconds) of the buckets of the histograms of durations.
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Phases of a request, in the order in which they're reported.
+PHASES = ('parse', 'db', 'serialize', 'commit', 'kdf', 'compress')
+
+
+class RequestTimings:
+    """Holds the timings of the request being served, in seconds."""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases = defaultdict(float)
+        self.active_phases = set()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.commit_started_at = None
+        self.profiler = None
+
+
+def current_timings():
+    """Return the timings of the request being served, or None outside of
+    an instrumented request."""
+    return g.get('_request_timings') if has_app_context() else None
+
+
+@contextmanager
+def phase(name):
+    """Context manager adding the time spent within its block to the given
+    phase of the current request. Nested blocks of the same phase are only
+    counted once, so instrumented helpers can call each other."""
+    timings = current_timings()
+    if timings is None or name in timings.active_phases:
+        yield
+        return
+
+    timings.active_phases.add(name)
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.phases[name] += time.perf_counter() - started_at
+        timings.active_phases.discard(name)
+
+
+def timed(phase_name):
+    """Decorator adding the time spent in the decorated function to the given
+    phase of the current request."""
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with phase(phase_name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class RequestParser(reqparse.RequestParser):
+    """RequestParser whose parsing is timed as the 'parse' phase."""
+
+    def parse_args(self, *args, **kwargs):
+        with phase('parse'):
+            return super().parse_args(*args, **kwargs)
+
+
+# SQL Statistics
+# --------------
+# The start of the statement being executed is held as a single value, which
+# is overwritten by the next statement when after_cursor_execute isn't fired
+# because the statement raised, so nothing is left behind on the connection.
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info['query_started_at'] = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info['query_started_at']
+    timings = current_timings()
+    if timings is not None:
+        timings.sql_count += 1
+        timings.sql_time += duration
+# --------------
+
+
+# Metrics
+# -------
+class Histogram:
+    """Cumulative histogram of observed values, with their count and sum."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _format_labels(labels):
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}' if labels else ''
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricsRegistry:
+    """Thread-safe registry of the counters and histograms of the requests
+    served by the process, rendered in the Prometheus text format.
+
+    Collectors can be added to report gauges read at scrape time (e.g. the
+    statistics of caches), as functions returning a list of
+    (name, type, help, [(labels, value), ...]) tuples, where labels is a
+    tuple of (key, value) pairs.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(lambda: defaultdict(int))
+        self._histograms = defaultdict(lambda: defaultdict(Histogram))
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name, help_text):
+        self._help[name] = help_text
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[name][labels] += value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            self._histograms[name][labels].observe(value)
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        """Return all the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        with self._lock:
+            for name, samples in sorted(self._counters.items()):
+                lines.append(f'# HELP {name} {self._help.get(name, name)}')
+                lines.append(f'# TYPE {name} counter')
+                for labels, value in sorted(samples.items()):
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+            for name, histograms in sorted(self._histograms.items()):
+                lines.append(f'# HELP {name} {self._help.get(name, name)}')
+                lines.append(f'# TYPE {name} histogram')
+                for labels, histogram in sorted(histograms.items()):
+                    for upper_bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{name}_bucket{_format_labels(labels + (("le", upper_bound),))} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {histogram.count}')
+                    lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}')
+                    lines.append(f'{name}_count{_format_labels(labels)} {histogram.count}')
+
+        for collector in self._collectors:
+            for name, metric_type, help_text, samples in collector():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in samples:
+                    lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+
+        return '\n'.join(lines) + '\n'
+# -------
+
+
+class Instrumentation:
+    """Flask extension timing the requests of an app, and recording their
+    timings into a MetricsRegistry.
+
+    server_timing enables the Server-Timing header of the responses, and
+    profile_sample_rate is the fraction of the requests that are profiled,
+    whose profiles are dumped into profile_dir.
+    """
+
+    def __init__(self, app=None, db=None, server_timing=True, profile_sample_rate=0.0, profile_dir='profiles'):
+        self.server_timing = server_timing
+        self.profile_sample_rate = profile_sample_rate
+        self.profile_dir = profile_dir
+        self.metrics = MetricsRegistry()
+        self.metrics.describe('treechat_requests_total', 'Requests served, by endpoint, method and status code.')
+        self.metrics.describe('treechat_request_duration_seconds', 'Duration of the requests, by endpoint.')
+        self.metrics.describe('treechat_request_phase_duration_seconds', 'Time spent in each phase of the requests, by endpoint.')
+        self.metrics.describe('treechat_sql_queries_total', 'SQL statements executed while serving the requests, by endpoint.')
+        self.metrics.describe('treechat_sql_duration_seconds_total', 'Time spent executing SQL statements, by endpoint.')
+        self.metrics.describe('treechat_profiles_total', 'Requests profiled with cProfile, by endpoint.')
+
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+
+        if db is not None:
+            self.time_commits(db.session)
+
+    def time_commits(self, session):
+        """Time the commits of the given session (or scoped session) as the
+        'commit' phase of the requests."""
+        event.listen(session, 'before_commit', self._start_commit)
+        event.listen(session, 'after_commit', self._finish_commit)
+
+    def _start_commit(self, session):
+        timings = current_timings()
+        if timings is not None:
+            timings.commit_started_at = time.perf_counter()
+
+    def _finish_commit(self, session):
+        timings = current_timings()
+        if timings is not None and timings.commit_started_at is not None:
+            timings.phases['commit'] += time.perf_counter() - timings.commit_started_at
+            timings.commit_started_at = None
+
+    def _start_request(self):
+        timings = g._request_timings = RequestTimings()
+
+        if self.profile_sample_rate and random.random() < self.profile_sample_rate:
+            timings.profiler = cProfile.Profile()
+            try:
+                timings.profiler.enable()
+            except ValueError:
+                # Another profiler is already active on this thread.
+                timings.profiler = None
+
+    def _finish_request(self, response):
+        timings = current_timings()
+        if timings is None:
+            return response
+
+        duration = time.perf_counter() - timings.started_at
+        endpoint = request.endpoint or 'unknown'
+
+        if timings.profiler is not None:
+            timings.profiler.disable()
+            self._dump_profile(timings.profiler, endpoint)
+
+        labels = (('endpoint', endpoint),)
+        self.metrics.inc('treechat_requests_total',
+            labels + (('method', request.method), ('status', response.status_code))
+        )
+        self.metrics.observe('treechat_request_duration_seconds', labels, duration)
+        for phase_name in PHASES:
+            if phase_name in timings.phases:
+                self.metrics.observe('treechat_request_phase_duration_seconds',
+                    labels + (('phase', phase_name),), timings.phases[phase_name]
+                )
+        self.metrics.inc('treechat_sql_queries_total', labels, timings.sql_count)
+        self.metrics.inc('treechat_sql_duration_seconds_total', labels, timings.sql_time)
+
+        if self.server_timing:
+            entries = [
+                f'{phase_name};dur={timings.phases[phase_name] * 1000:.3f}'
+                for phase_name in PHASES if phase_name in timings.phases
+            ]
+            entries.append(f'sql;dur={timings.sql_time * 1000:.3f};desc="{timings.sql_count} queries"')
+            entries.append(f'total;dur={duration * 1000:.3f}')
+            response.headers['Server-Timing'] = ', '.join(entries)
+
+        return response
+
+    def _dump_profile(self, profiler, endpoint):
+        """Write the profile of a request to a file named after its endpoint."""
+        os.makedirs(self.profile_dir, exist_ok=True)
+        file_name = f'{endpoint}-{int(time.time() * 1000)}-{os.getpid()}-{threading.get_ident()}.prof'
+        profiler.dump_stats(os.path.join(self.profile_dir, file_name))
+        self.metrics.inc('treechat_profiles_total', (('endpoint', endpoint),))
@@ -1,8 +1,38 @@
+import hashlib
+import json
+import math
 import os
-
-from flask import Flask
-from flask_restful import Api, Resource, reqparse, fields, marshal_with, abort
-from flask_sqlalchemy import SQLAlchemy
+import secrets
+import threading
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from itertools import islice
+
+from flask import Flask, Response, g, request, stream_with_context
+from flask_restful import Api, Resource, fields, abort
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.http import quote_etag
+from sqlalchemy import event, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.engine import Engine
+
+from archive import MessageArchive
+from broadcast import MessageBroadcaster
+from cache import LRUCache
+from codec import CompiledRequestParser, marshal, marshal_with, output_json
+from compression import Compression
+from credentials import CredentialPool, CredentialPoolFull, PasswordHasher, default_workers
+from instrumentation import Instrumentation, phase, timed
+from pool import pool_stats
+from ratelimit import DatabaseBackend, Limit, MemoryBackend, RateLimiter
+from retention import RetentionJob
+from routing import ReplicaRouter, RoutingSQLAlchemy
+from search import MessageSearchIndex, maintain_fulltext_index, tokenize
+from sessions import SessionTokens
+from sharding import MessageShards
+from writebehind import ACK_FLUSH, IdAllocator, QueueFullError, WriteBehindQueue
 
 # Load Environment Variables
 # --------------------------
@@ -12,6 +42,99 @@ DB_USER_PWD = os.getenv('DB_USER_PWD')
 DB_PUBLIC_IP_ADDRESS = os.getenv('DB_PUBLIC_IP_ADDRESS')
 CONNECTION_NAME = os.getenv('CONNECTION_NAME')
 DATABASE_NAME = os.getenv('DATABASE_NAME')
+
+# URI of the database to connect to instead of the Cloud SQL instance,
+# e.g. a local SQLite or MySQL database used for development and testing.
+DATABASE_URI = os.getenv('DATABASE_URI')
+
+# Name Lookup Caches
+NAME_CACHE_SIZE = int(os.getenv('NAME_CACHE_SIZE', 10000))
+NAME_CACHE_TTL = float(os.getenv('NAME_CACHE_TTL', 60))
+
+# Instrumentation
+SERVER_TIMING = os.getenv('SERVER_TIMING', 'true').strip().lower() in ('1', 'true', 'yes', 'on')
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', 0))
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+
+# Write-behind Queue of Messages (disabled unless the ack mode is set to
+# 'enqueue' or 'flush', see writebehind.py)
+MESSAGE_WRITE_BEHIND = os.getenv('MESSAGE_WRITE_BEHIND', '').strip().lower()
+WRITE_BEHIND_QUEUE_SIZE = int(os.getenv('WRITE_BEHIND_QUEUE_SIZE', 10000))
+WRITE_BEHIND_FLUSH_INTERVAL_MS = float(os.getenv('WRITE_BEHIND_FLUSH_INTERVAL_MS', 50))
+WRITE_BEHIND_FLUSH_BATCH = int(os.getenv('WRITE_BEHIND_FLUSH_BATCH', 500))
+WRITE_BEHIND_ACK_TIMEOUT = float(os.getenv('WRITE_BEHIND_ACK_TIMEOUT', 5))
+WRITE_BEHIND_RETRY_AFTER = int(os.getenv('WRITE_BEHIND_RETRY_AFTER', 1))
+
+# Read Replicas (comma-separated URIs, none by default, see routing.py)
+DB_REPLICA_URIS = [uri.strip() for uri in os.getenv('DB_REPLICA_URIS', '').split(',') if uri.strip()]
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', 5))
+REPLICA_LAG_CHECK_INTERVAL = float(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 1))
+
+# Shards of the Messages (comma-separated URIs, the messages are stored on
+# the primary if none is given, see sharding.py)
+MESSAGE_SHARD_URIS = [uri.strip() for uri in os.getenv('MESSAGE_SHARD_URIS', '').split(',') if uri.strip()]
+
+# Full-text Search of the Messages ('auto', 'fulltext' or 'memory', see search.py)
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'auto').strip().lower()
+
+# Compression of the Responses (see compression.py)
+COMPRESSION = os.getenv('COMPRESSION', 'true').strip().lower() in ('1', 'true', 'yes', 'on')
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', 6))
+BROTLI_QUALITY = int(os.getenv('BROTLI_QUALITY', 4))
+
+# Password Hashing ('scrypt' or 'pbkdf2_sha256', see credentials.py). The
+# number of workers defaults to half of the CPUs.
+PASSWORD_SCHEME = os.getenv('PASSWORD_SCHEME', 'scrypt').strip().lower()
+SCRYPT_N = int(os.getenv('SCRYPT_N', 2 ** 14))
+SCRYPT_R = int(os.getenv('SCRYPT_R', 8))
+SCRYPT_P = int(os.getenv('SCRYPT_P', 1))
+PBKDF2_ITERATIONS = int(os.getenv('PBKDF2_ITERATIONS', 600000))
+KDF_WORKERS = int(os.getenv('KDF_WORKERS', 0)) or default_workers()
+KDF_MAX_PENDING = int(os.getenv('KDF_MAX_PENDING', 64))
+KDF_TIMEOUT = float(os.getenv('KDF_TIMEOUT', 10))
+KDF_RETRY_AFTER = int(os.getenv('KDF_RETRY_AFTER', 1))
+
+# Session Tokens (see sessions.py). The processes serving the API must share
+# the secret key, a random one is only valid in this process. Unless the
+# tokens are required, the requests without one are served as before.
+SESSION_SECRET_KEY = os.getenv('SESSION_SECRET_KEY') or secrets.token_hex(32)
+SESSION_MAX_AGE = int(os.getenv('SESSION_MAX_AGE', 86400))
+SESSION_CACHE_SIZE = int(os.getenv('SESSION_CACHE_SIZE', 10000))
+SESSION_CACHE_TTL = float(os.getenv('SESSION_CACHE_TTL', 300))
+AUTH_REQUIRED = os.getenv('AUTH_REQUIRED', 'false').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Rate Limiting (disabled unless RATE_LIMIT is set, see ratelimit.py). The
+# rates are in requests (or messages) per second, and the bursts the number
+# of them allowed at once. The buckets are held by the process ('memory') or
+# stored in the rate_limits table of the primary ('database').
+RATE_LIMIT = os.getenv('RATE_LIMIT', 'false').strip().lower() in ('1', 'true', 'yes', 'on')
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'memory').strip().lower()
+RATE_LIMIT_MAX_KEYS = int(os.getenv('RATE_LIMIT_MAX_KEYS', 100000))
+RATE_LIMIT_CLIENT_RATE = float(os.getenv('RATE_LIMIT_CLIENT_RATE', 20))
+RATE_LIMIT_CLIENT_BURST = float(os.getenv('RATE_LIMIT_CLIENT_BURST', 40))
+RATE_LIMIT_SENDER_RATE = float(os.getenv('RATE_LIMIT_SENDER_RATE', 1))
+RATE_LIMIT_SENDER_BURST = float(os.getenv('RATE_LIMIT_SENDER_BURST', 10))
+RATE_LIMIT_ROOM_RATE = float(os.getenv('RATE_LIMIT_ROOM_RATE', 20))
+RATE_LIMIT_ROOM_BURST = float(os.getenv('RATE_LIMIT_ROOM_BURST', 100))
+
+# Retention of the Messages (see retention.py). Rooms without a policy of
+# their own keep their messages for RETENTION_DAYS days and/or keep their
+# RETENTION_MESSAGES most recent messages, 0 keeping them forever. Expired
+# messages are archived every RETENTION_INTERVAL seconds by a background
+# thread, if set, into the segments stored under ARCHIVE_DIR (see archive.py),
+# which must be shared by the processes serving the API.
+RETENTION_DAYS = int(os.getenv('RETENTION_DAYS', 0))
+RETENTION_MESSAGES = int(os.getenv('RETENTION_MESSAGES', 0))
+RETENTION_INTERVAL = float(os.getenv('RETENTION_INTERVAL', 0))
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', 1000))
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_CACHE_SIZE = int(os.getenv('ARCHIVE_CACHE_SIZE', 64))
+
+# Syncs only move past the changes and messages inserted more than
+# SYNC_SAFETY_LAG seconds ago, which is the longest a transaction inserting
+# them is expected to take to commit (see settled_id()).
+SYNC_SAFETY_LAG = float(os.getenv('SYNC_SAFETY_LAG', 2))
 # --------------------------
 
 # App Configuration
@@ -20,43 +143,211 @@ app = Flask(__name__)
 api = Api(app)
 
 # Remote MySQL(v8.0) SQL Instance Configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = f'mysql+mysqlconnector://{DB_USER}:{DB_USER_PWD}@{DB_PUBLIC_IP_ADDRESS}/{DATABASE_NAME}?unix_socket=/cloudsql/{CONNECTION_NAME}'
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI or f'mysql+mysqlconnector://{DB_USER}:{DB_USER_PWD}@{DB_PUBLIC_IP_ADDRESS}/{DATABASE_NAME}?unix_socket=/cloudsql/{CONNECTION_NAME}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+# The pool of connections is configured by the DB_POOL_* environment
+# variables, see pool.py. The sessions read from a replica while serving the
+# requests routed to one of them, see routing.py.
+db = RoutingSQLAlchemy(app)
+
+# Timings of the requests, see instrumentation.py.
+instrumentation = Instrumentation(app, db, server_timing=SERVER_TIMING,
+    profile_sample_rate=PROFILE_SAMPLE_RATE, profile_dir=PROFILE_DIR
+)
+# JSON responses are encoded by the configured codec (see codec.py), which is
+# timed as part of the 'serialize' phase.
+api.representation('application/json')(timed('serialize')(output_json))
+# Bodies of the responses are compressed for the clients accepting it, which
+# is timed as the 'compress' phase of the requests, see compression.py.
+compression = Compression(app, enabled=COMPRESSION, min_size=COMPRESSION_MIN_SIZE,
+    level=COMPRESSION_LEVEL, brotli_quality=BROTLI_QUALITY
+)
+# Passwords are hashed and verified by a bounded pool of workers, off the
+# threads serving the requests, which is timed as the 'kdf' phase of the
+# requests, see credentials.py.
+password_hasher = PasswordHasher(scheme=PASSWORD_SCHEME, scrypt_n=SCRYPT_N, scrypt_r=SCRYPT_R, scrypt_p=SCRYPT_P,
+    pbkdf2_iterations=PBKDF2_ITERATIONS
+)
+credential_pool = CredentialPool(password_hasher, workers=KDF_WORKERS, max_pending=KDF_MAX_PENDING,
+    timeout=KDF_TIMEOUT, metrics=instrumentation.metrics
+)
 # -----------------
 
+# Pagination Configuration
+# ------------------------
+# Number of messages returned in a page of the history of a room when the
+# client doesn't ask for a specific limit, and the largest limit it may ask for.
+MESSAGES_PAGE_DEFAULT_LIMIT = 50
+MESSAGES_PAGE_MAX_LIMIT = 200
+
+# Number of rows read from the database at a time by the streamed responses.
+STREAM_BATCH_SIZE = 1000
+
+# Largest number of messages that can be created by a single bulk request.
+MESSAGES_BULK_MAX_BATCH = 1000
+
+# Number of members (or rooms of a user) returned in a page when the client
+# doesn't ask for a specific limit, and the largest limit it may ask for.
+MEMBERS_PAGE_DEFAULT_LIMIT = 100
+MEMBERS_PAGE_MAX_LIMIT = 1000
+
+# Number of results returned in a page of a search of the messages when the
+# client doesn't ask for a specific limit, and the largest limit it may ask for.
+SEARCH_PAGE_DEFAULT_LIMIT = 20
+SEARCH_PAGE_MAX_LIMIT = 100
+
+# Number of changes (and of messages of each database) returned by a sync
+# when the client doesn't ask for a specific limit, and the largest limit it
+# may ask for, along with the largest number of rooms whose messages are synced.
+SYNC_DEFAULT_LIMIT = 500
+SYNC_MAX_LIMIT = 2000
+SYNC_MAX_ROOMS = 1000
+
+# Number of the most recent changes (or messages) read at a time while looking
+# for the last one a sync can move past.
+SYNC_SETTLED_BATCH_SIZE = 1000
+# ------------------------
+
+# Real-time Delivery Configuration
+# --------------------------------
+# Number of seconds a long-poll request waits for a new message when the
+# client doesn't ask for a specific timeout, and the longest it may ask for.
+POLL_DEFAULT_TIMEOUT = 25
+POLL_MAX_TIMEOUT = 55
+
+# Fans out the messages created by this process to the clients waiting
+# for new messages in a room.
+broadcaster = MessageBroadcaster(backlog=64)
+# --------------------------------
+
+# Name Lookup Caches
+# ------------------
+# Map the names of users and rooms to their id and the columns that are
+# read by the resources, so resolving a name doesn't cost a round trip to
+# the database. Filled by the lookups of NameLookupMixin.
+user_name_cache = LRUCache(maxsize=NAME_CACHE_SIZE, ttl=NAME_CACHE_TTL)
+room_name_cache = LRUCache(maxsize=NAME_CACHE_SIZE, ttl=NAME_CACHE_TTL)
+# ------------------
+
+
+# Session Tokens
+# --------------
+# Issues the tokens of the sessions of the users logging in, and verifies
+# them with a cache of the tokens verified recently.
+session_tokens = SessionTokens(SESSION_SECRET_KEY, max_age=SESSION_MAX_AGE,
+    cache_size=SESSION_CACHE_SIZE, cache_ttl=SESSION_CACHE_TTL
+)
+# --------------
+
 # Local Database Models
 # ---------------------
-class UserModel(db.Model):
+class NameLookupMixin:
+    """Mixin adding cached lookups by name to the models of the tables whose
+    records are identified by a unique name.
+
+    Models set name_cache to their name lookup cache, and lookup_columns to
+    the names of the columns read by the resources, which are the ones held
+    by the read-only rows returned by the lookups.
+    """
+
+    name_cache = None
+    lookup_columns = ()
+
+    @classmethod
+    def _lookup_query(cls):
+        return db.session.query(*(getattr(cls, column) for column in cls.lookup_columns))
+
+    @classmethod
+    @timed('db')
+    def lookup_by_name(cls, name):
+        """Return a read-only row holding the lookup columns of the record with
+        the given name, or None if no such record exists.
+
+        Rows are served from the name lookup cache of the model, and only read
+        from the database (and cached) when they are not found in it.
+        """
+        record = cls.name_cache.get(name)
+        if record is None:
+            record = cls._lookup_query().filter(cls.name == name).first()
+            if record is not None:
+                cls.name_cache.set(name, record)
+
+        return record
+
+    @classmethod
+    @timed('db')
+    def lookup_by_names(cls, names):
+        """Return a dict mapping each of the given names for which a record
+        exists to a read-only row holding its lookup columns.
+
+        The names which are not found in the name lookup cache of the model are
+        read from the database with a single query, and cached.
+        """
+        records = {}
+        for name in names:
+            record = cls.name_cache.get(name)
+            if record is not None:
+                records[name] = record
+
+        missing = [name for name in names if name not in records]
+        if missing:
+            for record in cls._lookup_query().filter(cls.name.in_(missing)):
+                cls.name_cache.set(record.name, record)
+                records[record.name] = record
+
+        return records
+
+
+class UserModel(NameLookupMixin, db.Model):
     """Model class defined for the User table."""
 
     # Name of the table created in the database
     __tablename__ = 'users'
 
+    name_cache = user_name_cache
+    lookup_columns = ('_id', 'name', 'email', 'session_epoch')
+
     _id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), unique=True, nullable=False)
-    password = db.Column(db.String(64), nullable=False)
+    # Hash of the password, see credentials.py. It is never cached nor
+    # returned by the resources.
+    password = db.Column(db.String(256), nullable=False)
     email = db.Column(db.String(256), nullable=True)
+    # Incremented when the user logs out, which revokes the session tokens
+    # issued to the user so far, see sessions.py.
+    session_epoch = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     is_admin = db.relationship('RoomModel', backref='user', lazy=True)
     sends = db.relationship('MessageModel', backref='user', lazy=True)
 
     def __repr__(self):
         """Object representation for a record of User."""
-        return f'User(name={self.name}, email={self.email}, password={self.password})'
+        return f'User(name={self.name}, email={self.email})'
 
 
-class RoomModel(db.Model):
+class RoomModel(NameLookupMixin, db.Model):
     """Model class defined for the Room table."""
 
     # Name of the table created in the database
     __tablename__ = 'rooms'
 
+    name_cache = room_name_cache
+    lookup_columns = ('_id', 'name', 'admin_id')
+
     _id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), unique=True, nullable=False)
     admin_id = db.Column(db.Integer, 
         db.ForeignKey('users._id', onupdate='CASCADE', ondelete='CASCADE'),
         nullable=False
     )
+    # Number of members of the room, which is kept up to date along with the
+    # memberships table, so it never has to be counted.
+    member_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Retention policy of the room: the number of days its messages are kept
+    # for, and the number of its most recent messages that are kept, which
+    # default to RETENTION_DAYS and RETENTION_MESSAGES when null (0 keeping
+    # them forever), see retention.py.
+    retention_days = db.Column(db.Integer, nullable=True)
+    retention_messages = db.Column(db.Integer, nullable=True)
     messages = db.relationship('MessageModel', backref='room', lazy=True)
 
     def __repr__(self):
@@ -80,27 +371,293 @@ class MessageModel(db.Model):
         db.ForeignKey('rooms._id', onupdate='CASCADE', ondelete='CASCADE'),
         nullable=False
     )
+    # Time (in UTC) at which the message was created, read by the retention
+    # policies of the rooms. Null for the messages created before it was added.
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+
+    # Composite indexes used to serve the history of a room, and the messages
+    # of a sender, in the order in which they were sent without scanning the
+    # messages of other rooms or senders. Created by the migrations in migrations.py.
+    __table_args__ = (
+        db.Index('ix_messages_room_id__id', 'room_id', '_id'),
+        db.Index('ix_messages_sender_id__id', 'sender_id', '_id'),
+    )
 
     def __repr__(self):
         """Object representation for a record of a Message."""
         return f'Message(body={self.body}, sender={self.user.name}, room={self.room.name}'
+
+
+class MembershipModel(db.Model):
+    """Model class defined for the Membership table, which holds the users
+    who are members of each room."""
+
+    # Name of the table created in the database
+    __tablename__ = 'memberships'
+
+    room_id = db.Column(db.Integer,
+        db.ForeignKey('rooms._id', onupdate='CASCADE', ondelete='CASCADE'),
+        primary_key=True
+    )
+    user_id = db.Column(db.Integer,
+        db.ForeignKey('users._id', onupdate='CASCADE', ondelete='CASCADE'),
+        primary_key=True
+    )
+
+    # The primary key serves the members of a room in the order of their ids,
+    # and this index serves the rooms of a user in the order of their ids.
+    __table_args__ = (
+        db.Index('ix_memberships_user_id_room_id', 'user_id', 'room_id'),
+    )
+
+    def __repr__(self):
+        """Object representation for a record of a Membership."""
+        return f'Membership(room_id={self.room_id}, user_id={self.user_id})'
+
+
+class ChangeModel(db.Model):
+    """Model class defined for the Change table, which logs the creation of
+    the users and rooms and the changes of the memberships, in the order in
+    which they were written, so that clients can sync what changed since
+    their previous sync without reading the whole tables."""
+
+    # Name of the table created in the database
+    __tablename__ = 'changes'
+
+    # Kinds of the changes. The admin of a created room is its user_id, and
+    # the first member of the room.
+    USER_CREATED = 1
+    ROOM_CREATED = 2
+    MEMBER_JOINED = 3
+    MEMBER_LEFT = 4
+
+    _id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.SmallInteger, nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    room_id = db.Column(db.Integer, nullable=True)
+    # Time at which the change was logged, NULL for the changes logged before
+    # the column was added.
+    created_at = db.Column(db.DateTime, nullable=True, default=datetime.utcnow)
+
+    # Ids are never reused, even on SQLite. Concurrent transactions may still
+    # commit their changes out of the order of their ids (e.g. on MySQL), so a
+    # sync only moves past the changes logged more than SYNC_SAFETY_LAG seconds
+    # ago, see settled_id().
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    def __repr__(self):
+        """Object representation for a record of a Change."""
+        return f'Change(kind={self.kind}, user_id={self.user_id}, room_id={self.room_id})'
+
+
+class IdBlockModel(db.Model):
+    """Model class defined for the table of the next ids to be handed out by
+    the id allocators, by name of table."""
+
+    # Name of the table created in the database
+    __tablename__ = 'id_blocks'
+
+    name = db.Column(db.String(64), primary_key=True)
+    next_id = db.Column(db.BigInteger, nullable=False)
+
+    def __repr__(self):
+        """Object representation for a record of an IdBlock."""
+        return f'IdBlock(name={self.name}, next_id={self.next_id})'
+
+
+class RateLimitModel(db.Model):
+    """Model class defined for the table of the token buckets of the rate
+    limiter, when they are stored in the database, by key."""
+
+    # Name of the table created in the database
+    __tablename__ = 'rate_limits'
+
+    key = db.Column(db.String(191), primary_key=True)
+    tokens = db.Column(db.Float(precision=53), nullable=False)
+    # Seconds since the epoch, compared exactly while updating a bucket.
+    updated_at = db.Column(db.Float(precision=53), nullable=False)
+
+    def __repr__(self):
+        """Object representation for a record of a RateLimit."""
+        return f'RateLimit(key={self.key}, tokens={self.tokens})'
+
+
+class ArchiveSegmentModel(db.Model):
+    """Model class defined for the table of the segments of the archive of the
+    messages, which hold the messages expired by the retention policies of
+    the rooms, see archive.py."""
+
+    # Name of the table created in the database
+    __tablename__ = 'archive_segments'
+
+    _id = db.Column(db.Integer, primary_key=True)
+    room_id = db.Column(db.Integer,
+        db.ForeignKey('rooms._id', onupdate='CASCADE', ondelete='CASCADE'),
+        nullable=False
+    )
+    # Ids of the first and the last message of the segment, which holds all
+    # the messages of the room between them.
+    first_id = db.Column(db.BigInteger, nullable=False)
+    last_id = db.Column(db.BigInteger, nullable=False)
+    message_count = db.Column(db.Integer, nullable=False)
+    # Path of the file of the segment, relative to ARCHIVE_DIR.
+    path = db.Column(db.String(512), nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+    # A batch of messages is only archived once, even by concurrent runs of
+    # the retention job, and the segments of a room are read in order.
+    __table_args__ = (
+        db.Index('ix_archive_segments_room_id_first_id', 'room_id', 'first_id', unique=True),
+    )
+
+    def __repr__(self):
+        """Object representation for a record of an ArchiveSegment."""
+        return f'ArchiveSegment(room_id={self.room_id}, first_id={self.first_id}, last_id={self.last_id})'
 # ---------------------
 
 
+# Write-behind Queue of Messages
+# ------------------------------
+if MESSAGE_WRITE_BEHIND not in ('', 'enqueue', 'flush'):
+    raise ValueError(f'Unknown MESSAGE_WRITE_BEHIND ack mode: {MESSAGE_WRITE_BEHIND}')
+
+
+def publish_flushed_messages(entries):
+    """Publish the messages of a batch committed by the write-behind queue
+    to the subscribers of their rooms."""
+    for row, payload in entries:
+        broadcaster.publish(row['room_id'], row['_id'], payload)
+
+
+# Hands out the ids of the messages that are written behind, or inserted
+# while the write-behind queue is enabled, in the order of their commits.
+message_id_allocator = IdAllocator(db, IdBlockModel.__table__, MessageModel._id)
+
+# Queue of the messages waiting to be inserted, or None if messages are
+# inserted by the requests creating them.
+message_writer = WriteBehindQueue(app, db, MessageModel.__table__, message_id_allocator,
+    on_flushed=publish_flushed_messages, max_size=WRITE_BEHIND_QUEUE_SIZE,
+    flush_interval=WRITE_BEHIND_FLUSH_INTERVAL_MS / 1000, flush_batch=WRITE_BEHIND_FLUSH_BATCH
+) if MESSAGE_WRITE_BEHIND else None
+# ------------------------------
+
+
+# Sharded Storage of Messages
+# ---------------------------
+if MESSAGE_SHARD_URIS and MESSAGE_WRITE_BEHIND:
+    raise ValueError('The write-behind queue of messages cannot be enabled along with the shards of the messages.')
+
+# Shards holding the messages of the rooms, or None if the messages are
+# stored on the primary.
+message_shards = MessageShards(app, MESSAGE_SHARD_URIS, MessageModel.__table__) if MESSAGE_SHARD_URIS else None
+if message_shards is not None:
+    for shard_session in message_shards.sessions:
+        instrumentation.time_commits(shard_session)
+
+
+def message_session(room_id):
+    """Return the session reading and writing the messages of the room with
+    the given id: the session of its shard, or else the session of the primary."""
+    return db.session if message_shards is None else message_shards.session(room_id)
+# ---------------------------
+
+
+# Full-text Search of Messages
+# ----------------------------
+# Inverted indexes of the bodies of the messages of every database holding
+# messages. The full-text indexes of the databases are created and dropped
+# along with their messages table.
+message_search_index = MessageSearchIndex(MessageModel.__table__, backend=SEARCH_BACKEND)
+maintain_fulltext_index(MessageModel.__table__)
+if message_shards is not None:
+    maintain_fulltext_index(message_shards.shard_table)
+# ----------------------------
+
+
+# Archive and Retention of Messages
+# ---------------------------------
+# Segments of the messages expired by the retention policies of the rooms,
+# see archive.py.
+message_archive = MessageArchive(ARCHIVE_DIR, ArchiveSegmentModel.__table__, cache_size=ARCHIVE_CACHE_SIZE)
+
+# Id of the last archived message of each room, by id of the room and of its
+# oldest message still in the messages table, so the pages reaching the
+# oldest messages of a room don't look up its archive every time. Archiving
+# messages of a room deletes its oldest messages, so the entries are never stale.
+archived_id_cache = LRUCache(maxsize=NAME_CACHE_SIZE, ttl=NAME_CACHE_TTL)
+
+
+def message_engine(room_id):
+    """Return the engine of the database holding the messages of the room
+    with the given id: the engine of its shard, or else the primary."""
+    return db.engine if message_shards is None else message_shards.engines[message_shards.shard_index(room_id)]
+
+
+# Archives the expired messages of the rooms, every RETENTION_INTERVAL
+# seconds once the first request is served, see retention.py.
+retention_job = RetentionJob(app, db, message_archive, RoomModel.__table__, MessageModel.__table__,
+    UserModel.__table__, message_engine, default_days=RETENTION_DAYS, default_messages=RETENTION_MESSAGES,
+    batch_size=RETENTION_BATCH_SIZE, interval=RETENTION_INTERVAL
+)
+app.before_first_request(retention_job.start)
+
+
+def archived_through(room_id, oldest_id):
+    """Return the id of the last archived message of the room with the
+    given id (0 if none of its messages is archived), given the id of its
+    oldest message still in the messages table (None if there is none)."""
+    key = (room_id, oldest_id)
+    last_id = archived_id_cache.get(key)
+    if last_id is None:
+        last_id = message_archive.last_archived_id(db.session, room_id)
+        archived_id_cache.set(key, last_id)
+
+    return last_id
+# ---------------------------------
+
+
+# Read Replicas
+# -------------
+def replication_watermark(connection):
+    """Return the largest id of the users, rooms, messages and changes, which
+    only grow as records are created (or as memberships change), read with
+    the given connection."""
+    return connection.execute(select([
+        select([func.coalesce(func.max(model._id), 0)]).as_scalar()
+        for model in (UserModel, RoomModel, MessageModel, ChangeModel)
+    ])).first()
+
+
+# Routes the GET requests to the replicas which are not lagging behind, except
+# the ones of the endpoints that must see the latest writes.
+replica_router = ReplicaRouter(app, db, DB_REPLICA_URIS, watermark=replication_watermark,
+    max_lag=REPLICA_MAX_LAG, check_interval=REPLICA_LAG_CHECK_INTERVAL,
+    primary_endpoints=('poll_new_msgs_of_a_room', 'get_pool_stats', 'get_replica_stats', 'get_write_behind_stats',
+        'get_cache_stats', 'get_rate_limit_stats', 'get_metrics')
+)
+# -------------
+
+
 # Request Parsers
 # ---------------
 # Add the request parser to verify that the user has passed in the
 # necessary fields in the JSON object to successfully create a new user.
-user_post_reqparser = reqparse.RequestParser()
+user_post_reqparser = CompiledRequestParser()
 user_post_reqparser.add_argument('name', type=str, help='Username is a mandatory field.', required=True)
 user_post_reqparser.add_argument('password', type=str,
     help='Password is a mandatory field. Cannot be empty', required=True
 )
 user_post_reqparser.add_argument('email', type=str, help='Email is an optional field.')
 
+# Add the request parser to verify that the user has passed in their name
+# and password in the JSON object to log in.
+user_login_reqparser = CompiledRequestParser()
+user_login_reqparser.add_argument('name', type=str, help='Username is a mandatory field.', required=True)
+user_login_reqparser.add_argument('password', type=str, help='Password is a mandatory field.', required=True)
+
 # Add the request parser to verify that the user has passed in the
 # necessary fields in the JSON object to successfully create a new room.
-room_post_reqparser = reqparse.RequestParser()
+room_post_reqparser = CompiledRequestParser()
 room_post_reqparser.add_argument('name', type=str, 
     help='Required. Name of the Room.', required=True
 )
@@ -110,7 +667,7 @@ room_post_reqparser.add_argument('room_admin_name', type=str,
 
 # Add the request parser to verify that the user has passed in the
 # necessary fields in the JSON object to successfully create a new message.
-message_post_reqparser = reqparse.RequestParser()
+message_post_reqparser = CompiledRequestParser()
 message_post_reqparser.add_argument('body', type=str, 
     help='Required. Body of the message. Cannot be empty.', required=True
 )
@@ -120,6 +677,96 @@ message_post_reqparser.add_argument('sender_name', type=str,
 message_post_reqparser.add_argument('room_name', type=str, 
     help='Required. Name of the room.', required=True
 )
+
+# Add the request parser to verify that the user has passed in a list
+# of messages in the JSON object to create them all at once.
+message_bulk_post_reqparser = CompiledRequestParser()
+message_bulk_post_reqparser.add_argument('messages', type=list, location='json', required=True,
+    help='Required. List of messages, each with a body, a sender_name and a room_name.'
+)
+
+# Add the request parser to read the optional cursor parameters passed in the
+# query string while fetching a page of messages of a room.
+message_get_reqparser = CompiledRequestParser()
+message_get_reqparser.add_argument('after_id', type=int, location='args',
+    help='Optional. Only return messages sent after the message with this id.'
+)
+message_get_reqparser.add_argument('before_id', type=int, location='args',
+    help='Optional. Only return messages sent before the message with this id.'
+)
+message_get_reqparser.add_argument('limit', type=int, location='args',
+    help='Optional. Maximum number of messages returned in a single page.'
+)
+
+# Add the request parser to read the parameters passed in the query string
+# while waiting for the new messages of a room.
+message_poll_reqparser = CompiledRequestParser()
+message_poll_reqparser.add_argument('since_id', type=int, location='args', required=True,
+    help='Required. Only return messages sent after the message with this id.'
+)
+message_poll_reqparser.add_argument('timeout', type=float, location='args',
+    help='Optional. Maximum number of seconds to wait for a new message.'
+)
+
+# Add the request parser to verify that the user has passed in the name of
+# the user joining a room in the JSON object.
+membership_post_reqparser = CompiledRequestParser()
+membership_post_reqparser.add_argument('user_name', type=str,
+    help='Required. Name of the user joining the room.', required=True
+)
+
+# Add the request parser to read the retention policy of a room passed in
+# the JSON object, whose fields default to the policy of the deployment.
+retention_put_reqparser = CompiledRequestParser()
+retention_put_reqparser.add_argument('days', type=int,
+    help='Optional. Number of days the messages of the room are kept for, 0 keeping them forever.'
+)
+retention_put_reqparser.add_argument('messages', type=int,
+    help='Optional. Number of the most recent messages of the room that are kept, 0 keeping all of them.'
+)
+
+# Add the request parser to read the optional cursor parameters passed in the
+# query string while fetching a page of the members of a room, or of the
+# rooms of a user.
+membership_get_reqparser = CompiledRequestParser()
+membership_get_reqparser.add_argument('after_id', type=int, location='args',
+    help='Optional. Only return the records whose id is greater than this id.'
+)
+membership_get_reqparser.add_argument('limit', type=int, location='args',
+    help='Optional. Maximum number of records returned in a single page.'
+)
+
+# Add the request parser to read the parameters passed in the query string
+# while searching the messages.
+message_search_reqparser = CompiledRequestParser()
+message_search_reqparser.add_argument('q', type=str, location='args', required=True,
+    help='Required. Words that the body of the messages must contain.'
+)
+message_search_reqparser.add_argument('room_name', type=str, location='args',
+    help='Optional. Only search the messages of the room with this name.'
+)
+message_search_reqparser.add_argument('limit', type=int, location='args',
+    help='Optional. Maximum number of messages returned in a single page.'
+)
+message_search_reqparser.add_argument('offset', type=int, location='args',
+    help='Optional. Number of the most relevant messages to skip.'
+)
+
+# Add the request parser to read the parameters passed in the query string
+# while syncing the changes since a previous sync.
+sync_get_reqparser = CompiledRequestParser()
+sync_get_reqparser.add_argument('since', type=str, location='args',
+    help='Optional. Sync token returned by the previous sync.'
+)
+sync_get_reqparser.add_argument('user_name', type=str, location='args',
+    help='Optional. Sync the messages of the rooms which the user with this name is a member of.'
+)
+sync_get_reqparser.add_argument('rooms', type=str, location='args',
+    help='Optional. Comma-separated names of other rooms whose messages are synced.'
+)
+sync_get_reqparser.add_argument('limit', type=int, location='args',
+    help='Optional. Maximum number of changes, and of messages of each database, returned by the sync.'
+)
 # ---------------
 
 # Field Resources
@@ -129,7 +776,6 @@ message_post_reqparser.add_argument('room_name', type=str,
 user_fields = {
     '_id': fields.Integer,
     'name': fields.String,
-    'password': fields.String,
     'email': fields.String
 }
 
@@ -141,6 +787,13 @@ room_fields = {
     'admin_id': fields.Integer
 }
 
+# Specify the format that will be used to convert a MembershipModel object
+# into JSON compatible types.
+membership_fields = {
+    'room_id': fields.Integer,
+    'user_id': fields.Integer
+}
+
 # Specify the format that will be used to convert a MessageModel object
 # into JSON compatible types.
 message_fields = {
@@ -149,9 +802,793 @@ message_fields = {
     'sender_id': fields.Integer,
     'room_id': fields.Integer
 }
+
+# Fields of each user, room and message listed by the resources (besides its
+# id), which the client can select with the 'fields' parameter of the query string.
+user_list_fields = ('name', 'email')
+room_list_fields = ('name', 'room_admin_name')
+message_page_fields = ('body', 'sender_name', 'room_name')
 # ---------------
 
 
+# Query Instrumentation
+# ---------------------
+# Per-thread list of the active query counters, so that the queries issued
+# while serving a request are only counted by the counters opened by it.
+_query_counters = threading.local()
+
+
+class QueryCounter:
+    """Holds the number of SQL statements executed, and the statements
+    themselves, while a count_queries() block was active."""
+
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __repr__(self):
+        return f'QueryCounter(count={self.count})'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    """Engine event hook recording every executed statement into each of the
+    counters that are active on the current thread."""
+    for counter in getattr(_query_counters, 'active', ()):
+        counter.count += 1
+        counter.statements.append(statement)
+
+
+@contextmanager
+def count_queries():
+    """Context manager counting the SQL statements executed on the current
+    thread within its block. Used to assert that an endpoint issues a constant
+    number of queries, no matter how many rows it returns:
+
+        with count_queries() as counter:
+            app.test_client().get('/rooms/all')
+        assert counter.count == 1
+    """
+    counter = QueryCounter()
+    if not hasattr(_query_counters, 'active'):
+        _query_counters.active = []
+    _query_counters.active.append(counter)
+    try:
+        yield counter
+    finally:
+        _query_counters.active.remove(counter)
+# ---------------------
+
+
+# Authentication
+# --------------
+# Endpoints served without a session token even when the tokens are required,
+# i.e. the ones creating and logging in the users, and the statistics.
+PUBLIC_ENDPOINTS = frozenset((
+    'create_new_user', 'login_user', 'get_cache_stats', 'get_pool_stats', 'get_replica_stats',
+    'get_write_behind_stats', 'get_rate_limit_stats', 'get_metrics'
+))
+
+
+def authenticate(token):
+    """Return the lookup row of the user of the given session token, or None
+    if the token is invalid, has expired or was revoked.
+
+    The signature of the token is checked without reading the database, and
+    its user is served from the name lookup cache of the users.
+    """
+    session = session_tokens.load(token)
+    if session is None:
+        return None
+
+    user = UserModel.lookup_by_name(session.name)
+    if user is None or user._id != session.user_id or user.session_epoch != session.epoch:
+        return None
+
+    return user
+
+
+@app.before_request
+def authenticate_request():
+    """Set g.user to the user of the session token passed in the
+    Authorization header of the request (as 'Bearer <token>'), or to None if
+    the request has no token.
+
+    Abort with a 401 error if the token is invalid, or if the request has no
+    token while the tokens are required and the endpoint isn't public.
+    """
+    g.user = None
+    header = request.headers.get('Authorization')
+    if header is None:
+        if AUTH_REQUIRED and request.endpoint is not None and request.endpoint not in PUBLIC_ENDPOINTS:
+            abort(401, error_code=401, error_msg='A session token is required, log in to get one.')
+        return
+
+    scheme, _, token = header.partition(' ')
+    g.user = authenticate(token.strip()) if scheme.lower() == 'bearer' else None
+    if g.user is None:
+        abort(401, error_code=401, error_msg='The given session token is invalid or has expired.')
+
+
+def check_acting_user(name, error_msg):
+    """Abort with a 403 error and the given message if the request has a
+    session token of a user other than the one with the given name."""
+    if g.user is not None and g.user.name != name:
+        abort(403, error_code=403, error_msg=error_msg)
+# --------------
+
+
+# Rate Limiting
+# -------------
+if RATE_LIMIT_BACKEND not in ('memory', 'database'):
+    raise ValueError(f'Unknown RATE_LIMIT_BACKEND: {RATE_LIMIT_BACKEND}')
+
+# Limits the requests of every client (a logged in user, or else an address),
+# and the messages of every sender and of every room.
+rate_limiter = RateLimiter(
+    MemoryBackend(max_keys=RATE_LIMIT_MAX_KEYS) if RATE_LIMIT_BACKEND == 'memory'
+        else DatabaseBackend(db, RateLimitModel.__table__),
+    {
+        'client': Limit(RATE_LIMIT_CLIENT_RATE, RATE_LIMIT_CLIENT_BURST),
+        'sender': Limit(RATE_LIMIT_SENDER_RATE, RATE_LIMIT_SENDER_BURST),
+        'room': Limit(RATE_LIMIT_ROOM_RATE, RATE_LIMIT_ROOM_BURST)
+    },
+    enabled=RATE_LIMIT
+)
+
+# Tokens taken from the bucket of the client by the requests of the endpoints
+# which cost more than one, i.e. the ones reading whole tables, searching,
+# syncing, inserting many messages or hashing a password.
+RATE_LIMIT_COSTS = {
+    'get_all_users': 10, 'get_all_rooms': 10, 'search_msgs': 5, 'sync_changes': 5,
+    'create_new_msgs_in_bulk': 10, 'create_new_user': 10, 'login_user': 10
+}
+
+# Endpoints whose requests aren't limited, i.e. the statistics.
+RATE_LIMIT_EXEMPT_ENDPOINTS = frozenset((
+    'get_cache_stats', 'get_pool_stats', 'get_replica_stats', 'get_write_behind_stats', 'get_rate_limit_stats',
+    'get_metrics'
+))
+
+# Error messages of the requests limited in each scope.
+RATE_LIMIT_ERRORS = {
+    'client': 'Too many requests, please retry later.',
+    'sender': 'Too many messages sent by the given sender, please retry later.',
+    'room': 'Too many messages sent to the given room, please retry later.'
+}
+
+
+def check_rate_limit(scope, key, cost=1):
+    """Take cost tokens from the bucket of the given key of a scope, and
+    abort with a 429 error and a Retry-After header if it doesn't hold
+    enough of them."""
+    retry_after = rate_limiter.hit(scope, key, cost)
+    if retry_after:
+        error = TooManyRequests(retry_after=max(1, math.ceil(retry_after)))
+        error.data = {'error_code': 429, 'error_msg': RATE_LIMIT_ERRORS[scope]}
+        raise error
+
+
+@app.before_request
+def limit_client_rate():
+    """Take the cost of the request from the bucket of its client, which is
+    the user of its session token if it has one, else its address."""
+    if not rate_limiter.enabled:
+        return
+
+    # Read once, as every read of the request context goes through a proxy.
+    endpoint, user = request.endpoint, g.user
+    if endpoint is None or endpoint in RATE_LIMIT_EXEMPT_ENDPOINTS:
+        return
+
+    client = f'user:{user._id}' if user is not None else f'address:{request.remote_addr}'
+    check_rate_limit('client', client, RATE_LIMIT_COSTS.get(endpoint, 1))
+# -------------
+
+
+# Conditional Requests
+# --------------------
+def make_etag(*parts):
+    """Return a strong entity tag derived from the given parts, which must
+    together identify the exact content of a response."""
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def not_modified(etag):
+    """Return a 304 response if the client already holds the version of the
+    response identified by the given entity tag, i.e. if it was passed in the
+    If-None-Match header of the request. Otherwise, return None."""
+    if request.if_none_match.contains_weak(etag):
+        return Response(status=304, headers={'ETag': quote_etag(etag)})
+
+    return None
+
+
+@timed('db')
+def table_version(model):
+    """Return the largest id of the table of the given model. The users and
+    rooms are never deleted, and the columns listed by their endpoints (their
+    names, emails and admins) are never updated, so the largest id changes
+    whenever the listing does.
+
+    It is read from the end of the primary key, so the query costs the same
+    no matter how many records the table holds.
+    """
+    return db.session.query(func.max(model._id)).scalar()
+
+
+@timed('db')
+def room_history_version(room_id):
+    """Return the smallest and the largest id of the messages of the room
+    with the given id. Messages are never updated, so every page of the
+    history of the room stays the same as long as the two don't change.
+
+    Both are read from the ends of the (room_id, _id) index, so the query
+    costs the same no matter how many messages the room holds.
+    """
+    return message_session(room_id).query(func.min(MessageModel._id), func.max(MessageModel._id)) \
+        .filter(MessageModel.room_id == room_id) \
+        .one()
+# --------------------
+
+
+# Query Helpers
+# -------------
+def user_rows_query():
+    """Return an unordered query of the _id, name and email of all the users."""
+    return db.session.query(UserModel._id, UserModel.name, UserModel.email)
+
+
+def room_rows_query():
+    """Return an unordered query of the _id, name and room_admin_name of all
+    the rooms, reading the name of the admin by joining the users table."""
+    return db.session.query(RoomModel._id, RoomModel.name, UserModel.name.label('room_admin_name')) \
+        .join(UserModel, UserModel._id == RoomModel.admin_id)
+
+
+def member_rows_query(room_id):
+    """Return an unordered query of the _id and name of the members of the
+    room with the given id, along with the member count of the room in every
+    row, read in the same query with a lookup of the room by its primary key.
+    The members are read from the primary key of the memberships table."""
+    member_count = select([RoomModel.member_count]).where(RoomModel._id == room_id).as_scalar()
+    return db.session.query(UserModel._id, UserModel.name, member_count.label('member_count')) \
+        .join(MembershipModel, MembershipModel.user_id == UserModel._id) \
+        .filter(MembershipModel.room_id == room_id)
+
+
+def user_room_rows_query(user_id):
+    """Return an unordered query of the _id, name, admin_id and member_count
+    of the rooms of the user with the given id, read from the
+    (user_id, room_id) index of the memberships table."""
+    return db.session.query(RoomModel._id, RoomModel.name, RoomModel.admin_id, RoomModel.member_count) \
+        .join(MembershipModel, MembershipModel.room_id == RoomModel._id) \
+        .filter(MembershipModel.user_id == user_id)
+
+
+def message_rows_query(room_id, after_id=None, before_id=None):
+    """Return an unordered query of the _id, body and sender_name of the
+    messages of the room with the given id, optionally restricted to the
+    messages sent after after_id and/or before before_id.
+
+    Only the columns that are serialized are selected, and the name of the
+    sender is read in the same query by joining the users table. When the
+    messages are sharded, the users table can't be joined, and the query
+    selects the sender_id instead, to be passed to with_sender_names().
+    """
+    if message_shards is None:
+        query = db.session.query(MessageModel._id, MessageModel.body, UserModel.name.label('sender_name')) \
+            .join(UserModel, UserModel._id == MessageModel.sender_id)
+    else:
+        query = message_shards.session(room_id).query(MessageModel._id, MessageModel.body, MessageModel.sender_id)
+    query = query.filter(MessageModel.room_id == room_id)
+    if after_id is not None:
+        query = query.filter(MessageModel._id > after_id)
+    if before_id is not None:
+        query = query.filter(MessageModel._id < before_id)
+
+    return query
+
+
+class MessageRow:
+    """Row of a page of messages, with the same attributes as the rows of a
+    message_rows_query() of the primary, so that they are serialized the same way."""
+
+    __slots__ = ('_id', 'body', 'sender_name')
+
+    def __init__(self, _id, body, sender_name):
+        self._id = _id
+        self.body = body
+        self.sender_name = sender_name
+
+
+def with_sender_names(rows, batch_size=STREAM_BATCH_SIZE):
+    """Yield the rows of messages read from a shard by a message_rows_query(),
+    which hold the id of their sender, as MessageRows holding the name of their
+    sender instead. The names are read with one query per batch of batch_size
+    rows, and the messages whose sender doesn't exist are skipped, like the
+    join of the unsharded query does."""
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+
+        sender_names = dict(db.session.query(UserModel._id, UserModel.name)
+            .filter(UserModel._id.in_({row.sender_id for row in batch}))
+        )
+        for row in batch:
+            if row.sender_id in sender_names:
+                yield MessageRow(row._id, row.body, sender_names[row.sender_id])
+
+
+def iterate_by_id(query, id_column, batch_size=STREAM_BATCH_SIZE):
+    """Yield the rows of the given query in ascending order of id_column.
+
+    Rows are read in batches of batch_size rows, each with its own query
+    resuming after the last id of the previous batch, so the memory used
+    stays the same no matter how many rows are yielded. This is used instead
+    of Query.yield_per(), as the mysqlconnector dialect buffers the whole
+    result set of a query on the client.
+    """
+    last_id = None
+    while True:
+        batch_query = query if last_id is None else query.filter(id_column > last_id)
+        batch = batch_query.order_by(id_column.asc()).limit(batch_size).all()
+        yield from batch
+
+        if len(batch) < batch_size:
+            return
+        last_id = getattr(batch[-1], id_column.key)
+
+
+def wants_ndjson():
+    """Return True if the client prefers the response to be streamed as
+    newline delimited JSON (application/x-ndjson) rather than as JSON."""
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+
+def selected_fields(allowed, args=None):
+    """Return the tuple of the fields selected by the client among the allowed
+    ones, passed as a comma-separated list in the 'fields' parameter of the
+    query string, or None if the client wants all of them. The arguments of
+    the query string are the ones of the current request, unless given.
+
+    Abort with a 400 error if an unknown field is selected.
+    """
+    value = (request.args if args is None else args).get('fields')
+    if value is None:
+        return None
+
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = names.difference(allowed)
+    if unknown:
+        abort(400, error_code=400,
+            error_msg=f'Unknown fields: {", ".join(sorted(unknown))}. Select among: {", ".join(allowed)}.'
+        )
+
+    return tuple(name for name in allowed if name in names)
+
+
+def select_fields(item, fields):
+    """Return the given dict restricted to the given fields, or the dict
+    itself if fields is None."""
+    return item if fields is None else {name: item[name] for name in fields}
+
+
+def wants_compact(args=None):
+    """Return True if the client asked for the compact form of the pages of
+    messages, by passing compact=true in the query string. The arguments of
+    the query string are the ones of the current request, unless given."""
+    return (request.args if args is None else args).get('compact', '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def stream_ndjson(rows, serialize, error_msg):
+    """Return a response streaming the given iterable of rows as newline
+    delimited JSON, with one object per line, which is created by passing a row
+    to serialize. Rows are consumed while the response is being sent.
+
+    Abort with a 404 error and the given error message if there are no rows.
+    """
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        abort(404, error_code=404, error_msg=error_msg)
+
+    def generate():
+        yield json.dumps(serialize(first_row)) + '\n'
+        for row in rows:
+            yield json.dumps(serialize(row)) + '\n'
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@timed('db')
+def fetch_message_page(room_id, after_id=None, before_id=None, limit=MESSAGES_PAGE_DEFAULT_LIMIT):
+    """Return a page of at most limit messages of the room with the given id,
+    ordered by their ids, along with the cursor of the next page.
+
+    The page is read with a range scan over the (room_id, _id) index, one row
+    past the limit, so the amount of work done doesn't depend on the number
+    of messages stored for the room.
+
+    When after_id is given, the page holds the oldest messages sent after it
+    and the cursor is the after_id of the next page. Otherwise, the page holds
+    the newest messages sent before before_id (or the newest messages of the room)
+    and the cursor is the before_id of the previous page. The cursor is None if
+    there are no more messages to fetch.
+
+    Only the columns that are serialized are selected, and the name of the
+    sender is read in the same query by joining the users table, so fetching
+    a page always costs a single query (two when the messages are sharded).
+    """
+    query = message_rows_query(room_id, after_id=after_id, before_id=before_id)
+
+    if after_id is not None:
+        records = query.order_by(MessageModel._id.asc()).limit(limit + 1).all()
+        has_more = len(records) > limit
+        records = records[:limit]
+        next_cursor = records[-1]._id if has_more else None
+    else:
+        records = query.order_by(MessageModel._id.desc()).limit(limit + 1).all()
+        has_more = len(records) > limit
+        records = records[:limit][::-1]
+        next_cursor = records[0]._id if has_more else None
+
+    if message_shards is not None:
+        records = list(with_sender_names(records))
+
+    return records, next_cursor
+
+
+@timed('db')
+def fetch_history_page(room_id, oldest_id, after_id=None, before_id=None, limit=MESSAGES_PAGE_DEFAULT_LIMIT):
+    """Return a page of messages of the room with the given id along with the
+    cursor of the next page, like fetch_message_page(), reading the archived
+    messages of the room when the page reaches past oldest_id, the id of its
+    oldest message still in the messages table (None if there is none).
+
+    The archive is only read by the pages of the archived history and by the
+    oldest page of the messages still in the messages table, whose archived
+    messages fill the rest of the page, or else set its cursor. Archived
+    messages are never updated, so the pages keep the same ETag once their
+    messages are archived.
+    """
+    if after_id is not None and (oldest_id is None or after_id < oldest_id):
+        last_archived_id = archived_through(room_id, oldest_id)
+        if after_id < last_archived_id:
+            archived = list(message_archive.messages(db.session, room_id,
+                after_id=after_id, before_id=before_id, limit=limit + 1
+            ))
+            if len(archived) > limit:
+                return archived[:limit], archived[limit - 1]._id
+            if len(archived) == limit:
+                has_more = oldest_id is not None and (before_id is None or oldest_id < before_id)
+                return archived, archived[-1]._id if has_more else None
+
+            records, next_cursor = fetch_message_page(room_id,
+                after_id=last_archived_id, before_id=before_id, limit=limit - len(archived)
+            )
+            return archived + records, next_cursor
+
+    records, next_cursor = fetch_message_page(room_id, after_id=after_id, before_id=before_id, limit=limit)
+
+    if after_id is None and next_cursor is None and archived_through(room_id, oldest_id):
+        missing = limit - len(records)
+        archived = list(message_archive.messages(db.session, room_id,
+            before_id=records[0]._id if records else before_id, descending=True, limit=missing + 1
+        ))
+        records = archived[:missing][::-1] + records
+        next_cursor = records[0]._id if len(archived) > missing else None
+
+    return records, next_cursor
+
+
+def iterate_history(room_id, oldest_id, after_id=None, before_id=None):
+    """Yield all the messages of the room with the given id sent after
+    after_id and before before_id, oldest first, its archived messages
+    followed by its messages still in the messages table, whose oldest one
+    has the id oldest_id (None if there is none)."""
+    last_archived_id = archived_through(room_id, oldest_id)
+    if last_archived_id and (after_id is None or after_id < last_archived_id):
+        yield from message_archive.messages(db.session, room_id, after_id=after_id, before_id=before_id)
+        after_id = last_archived_id
+
+    rows = iterate_by_id(message_rows_query(room_id, after_id=after_id, before_id=before_id), MessageModel._id)
+    if message_shards is not None:
+        rows = with_sender_names(rows)
+    yield from rows
+
+
+@timed('db')
+def fetch_membership_page(query, id_column, after_id=None, limit=MEMBERS_PAGE_DEFAULT_LIMIT):
+    """Return a page of at most limit rows of the given query of members or
+    rooms, ordered by the given id column of the memberships table, after the
+    row whose _id is after_id, along with the after_id of the next page, which
+    is None if there are no more rows."""
+    if after_id is not None:
+        query = query.filter(id_column > after_id)
+
+    records = query.order_by(id_column.asc()).limit(limit + 1).all()
+    next_cursor = records[limit - 1]._id if len(records) > limit else None
+
+    return records[:limit], next_cursor
+
+
+@timed('serialize')
+def serialize_message_page(records, room_name):
+    """Convert a page of messages returned by fetch_message_page() into a
+    dict mapping the id of each message to its details."""
+    messages = {}
+    for record in records:
+        messages[record._id] = {
+            'body': record.body,
+            'sender_name': record.sender_name,
+            'room_name': room_name
+        }
+
+    return messages
+
+
+@timed('serialize')
+def slim_message_page(messages, fields=None, compact=False):
+    """Return the body of a response holding the given dict of messages,
+    returned by serialize_message_page() or published by the broadcaster,
+    restricted to the given fields.
+
+    In the compact form, the messages don't repeat the name of the room, and
+    the name of the sender of each message is replaced by its index in the
+    list of the senders of the page, returned as 'senders'.
+    """
+    if fields is not None:
+        messages = {message_id: select_fields(message, fields) for message_id, message in messages.items()}
+    if not compact:
+        return {'messages': messages}
+
+    senders, sender_indexes, compact_messages = [], {}, {}
+    for message_id, message in messages.items():
+        compact_message = {}
+        if 'body' in message:
+            compact_message['body'] = message['body']
+        if 'sender_name' in message:
+            sender_name = message['sender_name']
+            index = sender_indexes.get(sender_name)
+            if index is None:
+                index = sender_indexes[sender_name] = len(senders)
+                senders.append(sender_name)
+            compact_message['sender'] = index
+        compact_messages[message_id] = compact_message
+
+    return {'messages': compact_messages, 'senders': senders}
+
+
+@timed('db')
+def search_messages(terms, room_id=None, limit=SEARCH_PAGE_DEFAULT_LIMIT, offset=0):
+    """Return a page of at most limit messages whose body holds all the given
+    terms, optionally only in the room with the given id, from the most to the
+    least relevant after skipping the first offset ones, along with the offset
+    of the next page, which is None if there are no more messages.
+
+    Each message is returned as a dict holding its _id, body, sender_name,
+    room_name and relevance score. When the messages are sharded, a search of
+    all the rooms asks every shard for its most relevant messages, which are
+    merged by score.
+    """
+    sessions = [message_session(room_id)] if room_id is not None else message_sessions()
+
+    # One result past the page, to know whether there is a next page.
+    hits = []
+    for session in sessions:
+        if len(sessions) == 1:
+            results = message_search_index.search(session.connection(), terms, room_id, limit + 1, offset)
+        else:
+            results = message_search_index.search(session.connection(), terms, room_id, offset + limit + 1)
+        hits.extend((score, message_id, session) for message_id, score in results)
+    if len(sessions) > 1:
+        hits = sorted(hits, key=lambda hit: (-hit[0], -hit[1]))[offset:]
+
+    next_offset = offset + limit if len(hits) > limit else None
+    hits = hits[:limit]
+
+    rows = {}
+    for session in {session for _, _, session in hits}:
+        ids = [message_id for _, message_id, hit_session in hits if hit_session is session]
+        rows.update((row._id, row) for row in session.query(
+            MessageModel._id, MessageModel.body, MessageModel.sender_id, MessageModel.room_id
+        ).filter(MessageModel._id.in_(ids)))
+
+    sender_names = dict(db.session.query(UserModel._id, UserModel.name)
+        .filter(UserModel._id.in_({row.sender_id for row in rows.values()}))
+    ) if rows else {}
+    room_names = dict(db.session.query(RoomModel._id, RoomModel.name)
+        .filter(RoomModel._id.in_({row.room_id for row in rows.values()}))
+    ) if rows else {}
+
+    messages = []
+    for score, message_id, _ in hits:
+        row = rows.get(message_id)
+        if row is not None and row.sender_id in sender_names and row.room_id in room_names:
+            messages.append({
+                '_id': message_id,
+                'body': row.body,
+                'sender_name': sender_names[row.sender_id],
+                'room_name': room_names[row.room_id],
+                'score': round(score, 6)
+            })
+
+    return messages, next_offset
+
+
+def message_sessions():
+    """Return the sessions of the databases holding the messages: the
+    sessions of the shards, or the session of the primary."""
+    if message_shards is None:
+        return [db.session]
+
+    return [shard_session() for shard_session in message_shards.sessions]
+
+
+def format_sync_token(change_id, message_ids):
+    """Return the sync token made of the id of the last synced change and of
+    the id of the last synced message of every database holding messages."""
+    return '.'.join(str(value) for value in (change_id, *message_ids))
+
+
+def parse_sync_token(token):
+    """Return the id of the last synced change along with the list of the ids
+    of the last synced messages of every database holding messages, read from
+    the given sync token.
+
+    Abort with a 400 error if the token is malformed.
+    """
+    try:
+        values = [int(value) for value in token.split('.')]
+    except ValueError:
+        values = []
+    if not values or any(value < 0 for value in values):
+        abort(400, error_code=400, error_msg='The given sync token is invalid.')
+
+    # Databases added since the token was made haven't been synced yet.
+    database_count = 1 if message_shards is None else len(message_shards.sessions)
+    return values[0], (values[1:] + [0] * database_count)[:database_count]
+
+
+def settled_id(session, model, after_id):
+    """Return the largest id of the changes (or messages, depending on the
+    given model) read with the given session up to which a sync resuming after
+    after_id can move.
+
+    Ids are handed out as the rows are inserted, but concurrent transactions
+    may commit them out of order, e.g. with the auto-increment of InnoDB, so a
+    row with an id lower than the largest one visible may still be committed.
+    A sync therefore only moves past the rows inserted more than
+    SYNC_SAFETY_LAG seconds ago, and the ones inserted before them, and leaves
+    the more recent ones to the next syncs.
+
+    The rows are read from the end of the primary key, in batches, until one
+    inserted before the lag is found, so the cost of the query only depends on
+    the number of rows inserted during the lag.
+    """
+    if SYNC_SAFETY_LAG <= 0:
+        return max(after_id, session.query(func.coalesce(func.max(model._id), 0)).scalar())
+
+    cutoff = datetime.utcnow() - timedelta(seconds=SYNC_SAFETY_LAG)
+    before_id = None
+    while True:
+        query = session.query(model._id, model.created_at).filter(model._id > after_id)
+        if before_id is not None:
+            query = query.filter(model._id < before_id)
+        rows = query.order_by(model._id.desc()).limit(SYNC_SETTLED_BATCH_SIZE).all()
+
+        for row in rows:
+            if row.created_at is None or row.created_at <= cutoff:
+                return row._id
+        if len(rows) < SYNC_SETTLED_BATCH_SIZE:
+            return after_id
+        before_id = rows[-1]._id
+
+
+@timed('db')
+def current_sync_token():
+    """Return the sync token of the current state of the database, from which
+    the next syncs return the changes."""
+    change_id = settled_id(db.session, ChangeModel, 0)
+    message_ids = [settled_id(session, MessageModel, 0) for session in message_sessions()]
+
+    return format_sync_token(change_id, message_ids)
+
+
+@timed('db')
+def fetch_changes(after_id, limit=SYNC_DEFAULT_LIMIT):
+    """Return at most limit changes logged after the change with the given id,
+    in the order in which they were logged, along with the id of the last
+    returned change and whether there are more changes to fetch. The changes
+    are read with a range scan of the primary key of the changes table, so
+    the cost of the query only depends on the number of changes returned.
+
+    The changes logged during the last SYNC_SAFETY_LAG seconds are left to the
+    next syncs, see settled_id()."""
+    until_id = settled_id(db.session, ChangeModel, after_id)
+    if until_id <= after_id:
+        return [], after_id, False
+
+    changes = db.session.query(ChangeModel._id, ChangeModel.kind, ChangeModel.user_id, ChangeModel.room_id) \
+        .filter(ChangeModel._id > after_id, ChangeModel._id <= until_id) \
+        .order_by(ChangeModel._id.asc()) \
+        .limit(limit + 1) \
+        .all()
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+
+    return changes, changes[-1]._id if changes else after_id, has_more
+
+
+def sync_message_rows_query(session, room_ids, after_id, until_id):
+    """Return an unordered query of the _id, body, sender_id and room_id of
+    the messages of the rooms with the given ids, read with the given session,
+    whose id is greater than after_id and at most until_id. The messages of
+    every room are read with a range scan over the (room_id, _id) index."""
+    return session.query(MessageModel._id, MessageModel.body, MessageModel.sender_id, MessageModel.room_id) \
+        .filter(MessageModel.room_id.in_(room_ids), MessageModel._id > after_id, MessageModel._id <= until_id)
+
+
+@timed('db')
+def fetch_sync_messages(room_names, after_ids, limit=SYNC_DEFAULT_LIMIT):
+    """Return the messages of the rooms with the given names (by id) sent
+    since a sync, along with the ids of the last synced message of every
+    database holding messages and whether there are more messages to fetch.
+
+    after_ids are the ids of the last synced message of every database.
+    At most limit messages are returned from every database, oldest first.
+    The messages are returned as a dict mapping the id of each message to
+    its body, sender_name and room_name.
+    """
+    sessions = message_sessions()
+    room_ids_by_database = {}
+    for room_id in room_names:
+        index = 0 if message_shards is None else message_shards.shard_index(room_id)
+        room_ids_by_database.setdefault(index, []).append(room_id)
+
+    rows, next_ids, has_more = [], [], False
+    for index, (session, after_id) in enumerate(zip(sessions, after_ids)):
+        # Messages sent during the last SYNC_SAFETY_LAG seconds, or while the
+        # sync is being served, are left to the next sync, which resumes after
+        # the id read here.
+        until_id = settled_id(session, MessageModel, after_id)
+        next_id = until_id
+
+        if index in room_ids_by_database and until_id > after_id:
+            database_rows = sync_message_rows_query(session, room_ids_by_database[index], after_id, until_id) \
+                .order_by(MessageModel._id.asc()) \
+                .limit(limit + 1) \
+                .all()
+            if len(database_rows) > limit:
+                database_rows = database_rows[:limit]
+                next_id = database_rows[-1]._id
+                has_more = True
+            rows.extend(database_rows)
+
+        next_ids.append(next_id)
+
+    sender_names = dict(db.session.query(UserModel._id, UserModel.name)
+        .filter(UserModel._id.in_({row.sender_id for row in rows}))
+    ) if rows else {}
+
+    messages = {}
+    for row in rows:
+        # The messages whose sender doesn't exist are skipped, like the join
+        # of the pages of the history of a room does.
+        if row.sender_id in sender_names:
+            messages[row._id] = {
+                'body': row.body,
+                'sender_name': sender_names[row.sender_id],
+                'room_name': room_names[row.room_id]
+            }
+
+    return messages, next_ids, has_more
+# -------------
+
+
 # API Resources
 # -------------
 class UserEntity(Resource):
@@ -172,24 +1609,52 @@ class UserEntity(Resource):
         Return a JSON response back to the user containing details
         about all the users stored in the database.
         
+        If the client accepts 'application/x-ndjson', the users are streamed
+        as newline delimited JSON instead, with one object holding the _id, name
+        and email of a user per line, so that the memory used doesn't grow with
+        the number of users.
+
+        The fields of the users can be selected by passing a comma-separated
+        list of them (among name and email) as fields in the query string.
+
+        The response carries an ETag header. If it matches the If-None-Match
+        header of the request, a 304 response without a body is returned instead.
+
         Abort handling GET requests and return 404 if no users exist
-        in the database along with an error message.
+        in the database along with an error message. Also, return a 400 error
+        if an unknown field is selected.
         """
-        results = db.session.query(UserModel).all()
+        fields = selected_fields(user_list_fields)
+        ndjson = wants_ndjson()
+        etag = make_etag('users', ndjson, fields, table_version(UserModel))
+        response = not_modified(etag)
+        if response:
+            return response
+
+        query = user_rows_query()
+
+        if ndjson:
+            response = stream_ndjson(iterate_by_id(query, UserModel._id),
+                lambda record: {'_id': record._id,
+                    **select_fields({'name': record.name, 'email': record.email}, fields)},
+                'No user exists in the database'
+            )
+            response.set_etag(etag)
+            return response
+
+        with phase('db'):
+            results = query.all()
 
         if not results:
             abort(404, error_code=404, error_msg='No user exists in the database')
 
-        users = {}
-        for record in results:
-            users[record._id] = {
-                'name': record.name, 
-                'email': record.email
-            }
+        with phase('serialize'):
+            users = {}
+            for record in results:
+                users[record._id] = select_fields({'name': record.name, 'email': record.email}, fields)
 
-        return [users], 200
+        return [users], 200, {'ETag': quote_etag(etag)}
 
-    @marshal_with(user_fields)
     def post(self):
         """Handles POST requests at the specified endpoint and returns status
         code 201 representing that a new user has been inserted into the
@@ -202,10 +1667,13 @@ class UserEntity(Resource):
         
         Aborts the request if a member with the passed name already exists
         and thus, return a 409 error code with an error message.
+
+        The password is stored hashed (see credentials.py). Return a 503 error
+        with a Retry-After header if the workers hashing the passwords are busy.
         """
         new_user_args = user_post_reqparser.parse_args(strict=True)
 
-        name_record = db.session.query(UserModel).filter_by(name=new_user_args['name']).first()
+        name_record = UserModel.lookup_by_name(new_user_args['name'])
         if name_record:
             abort(409, error_code=409,
                 error_msg='Cannot create a new user because an user with the given name already exists.'
@@ -213,13 +1681,140 @@ class UserEntity(Resource):
         if not len(new_user_args['password']):
             abort(409, error_code=409, error_msg='Cannot create a new user because the password field cannot be empty.')
 
+        # Return the connection to the pool while the password is hashed.
+        db.session.close()
+        try:
+            password_hash = credential_pool.hash(new_user_args['password'])
+        except (CredentialPoolFull, FutureTimeoutError):
+            return credentials_busy_response()
+
         new_user = UserModel(name=new_user_args['name'], 
-            password=new_user_args['password'], email=new_user_args['email']
+            password=password_hash, email=new_user_args['email']
         )
-        db.session.add(new_user)
+        # The name may have been taken by a concurrent request while the
+        # password was hashed, in which case the unique index of the names
+        # rejects the user.
+        try:
+            db.session.add(new_user)
+            db.session.flush()
+            db.session.add(ChangeModel(kind=ChangeModel.USER_CREATED, user_id=new_user._id))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            abort(409, error_code=409,
+                error_msg='Cannot create a new user because an user with the given name already exists.'
+            )
+        user_name_cache.invalidate(new_user.name)
+
+        # Marshalled here rather than with marshal_with, which would also
+        # marshal the error returned when the workers are busy.
+        with phase('serialize'):
+            user = marshal(new_user, user_fields)
+
+        return user, 201
+
+
+def credentials_busy_response():
+    """Return a 503 error with a Retry-After header, for the requests whose
+    password couldn't be hashed or verified because the workers are busy.
+    Returned rather than aborted, as it isn't an error to be logged with its
+    traceback."""
+    return {
+        'error_code': 503,
+        'error_msg': 'Cannot check passwords right now, please retry later.'
+    }, 503, {'Retry-After': str(KDF_RETRY_AFTER)}
+
+
+class UserLogin(Resource):
+    """Resource class to handle requests made to log a user in at the
+    specified endpoint(s):
+        1. /users/login
+    
+    Handles the following request(s) along with a summary::
+        1. POST - Verify the name and password of a user.
+    """
+
+    def post(self):
+        """Handles POST requests at the endpoint, which checks the password
+        passed in the JSON object against the one of the user with the given
+        name, and returns status code 200 along with a JSON response
+        containing the details of the user if it matches, and the token of a
+        new session of the user, which is passed in the Authorization header
+        of the following requests as 'Bearer <token>', see sessions.py.
+
+        The password is checked by the workers hashing the passwords, off the
+        thread serving the request. If it was stored with another scheme or
+        cost than the configured ones, it is hashed again and updated.
+
+        Abort handling POST requests and return 401 if no user with the given
+        name exists or if the password doesn't match, with the same error
+        message and about the same duration in both cases. Also, return a 503
+        error with a Retry-After header if the workers are busy.
+        """
+        login_args = user_login_reqparser.parse_args(strict=True)
+
+        # Read from the database rather than from the name lookup cache, which
+        # doesn't hold the passwords.
+        with phase('db'):
+            record = db.session.query(UserModel._id, UserModel.name, UserModel.email, UserModel.password,
+                    UserModel.session_epoch) \
+                .filter(UserModel.name == login_args['name']) \
+                .first()
+        # Return the connection to the pool while the password is checked.
+        db.session.close()
+
+        try:
+            verified = credential_pool.verify(login_args['password'], record.password if record else None)
+            if verified and password_hasher.needs_rehash(record.password):
+                password_hash = credential_pool.hash(login_args['password'])
+                db.session.query(UserModel).filter(UserModel._id == record._id) \
+                    .update({UserModel.password: password_hash}, synchronize_session=False)
+                db.session.commit()
+        except (CredentialPoolFull, FutureTimeoutError):
+            return credentials_busy_response()
+
+        if not verified:
+            abort(401, error_code=401, error_msg='The given name or password is incorrect.')
+
+        with phase('serialize'):
+            user = marshal(record._asdict(), user_fields)
+            user['token'] = session_tokens.issue(record._id, record.name, record.session_epoch)
+            user['expires_in'] = SESSION_MAX_AGE
+
+        return user, 200
+
+
+class UserLogout(Resource):
+    """Resource class to handle requests made to log a user out at the
+    specified endpoint(s):
+        1. /users/logout
+    
+    Handles the following request(s) along with a summary::
+        1. POST - Revoke the session tokens of the user of the request.
+    """
+
+    def post(self):
+        """Handles POST requests at the endpoint, which revokes all the session
+        tokens issued so far to the user of the session token of the request,
+        and returns status code 200 along with a JSON response containing the
+        details of the user.
+
+        The tokens are revoked right away in this process, and within the ttl
+        of the name lookup cache of the users in the other processes.
+
+        Abort handling POST requests and return 401 if the request has no
+        session token.
+        """
+        if g.user is None:
+            abort(401, error_code=401, error_msg='A session token is required, log in to get one.')
+
+        db.session.query(UserModel).filter(UserModel._id == g.user._id) \
+            .update({UserModel.session_epoch: UserModel.session_epoch + 1}, synchronize_session=False)
         db.session.commit()
-        
-        return new_user, 201
+        user_name_cache.invalidate(g.user.name)
+
+        with phase('serialize'):
+            return marshal(g.user._asdict(), user_fields), 200
 
 
 class UserRecord(Resource):
@@ -231,7 +1826,6 @@ class UserRecord(Resource):
         1. GET - Get a user by their name.
     """
 
-    @marshal_with(user_fields)
     def get(self, name):
         """Handles GET requests at the specified endpoint and return
         HTTP code 200 on a successful completion of a request.
@@ -241,19 +1835,36 @@ class UserRecord(Resource):
         and "NaMe" are treated as two different values because their cases
         are different, even though they mean the same.
         
-        Return a JSON response containing details about the specified user.
+        Return a JSON response containing details about the specified user, whose
+        fields can be selected by passing a comma-separated list of them as
+        fields in the query string.
+
+        The response carries an ETag header. If it matches the If-None-Match
+        header of the request, a 304 response without a body is returned instead.
 
         Abort handling GET requests and return 404 if no user with
-        the specified name is found along with an error message.
+        the specified name is found along with an error message. Also,
+        return a 400 error if an unknown field is selected.
         """
-        record = db.session.query(UserModel).filter_by(name=name).first()
+        record = UserModel.lookup_by_name(name)
 
         if not record:
             abort(404, error_code=404, 
                 error_msg='No user with the given name exists in the database.'
             )
 
-        return record, 200
+        fields = selected_fields(tuple(user_fields))
+        etag = make_etag('user', fields, *record)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        # Marshalled here rather than with marshal_with, which would also
+        # marshal the 304 response.
+        with phase('serialize'):
+            user = select_fields(marshal(record._asdict(), user_fields), fields)
+
+        return user, 200, {'ETag': quote_etag(etag)}
 
 
 class RoomEntity(Resource):
@@ -274,22 +1885,51 @@ class RoomEntity(Resource):
         Return a JSON response back to the user containing details
         about all the rooms stored in the database.
         
+        If the client accepts 'application/x-ndjson', the rooms are streamed
+        as newline delimited JSON instead, with one object holding the _id, name
+        and room_admin_name of a room per line.
+
+        The fields of the rooms can be selected by passing a comma-separated
+        list of them (among name and room_admin_name) as fields in the query string.
+
+        The response carries an ETag header. If it matches the If-None-Match
+        header of the request, a 304 response without a body is returned instead.
+
         Abort handling GET requests and return 404 if no rooms exist
-        in the database along with an error message.
+        in the database along with an error message. Also, return a 400 error
+        if an unknown field is selected.
         """
-        results = db.session.query(RoomModel).all()
+        fields = selected_fields(room_list_fields)
+        ndjson = wants_ndjson()
+        etag = make_etag('rooms', ndjson, fields, table_version(RoomModel))
+        response = not_modified(etag)
+        if response:
+            return response
+
+        query = room_rows_query()
+
+        if ndjson:
+            response = stream_ndjson(iterate_by_id(query, RoomModel._id),
+                lambda record: {'_id': record._id,
+                    **select_fields({'name': record.name, 'room_admin_name': record.room_admin_name}, fields)},
+                'No room exists in the database'
+            )
+            response.set_etag(etag)
+            return response
+
+        with phase('db'):
+            results = query.all()
 
         if not results:
             abort(404, error_code=404, error_msg='No room exists in the database')
 
-        rooms = {}
-        for record in results:
-            rooms[record._id] = {
-                'name': record.name, 
-                'room_admin_name': record.user.name
-            }
+        with phase('serialize'):
+            rooms = {}
+            for record in results:
+                rooms[record._id] = select_fields({'name': record.name, 'room_admin_name': record.room_admin_name},
+                    fields)
 
-        return [rooms], 200
+        return [rooms], 200, {'ETag': quote_etag(etag)}
 
     @marshal_with(room_fields)
     def post(self):
@@ -304,24 +1944,37 @@ class RoomEntity(Resource):
         
         Aborts the request if a room with the passed name already exists
         and thus, return a 409 error code with an error message.
+
+        The admin of the new room becomes its first member. Abort with a 403
+        error if the request has the session token of another user than the
+        room admin.
         """
         new_room_args = room_post_reqparser.parse_args(strict=True)
+        check_acting_user(new_room_args['room_admin_name'],
+            'Cannot create a new room administered by another user than the logged in one.'
+        )
 
-        name_record = db.session.query(RoomModel).filter_by(name=new_room_args['name']).first()
+        name_record = RoomModel.lookup_by_name(new_room_args['name'])
         if name_record:
             abort(409, error_code=409,
                 error_msg='Cannot create a new room because a room with the given name already exists.'
             )
-        room_admin = db.session.query(UserModel).filter_by(name=new_room_args['room_admin_name']).first()
+        room_admin = UserModel.lookup_by_name(new_room_args['room_admin_name'])
         if not room_admin:
             abort(409, error_code=409,
                 error_msg='Cannot create a new room because no user with the given name of the room admin exists.'
             )
 
-        new_room = RoomModel(name=new_room_args['name'])
-        room_admin.is_admin.append(new_room)
+        # Set the foreign key directly instead of appending to room_admin.is_admin,
+        # which would first lazy load every room administered by the user.
+        # The admin is the first member of the room.
+        new_room = RoomModel(name=new_room_args['name'], admin_id=room_admin._id, member_count=1)
         db.session.add(new_room)
+        db.session.flush()
+        db.session.add(MembershipModel(room_id=new_room._id, user_id=room_admin._id))
+        db.session.add(ChangeModel(kind=ChangeModel.ROOM_CREATED, user_id=room_admin._id, room_id=new_room._id))
         db.session.commit()
+        room_name_cache.invalidate(new_room.name)
         
         return new_room, 201
 
@@ -335,7 +1988,6 @@ class RoomRecord(Resource):
         1. GET - Get a room by their name.
     """
 
-    @marshal_with(room_fields)
     def get(self, name):
         """Handles GET requests at the specified endpoint and return
         HTTP code 200 on a successful completion of a request.
@@ -345,19 +1997,307 @@ class RoomRecord(Resource):
         and "RooM" are treated as two different values because their cases
         are different, even though they mean the same.
         
-        Return a JSON response containing details about the specified room.
+        Return a JSON response containing details about the specified room, whose
+        fields can be selected by passing a comma-separated list of them as
+        fields in the query string.
+
+        The response carries an ETag header. If it matches the If-None-Match
+        header of the request, a 304 response without a body is returned instead.
 
         Abort handling GET requests and return 404 if no room with
-        the specified name is found along with an error message.
+        the specified name is found along with an error message. Also,
+        return a 400 error if an unknown field is selected.
         """
-        record = db.session.query(RoomModel).filter_by(name=name).first()
+        record = RoomModel.lookup_by_name(name)
 
         if not record:
             abort(404, error_code=404, 
                 error_msg='No room with the given name exists in the database.'
             )
 
-        return record, 200
+        fields = selected_fields(tuple(room_fields))
+        etag = make_etag('room', fields, *record)
+        response = not_modified(etag)
+        if response:
+            return response
+
+        # Marshalled here rather than with marshal_with, which would also
+        # marshal the 304 response.
+        with phase('serialize'):
+            room = select_fields(marshal(record._asdict(), room_fields), fields)
+
+        return room, 200, {'ETag': quote_etag(etag)}
+
+
+def parse_membership_page_args():
+    """Parse the cursor parameters of a page of members or rooms of a user,
+    and return the after_id along with the limit of the page.
+
+    Abort with a 400 error if the given limit is not a positive number.
+    """
+    page_args = membership_get_reqparser.parse_args()
+
+    limit = page_args['limit']
+    if limit is None:
+        limit = MEMBERS_PAGE_DEFAULT_LIMIT
+    if limit < 1:
+        abort(400, error_code=400, error_msg='The limit of a page must be a positive number.')
+
+    return page_args['after_id'], min(limit, MEMBERS_PAGE_MAX_LIMIT)
+
+
+class RoomMembers(Resource):
+    """Resource class to handle requests made to the members of a room at
+    the specified endpoint(s):
+        1. /rooms/{name}/members
+    
+    Handles the following request(s) along with a summary::
+        1. GET  - Get the members of a room.
+        2. POST - Add a user to the members of a room.
+    """
+
+    def get(self, name):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing a page of the members of the
+        room with the given name, in the order of their ids, mapping the id of
+        each member to their name, along with the member_count of the room
+        and a 'next_cursor', which is the after_id to pass to fetch the next
+        page, or null once there are no more members. The page can be selected
+        by passing the following optional parameters in the query string:\n
+            1. after_id - Return the members whose id is greater than this id.\n
+            2. limit    - Maximum number of members in the page (default: 100, max: 1000).\n
+
+        Abort handling GET requests and return 404 if no room with the given
+        name exists in the database along with an error message. Also, return
+        a 400 error if the given limit is not a positive number.
+        """
+        after_id, limit = parse_membership_page_args()
+
+        room = RoomModel.lookup_by_name(name)
+        if not room:
+            abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
+
+        records, next_cursor = fetch_membership_page(member_rows_query(room._id), MembershipModel.user_id,
+            after_id=after_id, limit=limit
+        )
+        if records:
+            member_count = records[0].member_count
+        else:
+            with phase('db'):
+                member_count = db.session.query(RoomModel.member_count).filter(RoomModel._id == room._id).scalar()
+
+        with phase('serialize'):
+            members = {record._id: {'name': record.name} for record in records}
+
+        return {'members': members, 'member_count': member_count, 'next_cursor': next_cursor}, 200
+
+    def post(self, name):
+        """Handles POST requests at the endpoint, which adds the user whose
+        name is passed as user_name in the JSON object to the members of the
+        room with the given name, and returns status code 201 along with a
+        JSON response containing the room_id and user_id of the membership.
+
+        Abort handling POST requests and return 404 if no room with the given
+        name exists in the database, or 409 if no user with the given name
+        exists or if the user is already a member of the room, along with an
+        error message. Also, abort with a 403 error if the request has the
+        session token of another user than the one joining the room.
+        """
+        membership_args = membership_post_reqparser.parse_args(strict=True)
+        check_acting_user(membership_args['user_name'], 'Cannot add another user than the logged in one to a room.')
+
+        room = RoomModel.lookup_by_name(name)
+        if not room:
+            abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
+        user = UserModel.lookup_by_name(membership_args['user_name'])
+        if not user:
+            abort(409, error_code=409,
+                error_msg='Cannot join the room because the given user doesn\'t exist in the database.'
+            )
+
+        # The membership and the member count of the room are written in the
+        # same transaction, and a second join of the same user violates the
+        # primary key, so the count can't drift even under concurrent joins.
+        membership = MembershipModel(room_id=room._id, user_id=user._id)
+        try:
+            db.session.add(membership)
+            db.session.flush()
+            db.session.query(RoomModel).filter(RoomModel._id == room._id) \
+                .update({RoomModel.member_count: RoomModel.member_count + 1}, synchronize_session=False)
+            db.session.add(ChangeModel(kind=ChangeModel.MEMBER_JOINED, user_id=user._id, room_id=room._id))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            abort(409, error_code=409, error_msg='The given user is already a member of the room.')
+
+        with phase('serialize'):
+            return marshal({'room_id': room._id, 'user_id': user._id}, membership_fields), 201
+
+
+class RoomMember(Resource):
+    """Resource class to handle requests made to a specific member of a room
+    at the specified endpoint(s):
+        1. /rooms/{name}/members/{user_name}
+    
+    Handles the following request(s) along with a summary::
+        1. DELETE - Remove a user from the members of a room.
+    """
+
+    def delete(self, name, user_name):
+        """Handles DELETE requests at the endpoint, which removes the user with
+        the given user_name from the members of the room with the given name,
+        and returns status code 200 along with a JSON response containing the
+        room_id and user_id of the removed membership.
+
+        Abort handling DELETE requests and return 404 if the room or the user
+        doesn't exist, or if the user isn't a member of the room, and 409 if the
+        user is the admin of the room, who can't leave it, along with an
+        error message. Also, abort with a 403 error if the request has the
+        session token of another user than the one leaving the room.
+        """
+        check_acting_user(user_name, 'Cannot remove another user than the logged in one from a room.')
+
+        room = RoomModel.lookup_by_name(name)
+        if not room:
+            abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
+        user = UserModel.lookup_by_name(user_name)
+        if not user:
+            abort(404, error_code=404, error_msg='No user with the given name exists in the database.')
+        if user._id == room.admin_id:
+            abort(409, error_code=409, error_msg='The admin of a room cannot leave it.')
+
+        deleted = db.session.query(MembershipModel) \
+            .filter(MembershipModel.room_id == room._id, MembershipModel.user_id == user._id) \
+            .delete(synchronize_session=False)
+        if not deleted:
+            db.session.rollback()
+            abort(404, error_code=404, error_msg='The given user is not a member of the room.')
+
+        db.session.query(RoomModel).filter(RoomModel._id == room._id) \
+            .update({RoomModel.member_count: RoomModel.member_count - 1}, synchronize_session=False)
+        db.session.add(ChangeModel(kind=ChangeModel.MEMBER_LEFT, user_id=user._id, room_id=room._id))
+        db.session.commit()
+
+        with phase('serialize'):
+            return marshal({'room_id': room._id, 'user_id': user._id}, membership_fields), 200
+
+
+class RoomRetention(Resource):
+    """Resource class to handle requests made to the retention policy of a
+    room at the specified endpoint(s):
+        1. /rooms/{name}/retention
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the retention policy and the archive of a room.
+        2. PUT - Set the retention policy of a room.
+    """
+
+    @staticmethod
+    def _policy(room_id):
+        """Return the retention policy of the room with the given id, along
+        with the statistics of its archive, as a dict."""
+        room = db.session.query(RoomModel.retention_days, RoomModel.retention_messages) \
+            .filter(RoomModel._id == room_id) \
+            .one()
+        days, messages = retention_job.policy(room)
+
+        return {
+            'days': days,
+            'messages': messages,
+            'default': room.retention_days is None and room.retention_messages is None,
+            **message_archive.stats(db.session, room_id)
+        }
+
+    def get(self, name):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing the retention policy of the room
+        with the given name: the number of days its messages are kept for and
+        the number of its most recent messages that are kept (0 keeping them
+        forever), whether it is the default policy, and the number of segments
+        and of messages of its archive, along with the id of its last archived
+        message.
+
+        Abort handling GET requests and return 404 if no room with the given
+        name exists in the database along with an error message.
+        """
+        room = RoomModel.lookup_by_name(name)
+        if not room:
+            abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
+
+        return self._policy(room._id), 200
+
+    def put(self, name):
+        """Handles PUT requests at the endpoint, which sets the retention policy
+        of the room with the given name to the days and messages given in the
+        JSON object, either of them defaulting to the policy of the deployment
+        when omitted, and returns status code 200 along with the same JSON
+        response as GET requests. Messages expired by the policy are archived
+        by the next run of the retention job, see retention.py.
+
+        Abort handling PUT requests and return 404 if no room with the given
+        name exists in the database, and 400 if days or messages is negative,
+        along with an error message. Also, abort with a 403 error if the
+        request has the session token of another user than the admin of the room.
+        """
+        policy_args = retention_put_reqparser.parse_args()
+
+        room = RoomModel.lookup_by_name(name)
+        if not room:
+            abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
+        if g.user is not None and g.user._id != room.admin_id:
+            abort(403, error_code=403, error_msg='Only the admin of a room can set its retention policy.')
+        if any(value is not None and value < 0 for value in policy_args.values()):
+            abort(400, error_code=400, error_msg='The days and messages kept by a room cannot be negative.')
+
+        db.session.query(RoomModel).filter(RoomModel._id == room._id).update({
+            RoomModel.retention_days: policy_args['days'],
+            RoomModel.retention_messages: policy_args['messages']
+        }, synchronize_session=False)
+        db.session.commit()
+
+        return self._policy(room._id), 200
+
+
+class UserRooms(Resource):
+    """Resource class to handle requests made to the rooms of a user at the
+    specified endpoint(s):
+        1. /users/{name}/rooms
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the rooms which a user is a member of.
+    """
+
+    def get(self, name):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing a page of the rooms which the
+        user with the given name is a member of, in the order of their ids,
+        mapping the id of each room to its name, admin_id and member_count,
+        along with a 'next_cursor', which is the after_id to pass to fetch the
+        next page, or null once there are no more rooms. The page is selected
+        with the same optional after_id and limit parameters as the members
+        of a room.
+
+        Abort handling GET requests and return 404 if no user with the given
+        name exists in the database along with an error message. Also, return
+        a 400 error if the given limit is not a positive number.
+        """
+        after_id, limit = parse_membership_page_args()
+
+        user = UserModel.lookup_by_name(name)
+        if not user:
+            abort(404, error_code=404, error_msg='No user with the given name exists in the database.')
+
+        records, next_cursor = fetch_membership_page(user_room_rows_query(user._id), MembershipModel.room_id,
+            after_id=after_id, limit=limit
+        )
+
+        with phase('serialize'):
+            rooms = {
+                record._id: {'name': record.name, 'admin_id': record.admin_id, 'member_count': record.member_count}
+                for record in records
+            }
+
+        return {'rooms': rooms, 'next_cursor': next_cursor}, 200
 
 
 class Message(Resource):
@@ -379,37 +2319,98 @@ class Message(Resource):
         could potentially exist in the database. This means that "Room"
         and "RooM" are treated as two different values because their cases
         are different, even though they mean the same.
-        
+
+        The history of a room is returned one page at a time, in the order in
+        which the messages were sent. The page can be selected by passing the
+        following optional parameters in the query string:\n
+            1. after_id  - Return the messages sent after the message with this id.\n
+            2. before_id - Return the messages sent before the message with this id.\n
+            3. limit     - Maximum number of messages in the page (default: 50, max: 200).\n
+        If no cursor is given, the most recent messages of the room are returned.
+
+        If the client accepts 'application/x-ndjson', all the messages of the
+        room sent after after_id and before before_id are streamed instead, oldest
+        first, as newline delimited JSON with one object holding the _id, body,
+        sender_name and room_name of a message per line. The number of messages
+        is only limited if a limit is given.
+
+        The messages archived by the retention policy of the room (see
+        retention.py) are returned as well, once the pages reach past its
+        oldest messages still stored in the database.
+
         Return a JSON response back to the user containing details
-        about all the messages that were passed between members of the
-        given room.
-        
+        about the messages in the page along with a 'next_cursor'. When
+        paging forward with after_id, it is the value of after_id used to fetch
+        the next page; otherwise it is the value of before_id used to fetch
+        the previous (older) page. It is null once there are no more messages.
+
+        The size of the response can be cut down with the following optional
+        parameters of the query string:\n
+            1. fields  - Comma-separated list of the fields of the messages to return,
+                         among body, sender_name and room_name.\n
+            2. compact - If true, the messages don't hold the name of the room, and
+                         their 'sender' is the index of the name of their sender in
+                         the list of the 'senders' of the page (JSON responses only).\n
+
+        The response carries an ETag header. If it matches the If-None-Match
+        header of the request, a 304 response without a body is returned instead.
+
         Abort handling GET requests with an 404 error code along with
         an error message if:\n
             1. The room specified by room_name parameter doesn't exist, or;\n
-            2. No messages exist for a given room in the database.
+            2. No messages exist for a given room in the database.\n
+        Also, return a 400 error if the given limit is not a positive number
+        or if an unknown field is selected.
         """
-        room = db.session.query(RoomModel).filter_by(name=room_name).first()
+        page_args = message_get_reqparser.parse_args()
+        fields = selected_fields(message_page_fields)
+        compact = wants_compact()
+
+        limit = page_args['limit']
+        if limit is None:
+            limit = MESSAGES_PAGE_DEFAULT_LIMIT
+        if limit < 1:
+            abort(400, error_code=400, error_msg='The limit of a page of messages must be a positive number.')
+        limit = min(limit, MESSAGES_PAGE_MAX_LIMIT)
+
+        room = RoomModel.lookup_by_name(room_name)
 
         if not room:
             abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
 
-        results = db.session.query(MessageModel).filter_by(room_id=room._id).all()
-        
-        if not results:
+        ndjson = wants_ndjson()
+        oldest_id, newest_id = room_history_version(room._id)
+        etag = make_etag('messages', room._id, ndjson, fields, compact, page_args['after_id'],
+            page_args['before_id'], page_args['limit'], oldest_id, newest_id
+        )
+        response = not_modified(etag)
+        if response:
+            return response
+
+        if ndjson:
+            rows = iterate_history(room._id, oldest_id, after_id=page_args['after_id'], before_id=page_args['before_id'])
+            if page_args['limit'] is not None:
+                rows = islice(rows, limit)
+            response = stream_ndjson(rows,
+                lambda record: {'_id': record._id, **select_fields({'body': record.body,
+                    'sender_name': record.sender_name, 'room_name': room.name}, fields)},
+                'No messages exist in the given room.'
+            )
+            response.set_etag(etag)
+            return response
+
+        results, next_cursor = fetch_history_page(room._id, oldest_id,
+            after_id=page_args['after_id'], before_id=page_args['before_id'], limit=limit
+        )
+
+        if not results and page_args['after_id'] is None and page_args['before_id'] is None:
             abort(404, error_code=404, error_msg='No messages exist in the given room.')
 
-        messages = {}
-        for record in results:
-            messages[record._id] = {
-                'body': record.body,
-                'sender_name': record.user.name,
-                'room_name': record.room.name
-            }
+        page = slim_message_page(serialize_message_page(results, room.name), fields, compact)
+        page['next_cursor'] = next_cursor
 
-        return [messages], 200
+        return page, 200, {'ETag': quote_etag(etag)}
 
-    @marshal_with(message_fields)
     def post(self):
         """Handles POST requests at the specified endpoint and returns status
         code 201 representing that a new message has been inserted into the
@@ -422,16 +2423,29 @@ class Message(Resource):
         
         Aborts the request if a message with no content i.e., empty body is sent
         to the server and thus, return a 409 error code with an error message.
+
+        If the write-behind queue is enabled (see MESSAGE_WRITE_BEHIND), the
+        message is committed by a background writer along with other messages,
+        and a 202 status code is returned if it isn't committed yet.
+
+        Abort with a 403 error if the request has the session token of another
+        user than the sender, and with a 429 error and a Retry-After header if
+        the sender or the room sent too many messages (see RATE_LIMIT).
         """
         new_message_args = message_post_reqparser.parse_args(strict=True)
+        check_acting_user(new_message_args['sender_name'],
+            'Cannot create a new message sent by another user than the logged in one.'
+        )
+        check_rate_limit('sender', new_message_args['sender_name'])
+        check_rate_limit('room', new_message_args['room_name'])
 
-        sender = db.session.query(UserModel).filter_by(name=new_message_args['sender_name']).first()
+        sender = UserModel.lookup_by_name(new_message_args['sender_name'])
         if not sender:
             abort(409, error_code=409,
                 error_msg='Cannot create a new message because the given sender doesn\'t exist in the database.'
             )
         
-        room = db.session.query(RoomModel).filter_by(name=new_message_args['room_name']).first()
+        room = RoomModel.lookup_by_name(new_message_args['room_name'])
         if not room:
             abort(409, error_code=409,
                 error_msg='Cannot create a new message because the given room doesn\'t exist in the database.'
@@ -442,11 +2456,669 @@ class Message(Resource):
                 error_msg='Cannot create a message with an empty body.'
             )
 
-        new_message = MessageModel(body=new_message_args['body'], room_id=room._id)
-        sender.sends.append(new_message)
-        db.session.commit()
-        
-        return new_message, 201  
+        payload = {
+            'body': new_message_args['body'],
+            'sender_name': sender.name,
+            'room_name': room.name
+        }
+
+        if message_writer is not None:
+            return self._write_behind(new_message_args['body'], sender, room, payload)
+
+        # Set the foreign key directly instead of appending to sender.sends,
+        # which would first lazy load every message ever sent by the user.
+        new_message = MessageModel(body=new_message_args['body'], sender_id=sender._id, room_id=room._id)
+        session = message_session(room._id)
+        session.add(new_message)
+        session.commit()
+
+        # Wake up the clients waiting for the new messages of the room.
+        broadcaster.publish(room._id, new_message._id, payload)
+
+        # Marshalled here rather than with marshal_with, which would also
+        # marshal the error returned when the write-behind queue is full.
+        with phase('serialize'):
+            message = marshal(new_message, message_fields)
+
+        return message, 201
+
+    def _write_behind(self, body, sender, room, payload):
+        """Queue a new message in the write-behind queue, which publishes it
+        to the subscribers of the room once it is committed.
+
+        In the 'enqueue' ack mode, return 202 as soon as the message is queued.
+        In the 'flush' ack mode, return 201 once the message is committed, or
+        202 if it wasn't committed within WRITE_BEHIND_ACK_TIMEOUT seconds.
+        Ids are handed out as the messages are committed, so the _id of the
+        message is null when 202 is returned.
+
+        Return a 503 error with a Retry-After header if the queue is full, and
+        abort with a 500 error if the message couldn't be committed.
+        """
+        row = {'body': body, 'sender_id': sender._id, 'room_id': room._id}
+        try:
+            flushed = message_writer.put(row, payload)
+        except QueueFullError:
+            # Returned rather than aborted, as the backpressure of the queue
+            # isn't an error to be logged with its traceback.
+            return {
+                'error_code': 503,
+                'error_msg': 'Cannot accept new messages right now, please retry later.'
+            }, 503, {'Retry-After': str(WRITE_BEHIND_RETRY_AFTER)}
+
+        message_id, status_code = None, 202
+        if MESSAGE_WRITE_BEHIND == ACK_FLUSH:
+            # Return the connection to the pool while waiting for the writer.
+            db.session.close()
+            try:
+                message_id = flushed.result(timeout=WRITE_BEHIND_ACK_TIMEOUT)
+                status_code = 201
+            except FutureTimeoutError:
+                pass
+            except Exception:
+                abort(500, error_code=500, error_msg='The message could not be written to the database.')
+
+        with phase('serialize'):
+            message = marshal(dict(row, _id=message_id), message_fields)
+            if message_id is None:
+                message['_id'] = None
+
+        return message, status_code
+
+
+class MessageSearch(Resource):
+    """Resource class to handle requests made to search the 'messages' table
+    at the specified endpoint(s):
+        1. /messages/search
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the messages whose body contains the given words, most relevant first.
+    """
+
+    def get(self):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing the messages whose body contains
+        every word of the query passed as q in the query string, ordered from
+        the most to the least relevant, and the most recent first among equally
+        relevant messages. The search can be narrowed down and paged through
+        by passing the following optional parameters in the query string:\n
+            1. room_name - Only search the messages of the room with this name.\n
+            2. limit     - Maximum number of messages in the page (default: 20, max: 100).\n
+            3. offset    - Number of the most relevant messages to skip (default: 0).\n
+
+        The response holds a 'messages' list with the _id, body, sender_name,
+        room_name and relevance score of each message, along with a
+        'next_offset' to pass to fetch the next page, which is null once there
+        are no more messages.
+
+        Abort handling GET requests with an 404 error code along with
+        an error message if the room specified by the room_name parameter
+        doesn't exist. Also, return a 400 error if the query doesn't contain
+        any word, if the given limit is not a positive number, or if the
+        given offset is negative.
+        """
+        search_args = message_search_reqparser.parse_args()
+
+        terms = tokenize(search_args['q'])
+        if not terms:
+            abort(400, error_code=400, error_msg='The search query must contain at least one word.')
+
+        limit = search_args['limit']
+        if limit is None:
+            limit = SEARCH_PAGE_DEFAULT_LIMIT
+        if limit < 1:
+            abort(400, error_code=400, error_msg='The limit of a page of messages must be a positive number.')
+        limit = min(limit, SEARCH_PAGE_MAX_LIMIT)
+
+        offset = search_args['offset'] or 0
+        if offset < 0:
+            abort(400, error_code=400, error_msg='The offset of a page of messages cannot be negative.')
+
+        room_id = None
+        if search_args['room_name'] is not None:
+            room = RoomModel.lookup_by_name(search_args['room_name'])
+            if not room:
+                abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
+            room_id = room._id
+
+        messages, next_offset = search_messages(terms, room_id, limit, offset)
+
+        return {'messages': messages, 'next_offset': next_offset}, 200
+
+
+class MessageBulk(Resource):
+    """Resource class to handle requests made to create many records of the
+    'messages' table at once at the specified endpoint(s):
+        1. /messages/bulk
+    
+    Handles the following request(s) along with a summary::
+        1. POST - Create a batch of new messages.
+    """
+
+    def post(self):
+        """Handles POST requests at the specified endpoint, which creates all
+        the messages passed in the 'messages' list of the JSON object. Each
+        message is an object with a body, a sender_name and a room_name, and
+        messages of different senders and rooms can be mixed in a batch.
+
+        Names are resolved with a single query per table, and the valid messages
+        are inserted with a single multi-row insert in one transaction, or one
+        per shard holding any of their rooms when the messages are sharded.
+
+        Return a JSON response with the number of messages created and the
+        result of each message, in the order in which they were passed: either
+        a 201 status or a 409 status along with an error message, if the sender or
+        the room of the message doesn't exist or its body is empty. The status
+        code of the response is 201 if any message was created, else 409.
+        Messages sent by another user than the one of the session token of the
+        request, if any, get a 403 status.
+
+        Return a 400 error along with an error message if no list of messages is
+        given, if the list is empty or longer than 1000 messages, or if one of
+        the messages isn't an object with the necessary fields. Also, return a
+        429 error and a Retry-After header if one of the senders or rooms of the
+        batch sent too many messages (see RATE_LIMIT), each of them taking as
+        many tokens as it has messages in the batch.
+        """
+        bulk_args = message_bulk_post_reqparser.parse_args(strict=True)
+        items = bulk_args['messages']
+
+        if not items or len(items) > MESSAGES_BULK_MAX_BATCH:
+            abort(400, error_code=400,
+                error_msg=f'A batch must contain between 1 and {MESSAGES_BULK_MAX_BATCH} messages.'
+            )
+        for index, item in enumerate(items):
+            if not isinstance(item, dict) or set(item) != {'body', 'sender_name', 'room_name'} \
+                    or not all(isinstance(value, str) for value in item.values()):
+                abort(400, error_code=400,
+                    error_msg=f'The message at index {index} must have a body, a sender_name and a room_name.'
+                )
+
+        for scope, key in (('sender', 'sender_name'), ('room', 'room_name')):
+            for name, count in Counter(item[key] for item in items).items():
+                check_rate_limit(scope, name, count)
+
+        senders = UserModel.lookup_by_names({item['sender_name'] for item in items})
+        rooms = RoomModel.lookup_by_names({item['room_name'] for item in items})
+
+        rows = []
+        results = []
+        for index, item in enumerate(items):
+            sender = senders.get(item['sender_name'])
+            room = rooms.get(item['room_name'])
+            if g.user is not None and g.user.name != item['sender_name']:
+                results.append({'index': index, 'status': 403,
+                    'error_msg': 'Cannot create a new message sent by another user than the logged in one.'
+                })
+            elif not sender:
+                results.append({'index': index, 'status': 409,
+                    'error_msg': 'Cannot create a new message because the given sender doesn\'t exist in the database.'
+                })
+            elif not room:
+                results.append({'index': index, 'status': 409,
+                    'error_msg': 'Cannot create a new message because the given room doesn\'t exist in the database.'
+                })
+            elif not len(item['body']):
+                results.append({'index': index, 'status': 409,
+                    'error_msg': 'Cannot create a message with an empty body.'
+                })
+            else:
+                rows.append({'body': item['body'], 'sender_id': sender._id, 'room_id': room._id})
+                results.append({'index': index, 'status': 201})
+
+        if rows:
+            # Ids are handed out by the allocator of the write-behind queue
+            # while it is enabled, so that they never collide and are
+            # committed in order.
+            if message_writer is not None:
+                with phase('db'):
+                    first_id = message_id_allocator.reserve(db.session.connection(), len(rows))
+                for offset, row in enumerate(rows):
+                    row['_id'] = first_id + offset
+
+            if message_shards is not None:
+                with phase('db'):
+                    message_shards.insert(rows)
+            else:
+                with phase('db'):
+                    db.session.execute(MessageModel.__table__.insert(), rows)
+                db.session.commit()
+
+            # Wake up the clients waiting for the new messages of the rooms,
+            # which read them from the database as their ids aren't known.
+            for room_id in {row['room_id'] for row in rows}:
+                broadcaster.publish(room_id, None)
+
+        return {'created': len(rows), 'results': results}, 201 if rows else 409
+
+
+class MessageStream(Resource):
+    """Resource class to handle long-poll requests waiting for the new
+    messages of a room at the specified endpoint(s):
+        1. /messages/{room_name}/poll
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Wait for the messages sent to a room after a given message.
+    """
+
+    def get(self, room_name):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        as soon as a message is sent to the room after the message whose id
+        is passed as since_id in the query string, or once the timeout (in seconds,
+        default: 25, max: 55) passed in the query string has elapsed.
+
+        Return a JSON response in the same format as a page of the history of
+        the room, i.e. the new messages (if any) along with a 'next_cursor' which
+        is the since_id to pass in the next request. The fields and compact
+        parameters of the query string select the form of the messages, like
+        for a page of the history of the room.
+
+        The request doesn't hold a connection to the database while waiting,
+        and is woken up by the server as soon as a new message is created in
+        the room, so clients can wait for new messages without polling.
+
+        Abort handling GET requests and return 404 if no room with the
+        given name exists in the database along with an error message.
+        Also, return a 400 error if the given timeout is negative or if an
+        unknown field is selected.
+        """
+        poll_args = message_poll_reqparser.parse_args()
+        fields = selected_fields(message_page_fields)
+        compact = wants_compact()
+        since_id = poll_args['since_id']
+
+        timeout = poll_args['timeout']
+        if timeout is None:
+            timeout = POLL_DEFAULT_TIMEOUT
+        if timeout < 0:
+            abort(400, error_code=400, error_msg='The timeout of a poll request cannot be negative.')
+        timeout = min(timeout, POLL_MAX_TIMEOUT)
+
+        room = RoomModel.lookup_by_name(room_name)
+
+        if not room:
+            abort(404, error_code=404, error_msg='No room with the given name exists in the database.')
+        room_id, room_name = room._id, room.name
+
+        # Take the position of the room before reading the database, so that
+        # a message committed after the read is published after the position.
+        position = broadcaster.position(room_id)
+        results, _ = fetch_message_page(room_id, after_id=since_id, limit=MESSAGES_PAGE_MAX_LIMIT)
+        messages = serialize_message_page(results, room_name)
+
+        if not messages:
+            # Return the connections to the pools while waiting.
+            db.session.close()
+            if message_shards is not None:
+                message_shards.close_sessions()
+
+            events = broadcaster.wait(room_id, position, since_id, timeout)
+            if events is None:
+                results, _ = fetch_message_page(room_id, after_id=since_id, limit=MESSAGES_PAGE_MAX_LIMIT)
+                messages = serialize_message_page(results, room_name)
+            else:
+                for message_id, payload in events[:MESSAGES_PAGE_MAX_LIMIT]:
+                    messages[message_id] = payload
+
+        page = slim_message_page(messages, fields, compact)
+        page['next_cursor'] = max(messages) if messages else since_id
+
+        return page, 200
+
+
+class Sync(Resource):
+    """Resource class to handle requests made to sync the changes since a
+    previous sync at the specified endpoint(s):
+        1. /sync
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the users, rooms, memberships and messages created since a sync.
+    """
+
+    def get(self):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing everything that changed since
+        the sync whose token is passed as since in the query string:\n
+            1. users       - The users created since, mapping the id of each user
+                             to their name and email.\n
+            2. rooms       - The rooms created since, and the synced rooms whose
+                             members changed since, mapping the id of each room
+                             to its name, room_admin_name and member_count.\n
+            3. memberships - The users who joined (or left) the synced rooms, and
+                             the rooms which the user joined (or left), as a list of
+                             objects holding a room_id, a user_id and whether the
+                             user joined the room, in the order of the changes.\n
+            4. messages    - The messages sent since to the synced rooms, in the
+                             same format as a page of the history of a room.\n
+        The synced rooms are the rooms which the user whose name is passed as
+        user_name is a member of, along with the rooms whose names are passed
+        as a comma-separated list as rooms.
+
+        The response also holds the 'next_token' to pass as since to the next
+        sync, and 'has_more', which is true if more changes than the limit
+        passed in the query string (default: 500, max: 2000) are left, which
+        are returned by the next sync. If no sync token is given, only the
+        token of the current state of the database is returned, from which the
+        next sync starts. The form of the messages can be selected with the
+        fields and compact parameters, like for a page of the history of a room.
+
+        The changes are read from a log of the changes of the users, rooms and
+        memberships, and the messages from the (room_id, _id) index of the
+        messages, so the cost of a sync depends on the number of changes it
+        returns rather than on the size of the tables.
+
+        The changes and messages of the last seconds (SYNC_SAFETY_LAG, default:
+        2), which may still be committed out of order, are left to the next
+        syncs, so that no change is ever skipped.
+
+        Abort handling GET requests and return 404 if the given user or one
+        of the given rooms doesn't exist in the database along with an error
+        message. Also, return a 400 error if the sync token is invalid, if the
+        given limit is not a positive number, if more than 1000 rooms are given
+        or if an unknown field is selected.
+        """
+        sync_args = sync_get_reqparser.parse_args()
+        fields = selected_fields(message_page_fields)
+        compact = wants_compact()
+
+        limit = sync_args['limit']
+        if limit is None:
+            limit = SYNC_DEFAULT_LIMIT
+        if limit < 1:
+            abort(400, error_code=400, error_msg='The limit of a sync must be a positive number.')
+        limit = min(limit, SYNC_MAX_LIMIT)
+
+        room_names = {}
+        if sync_args['rooms']:
+            names = {name.strip() for name in sync_args['rooms'].split(',') if name.strip()}
+            if len(names) > SYNC_MAX_ROOMS:
+                abort(400, error_code=400, error_msg=f'Cannot sync more than {SYNC_MAX_ROOMS} rooms at once.')
+            for name in names:
+                room = RoomModel.lookup_by_name(name)
+                if not room:
+                    abort(404, error_code=404, error_msg=f'No room named {name!r} exists in the database.')
+                room_names[room._id] = room.name
+
+        user_id = None
+        if sync_args['user_name'] is not None:
+            user = UserModel.lookup_by_name(sync_args['user_name'])
+            if not user:
+                abort(404, error_code=404, error_msg='No user with the given name exists in the database.')
+            user_id = user._id
+            with phase('db'):
+                room_names.update(db.session.query(RoomModel._id, RoomModel.name)
+                    .join(MembershipModel, MembershipModel.room_id == RoomModel._id)
+                    .filter(MembershipModel.user_id == user_id)
+                    .order_by(MembershipModel.room_id.asc())
+                    .limit(SYNC_MAX_ROOMS)
+                )
+
+        if sync_args['since'] is None:
+            return {'users': {}, 'rooms': {}, 'memberships': [], 'messages': {},
+                'next_token': current_sync_token(), 'has_more': False}, 200
+
+        change_id, message_ids = parse_sync_token(sync_args['since'])
+        changes, change_id, changes_left = fetch_changes(change_id, limit)
+        messages, message_ids, messages_left = fetch_sync_messages(room_names, message_ids, limit)
+
+        user_ids, room_ids, memberships = set(), set(), []
+        for change in changes:
+            if change.kind == ChangeModel.USER_CREATED:
+                user_ids.add(change.user_id)
+                continue
+            if change.kind == ChangeModel.ROOM_CREATED:
+                room_ids.add(change.room_id)
+            if change.room_id in room_names or change.user_id == user_id:
+                room_ids.add(change.room_id)
+                memberships.append({'room_id': change.room_id, 'user_id': change.user_id,
+                    'joined': change.kind != ChangeModel.MEMBER_LEFT})
+
+        with phase('db'):
+            users = user_rows_query().filter(UserModel._id.in_(user_ids)).all() if user_ids else []
+            rooms = room_rows_query().add_columns(RoomModel.member_count) \
+                .filter(RoomModel._id.in_(room_ids)).all() if room_ids else []
+
+        with phase('serialize'):
+            sync = slim_message_page(messages, fields, compact)
+            sync['users'] = {record._id: {'name': record.name, 'email': record.email} for record in users}
+            sync['rooms'] = {
+                record._id: {'name': record.name, 'room_admin_name': record.room_admin_name,
+                    'member_count': record.member_count}
+                for record in rooms
+            }
+            sync['memberships'] = memberships
+            sync['next_token'] = format_sync_token(change_id, message_ids)
+            sync['has_more'] = changes_left or messages_left
+
+        return sync, 200
+
+
+class CacheStats(Resource):
+    """Resource class to handle requests made to get the statistics of the
+    name lookup caches at the specified endpoint(s):
+        1. /stats/cache
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the size, hits and misses of the caches of users, rooms and sessions.
+    """
+
+    def get(self):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing the statistics of the name lookup
+        caches and of the cache of the verified session tokens of this process.
+        """
+        return {
+            'users': user_name_cache.stats(),
+            'rooms': room_name_cache.stats(),
+            'sessions': session_tokens.stats()
+        }, 200
+
+
+class RateLimitStats(Resource):
+    """Resource class to handle requests made to get the statistics of the
+    rate limiter at the specified endpoint(s):
+        1. /stats/ratelimit
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the limits and the allowed and limited requests of each scope.
+    """
+
+    def get(self):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing whether the requests are rate
+        limited, the backend and number of the token buckets, and for each
+        scope (client, sender and room) its rate and burst, and the number of
+        requests allowed and limited so far by this process.
+        """
+        return {
+            'enabled': rate_limiter.enabled,
+            'backend': RATE_LIMIT_BACKEND,
+            'buckets': rate_limiter.backend.size(),
+            'scopes': rate_limiter.stats()
+        }, 200
+
+
+def database_pool_stats():
+    """Return the statistics of the pools of connections to the primary, the
+    read replicas and the shards of the messages, by name of database."""
+    pools = {'primary': pool_stats(db.engine)}
+    pools.update(replica_router.pool_stats())
+    if message_shards is not None:
+        pools.update(message_shards.pool_stats())
+
+    return pools
+
+
+class PoolStats(Resource):
+    """Resource class to handle requests made to get the statistics of the
+    pool of connections to the database at the specified endpoint(s):
+        1. /stats/pool
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the checked out connections, overflow and wait times of the pool.
+    """
+
+    def get(self):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing the statistics of the pool of
+        connections of this process: its size, the number of connections that
+        are checked in and out, the overflow, and the time spent by requests
+        waiting for a free connection (in seconds), for the primary, each of
+        the read replicas and each of the shards of the messages.
+        """
+        return database_pool_stats(), 200
+
+
+class ReplicaStats(Resource):
+    """Resource class to handle requests made to get the replication lag of
+    the read replicas at the specified endpoint(s):
+        1. /stats/replicas
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the lag and the health of each read replica.
+    """
+
+    def get(self):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing the lag (in seconds) of each read
+        replica, whether it is serving requests, and the error raised while
+        checking it, if any.
+        """
+        replica_router.check()
+        return {'max_lag': REPLICA_MAX_LAG, 'replicas': replica_router.stats()}, 200
+
+
+def collect_stats_metrics():
+    """Collector of the metrics registry reporting the statistics of the name
+    lookup caches, of the pools of connections to the database, of the
+    read replicas, of the compression of the responses, of the workers
+    hashing the passwords, of the cache of the verified session tokens, of
+    the rate limiter and of the retention job of the messages."""
+    caches = {'users': user_name_cache.stats(), 'rooms': room_name_cache.stats()}
+    pools = database_pool_stats()
+
+    metrics = [
+        ('treechat_name_cache_size', 'gauge', 'Entries held by the name lookup caches.',
+            [((('cache', name),), stats['size']) for name, stats in caches.items()]),
+        ('treechat_name_cache_hits_total', 'counter', 'Lookups served by the name lookup caches.',
+            [((('cache', name),), stats['hits']) for name, stats in caches.items()]),
+        ('treechat_name_cache_misses_total', 'counter', 'Lookups not served by the name lookup caches.',
+            [((('cache', name),), stats['misses']) for name, stats in caches.items()])
+    ]
+    for key in ('size', 'checked_in', 'checked_out', 'overflow', 'checkouts', 'checkout_timeouts', 'wait_time_total'):
+        samples = [((('pool', name),), pool[key]) for name, pool in pools.items() if key in pool]
+        if samples:
+            metric_type = 'counter' if key in ('checkouts', 'checkout_timeouts', 'wait_time_total') else 'gauge'
+            metrics.append((f'treechat_db_pool_{key}', metric_type, f'{key} of the pools of connections to the database.',
+                samples
+            ))
+
+    replicas = replica_router.stats()
+    if replicas:
+        metrics.append(('treechat_db_replica_lag_seconds', 'gauge', 'Replication lag of the read replicas.',
+            [((('replica', name),), stats['lag']) for name, stats in replicas.items() if stats['lag'] is not None]
+        ))
+        metrics.append(('treechat_db_replica_healthy', 'gauge', 'Whether the read replicas are serving requests.',
+            [((('replica', name),), int(stats['healthy'])) for name, stats in replicas.items()]
+        ))
+
+    if compression.enabled:
+        compressed = compression.stats()
+        for key, help_text in (('responses', 'Responses compressed, by encoding.'),
+                ('bytes_in', 'Size of the bodies of the compressed responses before compression, by encoding.'),
+                ('bytes_out', 'Size of the bodies of the compressed responses after compression, by encoding.')):
+            metrics.append((f'treechat_compression_{key}_total', 'counter', help_text,
+                [((('encoding', encoding),), stats[key]) for encoding, stats in compressed.items()]
+            ))
+
+    credentials = credential_pool.stats()
+    metrics.append(('treechat_kdf_pending', 'gauge', 'Passwords held by the workers hashing the passwords.',
+        [((), credentials['pending'])]
+    ))
+    for key in ('completed', 'rejected'):
+        metrics.append((f'treechat_kdf_{key}_total', 'counter', f'Passwords {key} by the workers hashing the passwords.',
+            [((), credentials[key])]
+        ))
+
+    sessions = session_tokens.stats()
+    metrics.append(('treechat_session_cache_size', 'gauge', 'Tokens held by the cache of the verified session tokens.',
+        [((), sessions['size'])]
+    ))
+    for key in ('hits', 'misses'):
+        metrics.append((f'treechat_session_cache_{key}_total', 'counter',
+            f'{key} of the cache of the verified session tokens.', [((), sessions[key])]
+        ))
+
+    if rate_limiter.enabled:
+        scopes = rate_limiter.stats()
+        for key in ('allowed', 'limited'):
+            metrics.append((f'treechat_rate_limit_{key}_total', 'counter', f'Requests {key} by the rate limiter, by scope.',
+                [((('scope', scope),), stats[key]) for scope, stats in scopes.items()]
+            ))
+
+    retention = retention_job.stats()
+    for key in ('runs', 'archived', 'segments', 'failed'):
+        metrics.append((f'treechat_retention_{key}_total', 'counter', f'{key} by the retention job of the messages.',
+            [((), retention[key])]
+        ))
+
+    if message_writer is not None:
+        writer = message_writer.stats()
+        metrics.append(('treechat_write_behind_queued', 'gauge', 'Messages waiting in the write-behind queue.',
+            [((), writer['queued'])]
+        ))
+        for key in ('flushed', 'batches', 'failed', 'rejected'):
+            metrics.append((f'treechat_write_behind_{key}_total', 'counter', f'{key} by the write-behind queue.',
+                [((), writer[key])]
+            ))
+
+    return metrics
+
+
+instrumentation.metrics.add_collector(collect_stats_metrics)
+
+
+class WriteBehindStats(Resource):
+    """Resource class to handle requests made to get the statistics of the
+    write-behind queue of messages at the specified endpoint(s):
+        1. /stats/writebehind
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the length of the queue and the number of written messages.
+    """
+
+    def get(self):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with a JSON response containing the ack mode of the write-behind
+        queue of this process, the number of messages queued, and the number
+        of messages written, failed and rejected so far.
+
+        Abort handling GET requests and return 404 if the write-behind queue
+        is disabled.
+        """
+        if message_writer is None:
+            abort(404, error_code=404, error_msg='The write-behind queue of messages is disabled.')
+
+        return dict(message_writer.stats(), ack_mode=MESSAGE_WRITE_BEHIND), 200
+
+
+class Metrics(Resource):
+    """Resource class to handle requests made to get the metrics of the
+    process in the Prometheus text format at the specified endpoint(s):
+        1. /metrics
+    
+    Handles the following request(s) along with a summary::
+        1. GET - Get the request timings, SQL statistics, cache and pool statistics.
+    """
+
+    def get(self):
+        """Handles GET requests at the endpoint and return HTTP code 200
+        along with the metrics of the requests served by this process: their
+        number, durations and phases, and the number and duration of the SQL
+        statements they executed, by endpoint, followed by the statistics of
+        the name lookup caches and of the pool of connections.
+        """
+        return Response(instrumentation.metrics.render(), mimetype='text/plain; version=0.0.4')
 # -------------
 
 
@@ -454,12 +3126,28 @@ class Message(Resource):
 # -----------------------------------
 api.add_resource(UserEntity, '/users/new', endpoint='create_new_user')
 api.add_resource(UserEntity, '/users/all', endpoint='get_all_users')
+api.add_resource(UserLogin, '/users/login', endpoint='login_user')
+api.add_resource(UserLogout, '/users/logout', endpoint='logout_user')
 api.add_resource(UserRecord, '/users/<string:name>', endpoint='get_user_by_name')
 api.add_resource(RoomEntity, '/rooms/new', endpoint='create_new_room')
 api.add_resource(RoomEntity, '/rooms/all', endpoint='get_all_rooms')
 api.add_resource(RoomRecord, '/rooms/<string:name>', endpoint='get_room_by_name')
+api.add_resource(RoomMembers, '/rooms/<string:name>/members', endpoint='members_of_a_room')
+api.add_resource(RoomMember, '/rooms/<string:name>/members/<string:user_name>', endpoint='member_of_a_room')
+api.add_resource(RoomRetention, '/rooms/<string:name>/retention', endpoint='retention_of_a_room')
+api.add_resource(UserRooms, '/users/<string:name>/rooms', endpoint='get_rooms_of_a_user')
 api.add_resource(Message, '/messages/new', endpoint='create_new_message')
+api.add_resource(MessageBulk, '/messages/bulk', endpoint='create_new_msgs_in_bulk')
+api.add_resource(MessageSearch, '/messages/search', endpoint='search_msgs')
 api.add_resource(Message, '/messages/<string:room_name>', endpoint='get_all_msgs_of_a_room')
+api.add_resource(MessageStream, '/messages/<string:room_name>/poll', endpoint='poll_new_msgs_of_a_room')
+api.add_resource(Sync, '/sync', endpoint='sync_changes')
+api.add_resource(CacheStats, '/stats/cache', endpoint='get_cache_stats')
+api.add_resource(PoolStats, '/stats/pool', endpoint='get_pool_stats')
+api.add_resource(ReplicaStats, '/stats/replicas', endpoint='get_replica_stats')
+api.add_resource(WriteBehindStats, '/stats/writebehind', endpoint='get_write_behind_stats')
+api.add_resource(RateLimitStats, '/stats/ratelimit', endpoint='get_rate_limit_stats')
+api.add_resource(Metrics, '/metrics', endpoint='get_metrics')
 # -----------------------------------
 
 if __name__ == '__main__':
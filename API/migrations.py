@@ -0,0 +1,326 @@
+"""Versioned migrations of the schema of the TreeChat database.
+
+Every migration has a version number, and the versions which were applied
+to a database are recorded in its 'schema_migrations' table, so that
+upgrading a database only applies the migrations it is missing:
+
+    $ python migrations.py upgrade            # Apply all the pending migrations.
+    $ python migrations.py upgrade --to 2     # Apply the pending migrations up to version 2.
+    $ python migrations.py current            # Print the version of the schema.
+    $ python migrations.py explain            # Print the plans of the queries of the endpoints.
+
+Migrations check the current state of the schema before changing it, so they
+can also be applied to databases whose tables were created with db.create_all().
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, String, Table, func, inspect, literal, null,
+    select, union)
+from sqlalchemy.schema import CreateColumn
+
+from main import (app, db, message_shards, password_hasher, KDF_WORKERS, UserModel, RoomModel, MessageModel,
+    MembershipModel, ChangeModel, IdBlockModel, RateLimitModel, ArchiveSegmentModel, MESSAGES_PAGE_DEFAULT_LIMIT,
+    MEMBERS_PAGE_DEFAULT_LIMIT, SYNC_DEFAULT_LIMIT, SYNC_SETTLED_BATCH_SIZE, user_rows_query, room_rows_query,
+    message_rows_query, member_rows_query, user_room_rows_query, sync_message_rows_query)
+from search import create_fulltext_index
+
+# Table recording the migrations applied to the database.
+schema_migrations = Table('schema_migrations', MetaData(),
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(256), nullable=False),
+    Column('applied_at', DateTime, nullable=False)
+)
+
+# Registered migrations as (version, name, function) tuples.
+MIGRATIONS = []
+
+# Number of users whose passwords are hashed at a time by the migration
+# hashing the passwords.
+PASSWORD_BATCH_SIZE = 1000
+
+
+def migration(version, name):
+    """Decorator registering the decorated function as the migration with the
+    given version. The function is called with a connection to the database,
+    within a transaction."""
+    def register(function):
+        MIGRATIONS.append((version, name, function))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return function
+
+    return register
+
+
+# Migration Helpers
+# -----------------
+def create_index_if_missing(connection, table, name, *columns):
+    """Create an index with the given name on the given columns of a table,
+    unless the table already has an index with that name."""
+    if name in {index['name'] for index in inspect(connection).get_indexes(table.name)}:
+        return
+
+    Index(name, *(table.c[column] for column in columns)).create(bind=connection)
+
+
+def add_column_if_missing(connection, table, column_name):
+    """Add the column of a table with the given name, as it is defined on the
+    model of the table, unless the table already has that column."""
+    if column_name in {column['name'] for column in inspect(connection).get_columns(table.name)}:
+        return
+
+    column_ddl = CreateColumn(table.c[column_name]).compile(dialect=connection.dialect)
+    connection.execute(f'ALTER TABLE {table.name} ADD COLUMN {column_ddl}')
+
+
+def add_message_created_at(connection, table):
+    """Add the created_at column to the given messages table (of the primary or
+    of a shard), and set it to the current time for the existing messages,
+    which start their retention period from the time they are migrated."""
+    add_column_if_missing(connection, table, 'created_at')
+    connection.execute(table.update().where(table.c.created_at.is_(None)).values(created_at=datetime.utcnow()))
+
+
+def backfill_change_log(connection):
+    """Log the creation of the existing users and rooms, and the existing
+    memberships other than the ones of the admins of the rooms, unless the
+    change log already holds changes."""
+    changes, users, rooms, memberships = (ChangeModel.__table__, UserModel.__table__, RoomModel.__table__,
+        MembershipModel.__table__)
+    if connection.execute(select([func.count()]).select_from(changes)).scalar() > 0:
+        return
+
+    columns = ['kind', 'user_id', 'room_id']
+    connection.execute(changes.insert().from_select(columns,
+        select([literal(ChangeModel.USER_CREATED), users.c._id, null()]).order_by(users.c._id)
+    ))
+    connection.execute(changes.insert().from_select(columns,
+        select([literal(ChangeModel.ROOM_CREATED), rooms.c.admin_id, rooms.c._id]).order_by(rooms.c._id)
+    ))
+    connection.execute(changes.insert().from_select(columns,
+        select([literal(ChangeModel.MEMBER_JOINED), memberships.c.user_id, memberships.c.room_id])
+            .select_from(memberships.join(rooms, rooms.c._id == memberships.c.room_id))
+            .where(memberships.c.user_id != rooms.c.admin_id)
+            .order_by(memberships.c.room_id, memberships.c.user_id)
+    ))
+# -----------------
+
+
+# Migrations
+# ----------
+@migration(1, 'Create the users, rooms and messages tables')
+def create_base_tables(connection):
+    db.metadata.create_all(bind=connection, checkfirst=True,
+        tables=[UserModel.__table__, RoomModel.__table__, MessageModel.__table__]
+    )
+
+
+@migration(2, 'Index the messages by room and by sender, in the order in which they were sent')
+def create_message_indexes(connection):
+    # Serves the pages of the history of a room, and the versions of the
+    # history used to answer conditional requests.
+    create_index_if_missing(connection, MessageModel.__table__, 'ix_messages_room_id__id', 'room_id', '_id')
+    # Serves the messages of a sender, and replaces the index MySQL creates
+    # implicitly for the foreign key of the sender.
+    create_index_if_missing(connection, MessageModel.__table__, 'ix_messages_sender_id__id', 'sender_id', '_id')
+
+
+@migration(3, 'Create the id_blocks table of the id allocators')
+def create_id_blocks_table(connection):
+    IdBlockModel.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration(4, 'Create the full-text index of the bodies of the messages')
+def create_message_fulltext_index(connection):
+    # A FULLTEXT index on MySQL, an FTS5 table on SQLite, see search.py.
+    create_fulltext_index(connection, MessageModel.__table__)
+
+
+@migration(5, 'Create the memberships table and the member counts of the rooms')
+def create_memberships_table(connection):
+    memberships, rooms, messages = MembershipModel.__table__, RoomModel.__table__, MessageModel.__table__
+    memberships.create(bind=connection, checkfirst=True)
+    add_column_if_missing(connection, rooms, 'member_count')
+
+    # The members of the existing rooms are their admin and the users who
+    # sent messages to them (stored on the primary).
+    if connection.execute(select([func.count()]).select_from(memberships)).scalar() == 0:
+        connection.execute(memberships.insert().from_select(['room_id', 'user_id'], union(
+            select([rooms.c._id, rooms.c.admin_id]),
+            select([messages.c.room_id, messages.c.sender_id])
+        )))
+    connection.execute(rooms.update().values(member_count=select([func.count()])
+        .where(memberships.c.room_id == rooms.c._id)
+        .as_scalar()
+    ))
+
+
+@migration(6, 'Create the change log of the users, rooms and memberships')
+def create_changes_table(connection):
+    ChangeModel.__table__.create(bind=connection, checkfirst=True)
+    backfill_change_log(connection)
+
+
+@migration(7, 'Hash the passwords of the users')
+def hash_passwords(connection):
+    users = UserModel.__table__
+    if connection.dialect.name == 'mysql':
+        connection.execute('ALTER TABLE users MODIFY password VARCHAR(256) NOT NULL')
+
+    # The passwords stored before hashing was introduced are hashed by
+    # KDF_WORKERS threads, in batches read in the order of the ids.
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=KDF_WORKERS) as executor:
+        while True:
+            rows = connection.execute(select([users.c._id, users.c.password])
+                .where(users.c._id > last_id)
+                .order_by(users.c._id)
+                .limit(PASSWORD_BATCH_SIZE)
+            ).fetchall()
+            if not rows:
+                return
+
+            plaintext = [(user_id, password) for user_id, password in rows if not password_hasher.is_hash(password)]
+            hashes = executor.map(password_hasher.hash, [password for _, password in plaintext])
+            for (user_id, _), password_hash in zip(plaintext, hashes):
+                connection.execute(users.update().where(users.c._id == user_id).values(password=password_hash))
+            last_id = rows[-1][0]
+
+
+@migration(8, 'Add the session epoch of the users')
+def add_session_epoch(connection):
+    add_column_if_missing(connection, UserModel.__table__, 'session_epoch')
+
+
+@migration(9, 'Create the rate_limits table of the token buckets')
+def create_rate_limits_table(connection):
+    RateLimitModel.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration(10, 'Add the retention policies of the rooms and the archive of the messages')
+def create_message_archive(connection):
+    add_message_created_at(connection, MessageModel.__table__)
+    add_column_if_missing(connection, RoomModel.__table__, 'retention_days')
+    add_column_if_missing(connection, RoomModel.__table__, 'retention_messages')
+    ArchiveSegmentModel.__table__.create(bind=connection, checkfirst=True)
+
+
+@migration(11, 'Add the time at which the changes were logged')
+def add_change_created_at(connection):
+    # The changes logged before are left without a time, and are synced as
+    # settled ones.
+    add_column_if_missing(connection, ChangeModel.__table__, 'created_at')
+# ----------
+
+
+# Commands
+# --------
+def current_version(connection):
+    """Return the version of the last migration applied to the database,
+    or 0 if no migration was applied."""
+    schema_migrations.create(bind=connection, checkfirst=True)
+    return connection.execute(func.coalesce(func.max(schema_migrations.c.version), 0).select()).scalar()
+
+
+def upgrade(target=None):
+    """Apply all the pending migrations whose version is at most target (or
+    all of them, if no target is given), each in its own transaction.
+
+    When the messages are sharded, the messages table and its full-text index
+    are also created on the shards that don't have them yet, and the columns
+    added to the messages table since are added to the existing ones."""
+    with app.app_context():
+        with db.engine.begin() as connection:
+            version = current_version(connection)
+
+        for migration_version, name, function in MIGRATIONS:
+            if migration_version <= version or (target is not None and migration_version > target):
+                continue
+
+            print(f'Applying migration {migration_version}: {name}...')
+            with db.engine.begin() as connection:
+                function(connection)
+                connection.execute(schema_migrations.insert(),
+                    version=migration_version, name=name, applied_at=datetime.utcnow()
+                )
+            version = migration_version
+
+        print(f'The schema of the database is at version {version}.')
+
+        if message_shards is not None:
+            message_shards.create_tables()
+            for engine in message_shards.engines:
+                with engine.begin() as connection:
+                    create_fulltext_index(connection, message_shards.shard_table)
+                    add_message_created_at(connection, message_shards.shard_table)
+            print(f'The messages table exists on all the {len(message_shards.engines)} shards.')
+
+
+def endpoint_queries():
+    """Return the queries issued by the endpoints, by name, built with
+    sample parameters."""
+    return {
+        'GET /users/all': user_rows_query(),
+        'GET /users/all (version)': db.session.query(func.max(UserModel._id)),
+        'GET /users/{name}': UserModel._lookup_query().filter(UserModel.name == 'name'),
+        'GET /rooms/all': room_rows_query(),
+        'GET /rooms/all (version)': db.session.query(func.max(RoomModel._id)),
+        'GET /rooms/{name}': RoomModel._lookup_query().filter(RoomModel.name == 'name'),
+        'GET /messages/{room_name}': message_rows_query(1)
+            .order_by(MessageModel._id.desc()).limit(MESSAGES_PAGE_DEFAULT_LIMIT + 1),
+        'GET /messages/{room_name}?after_id': message_rows_query(1, after_id=1)
+            .order_by(MessageModel._id.asc()).limit(MESSAGES_PAGE_DEFAULT_LIMIT + 1),
+        'GET /messages/{room_name}?before_id': message_rows_query(1, before_id=1)
+            .order_by(MessageModel._id.desc()).limit(MESSAGES_PAGE_DEFAULT_LIMIT + 1),
+        'GET /messages/{room_name} (version)': db.session.query(func.min(MessageModel._id), func.max(MessageModel._id))
+            .filter(MessageModel.room_id == 1),
+        'GET /rooms/{name}/members': member_rows_query(1)
+            .order_by(MembershipModel.user_id.asc()).limit(MEMBERS_PAGE_DEFAULT_LIMIT + 1),
+        'GET /users/{name}/rooms': user_room_rows_query(1)
+            .order_by(MembershipModel.room_id.asc()).limit(MEMBERS_PAGE_DEFAULT_LIMIT + 1),
+        'GET /sync (settled)': db.session.query(ChangeModel._id, ChangeModel.created_at).filter(ChangeModel._id > 1)
+            .order_by(ChangeModel._id.desc()).limit(SYNC_SETTLED_BATCH_SIZE),
+        'GET /sync (changes)': db.session.query(ChangeModel._id, ChangeModel.kind, ChangeModel.user_id,
+            ChangeModel.room_id).filter(ChangeModel._id > 1, ChangeModel._id <= 2).order_by(ChangeModel._id.asc())
+            .limit(SYNC_DEFAULT_LIMIT + 1),
+        'GET /sync (messages)': sync_message_rows_query(db.session, [1, 2], 1, 2)
+            .order_by(MessageModel._id.asc()).limit(SYNC_DEFAULT_LIMIT + 1),
+        'POST /messages/bulk (names)': UserModel._lookup_query().filter(UserModel.name.in_(['name 1', 'name 2']))
+    }
+
+
+def explain():
+    """Print the plan chosen by the database for each query of the endpoints."""
+    with app.app_context():
+        dialect = db.engine.dialect
+        explain_prefix = 'EXPLAIN QUERY PLAN' if dialect.name == 'sqlite' else 'EXPLAIN'
+
+        for name, query in endpoint_queries().items():
+            statement = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+            result = db.session.execute(f'{explain_prefix} {statement}')
+
+            print(f'{name}\n{"-" * len(name)}\n{statement}\n')
+            print(' | '.join(result.keys()))
+            for row in result:
+                print(' | '.join(str(value) for value in row))
+            print()
+# --------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the schema of the TreeChat database.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    upgrade_parser = subparsers.add_parser('upgrade', help='Apply the pending migrations.')
+    upgrade_parser.add_argument('--to', type=int, help='Version of the last migration to apply.')
+    subparsers.add_parser('current', help='Print the version of the schema.')
+    subparsers.add_parser('explain', help='Print the plans of the queries of the endpoints.')
+    args = parser.parse_args()
+
+    if args.command == 'upgrade':
+        upgrade(args.to)
+    elif args.command == 'current':
+        with app.app_context(), db.engine.begin() as connection:
+            print(current_version(connection))
+    elif args.command == 'explain':
+        explain()
@@ -0,0 +1,155 @@
+"""Configuration and monitoring of the pools of connections to the database.
+
+The pools are configured with the following environment variables:
+    DB_POOL_SIZE         - Connections kept open in the pool (default: 10).
+    DB_MAX_OVERFLOW      - Connections opened on top of the pool under bursts (default: 10).
+    DB_POOL_TIMEOUT      - Seconds to wait for a free connection before failing (default: 10).
+    DB_POOL_RECYCLE      - Seconds after which a connection is reopened (default: 1800).
+    DB_POOL_PRE_PING     - Test connections before using them (default: true).
+    DB_CONNECT_TIMEOUT   - Seconds to wait while opening a connection (default: 10).
+    DB_STATEMENT_TIMEOUT - Milliseconds after which MySQL aborts a SELECT (default: 0, no timeout).
+"""
+import os
+import threading
+import time
+
+import flask_sqlalchemy
+import sqlalchemy
+from sqlalchemy import event, exc
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+
+
+class PoolConfig:
+    """Settings of the pools of connections, read from the environment."""
+
+    def __init__(self, environ=os.environ):
+        self.pool_size = int(environ.get('DB_POOL_SIZE', 10))
+        self.max_overflow = int(environ.get('DB_MAX_OVERFLOW', 10))
+        self.pool_timeout = float(environ.get('DB_POOL_TIMEOUT', 10))
+        self.pool_recycle = int(environ.get('DB_POOL_RECYCLE', 1800))
+        self.pool_pre_ping = environ.get('DB_POOL_PRE_PING', 'true').strip().lower() in ('1', 'true', 'yes', 'on')
+        self.connect_timeout = int(environ.get('DB_CONNECT_TIMEOUT', 10))
+        self.statement_timeout = int(environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool also recording how long the checkouts waited for a free
+    connection, and how many of them timed out."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    def _do_get(self):
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.checkout_timeouts += 1
+            raise
+        finally:
+            wait_time = time.perf_counter() - started_at
+            with self._stats_lock:
+                self.checkouts += 1
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+
+
+def engine_options(uri, config=None):
+    """Return the keyword arguments of create_engine() configuring the pool
+    of connections to the database at the given URI, according to config
+    (or to the environment, if no config is given)."""
+    config = config or PoolConfig()
+    url = make_url(str(uri))
+
+    # In-memory SQLite databases live in a single connection.
+    if url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:'):
+        return {}
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config.pool_size,
+        'max_overflow': config.max_overflow,
+        'pool_timeout': config.pool_timeout,
+        'pool_recycle': config.pool_recycle,
+        'pool_pre_ping': config.pool_pre_ping
+    }
+
+    if url.drivername == 'mysql+mysqlconnector':
+        options['connect_args'] = {'connection_timeout': config.connect_timeout}
+    elif url.drivername.startswith('mysql'):
+        options['connect_args'] = {'connect_timeout': config.connect_timeout}
+    elif url.drivername.startswith('sqlite'):
+        # Connections are shared by the threads of the pool.
+        options['connect_args'] = {'timeout': config.connect_timeout, 'check_same_thread': False}
+
+    return options
+
+
+def configure_engine(engine, config=None):
+    """Set up the session of every new connection of the engine, i.e. the
+    statement timeout of MySQL connections, and return the engine."""
+    config = config or PoolConfig()
+
+    if engine.dialect.name == 'mysql' and config.statement_timeout > 0:
+        @event.listens_for(engine, 'connect')
+        def set_statement_timeout(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f'SET SESSION MAX_EXECUTION_TIME = {config.statement_timeout}')
+            cursor.close()
+
+    return engine
+
+
+def create_engine(uri, config=None):
+    """Create an engine for the database at the given URI, with its pool of
+    connections configured like the one of the Flask app."""
+    return configure_engine(sqlalchemy.create_engine(uri, **engine_options(uri, config)), config)
+
+
+def pool_stats(engine):
+    """Return the statistics of the pool of connections of the engine as a dict."""
+    pool = engine.pool
+    stats = {'pool_class': type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        stats.update({
+            'size': pool.size(),
+            'checked_in': pool.checkedin(),
+            'checked_out': pool.checkedout(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+            'timeout': pool.timeout()
+        })
+    if isinstance(pool, InstrumentedQueuePool):
+        with pool._stats_lock:
+            stats.update({
+                'checkouts': pool.checkouts,
+                'checkout_timeouts': pool.checkout_timeouts,
+                'wait_time_total': round(pool.wait_time_total, 6),
+                'wait_time_max': round(pool.wait_time_max, 6),
+                'wait_time_avg': round(pool.wait_time_total / pool.checkouts, 6) if pool.checkouts else 0.0
+            })
+
+    return stats
+
+
+class PooledSQLAlchemy(flask_sqlalchemy.SQLAlchemy):
+    """Flask-SQLAlchemy extension creating its engines with pools of
+    connections configured from the environment."""
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        # Set before the defaults of Flask-SQLAlchemy, which don't override them.
+        for key, value in engine_options(sa_url).items():
+            options.setdefault(key, value)
+
+        return super().apply_driver_hacks(app, sa_url, options)
+
+    def create_engine(self, sa_url, engine_opts):
+        return configure_engine(super().create_engine(sa_url, engine_opts))
@@ -0,0 +1,187 @@
+"""Rate limiting of the requests with token buckets.
+
+Every limited key (a client, the sender of messages or a room) has a bucket
+of tokens, which holds at most burst tokens and is refilled with rate tokens
+per second. A request takes cost tokens from each bucket it is limited by,
+and is rejected if a bucket holds fewer, along with the number of seconds
+after which the bucket will hold enough of them.
+
+The buckets are kept by a backend:
+    memory   - Buckets held by the process, at most max_keys of them, the
+               least recently used ones being dropped first. Each process
+               serving the API limits the requests it serves on its own.
+    database - Buckets stored in a table of a database shared by the
+               processes, e.g. the 'rate_limits' table of the primary, which
+               limit the requests served by all of them together. Costs a
+               round trip per bucket, and is meant for deployments of a few
+               processes, or as a local stand-in of a shared store.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+# Rate (in tokens per second) and burst (in tokens) of the buckets of a scope.
+Limit = namedtuple('Limit', ['rate', 'burst'])
+
+# Number of times the database backend retries taking tokens from a bucket
+# that was updated concurrently by another process.
+DATABASE_RETRIES = 5
+
+
+def refill(tokens, updated_at, now, limit):
+    """Return the number of tokens of a bucket holding the given tokens at
+    updated_at, once refilled at the given time."""
+    return min(limit.burst, tokens + (now - updated_at) * limit.rate)
+
+
+def take(tokens, cost, limit):
+    """Return the tokens left in a bucket once cost tokens are taken from the
+    given ones, and the number of seconds to wait before retrying if the
+    bucket doesn't hold enough of them (else 0, in which case they're taken).
+
+    A cost larger than the burst is capped to it, so that the largest requests
+    get through once the bucket is full rather than never.
+    """
+    cost = min(cost, limit.burst)
+    if tokens >= cost:
+        return tokens - cost, 0.0
+
+    return tokens, (cost - tokens) / limit.rate
+
+
+class MemoryBackend:
+    """Thread-safe token buckets held by the process."""
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, key, cost, limit):
+        """Take cost tokens from the bucket of the given key, and return the
+        number of seconds to wait before retrying if it doesn't hold enough
+        of them, else 0."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                tokens = limit.burst
+                if len(self._buckets) >= self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                tokens = refill(bucket[0], bucket[1], now, limit)
+                self._buckets.move_to_end(key)
+
+            tokens, retry_after = take(tokens, cost, limit)
+            self._buckets[key] = (tokens, now)
+
+        return retry_after
+
+    def size(self):
+        """Return the number of buckets held by the backend."""
+        with self._lock:
+            return len(self._buckets)
+
+
+class DatabaseBackend:
+    """Token buckets stored in a table of a database, with a 'key' string
+    primary key, and 'tokens' and 'updated_at' float columns.
+
+    Buckets are updated with a compare-and-set on their updated_at column,
+    which is retried when another process updated the bucket concurrently,
+    so no lock is held across the round trips.
+    """
+
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+
+    def consume(self, key, cost, limit):
+        """Take cost tokens from the bucket of the given key, and return the
+        number of seconds to wait before retrying if it doesn't hold enough
+        of them, else 0."""
+        table = self.table
+        with self.db.engine.connect() as connection:
+            for _ in range(DATABASE_RETRIES):
+                now = time.time()
+                bucket = connection.execute(
+                    select([table.c.tokens, table.c.updated_at]).where(table.c.key == key)
+                ).first()
+
+                if bucket is None:
+                    tokens, retry_after = take(limit.burst, cost, limit)
+                    try:
+                        connection.execute(table.insert(), key=key, tokens=tokens, updated_at=now)
+                    except IntegrityError:
+                        continue
+                    return retry_after
+
+                tokens, retry_after = take(refill(bucket.tokens, bucket.updated_at, now, limit), cost, limit)
+                updated = connection.execute(
+                    table.update()
+                        .where(table.c.key == key)
+                        .where(table.c.updated_at == bucket.updated_at)
+                        .values(tokens=tokens, updated_at=now)
+                ).rowcount
+                if updated:
+                    return retry_after
+
+        # The bucket is updated so often that the limit is surely exceeded.
+        return cost / limit.rate
+
+    def size(self):
+        """Return the number of buckets stored in the table."""
+        with self.db.engine.connect() as connection:
+            return connection.execute(select([func.count()]).select_from(self.table)).scalar()
+
+
+class RateLimiter:
+    """Limits the requests of each scope (e.g. 'client', 'sender' or 'room')
+    with the token buckets of the given backend, with the Limit of the scope
+    given in limits. Keys of the scopes without a limit aren't limited.
+
+    Counts the requests allowed and limited in each scope, which are reported
+    by stats().
+    """
+
+    def __init__(self, backend, limits, enabled=True):
+        self.backend = backend
+        self.limits = dict(limits)
+        self.enabled = enabled
+        self._allowed = dict.fromkeys(self.limits, 0)
+        self._limited = dict.fromkeys(self.limits, 0)
+        self._lock = threading.Lock()
+
+    def hit(self, scope, key, cost=1):
+        """Take cost tokens from the bucket of the given key of a scope, and
+        return the number of seconds to wait before retrying if the request
+        is limited, else 0."""
+        limit = self.limits.get(scope)
+        if not self.enabled or limit is None:
+            return 0.0
+
+        retry_after = self.backend.consume(f'{scope}:{key}', cost, limit)
+        with self._lock:
+            if retry_after:
+                self._limited[scope] += 1
+            else:
+                self._allowed[scope] += 1
+
+        return retry_after
+
+    def stats(self):
+        """Return the limit of each scope, along with the number of requests
+        allowed and limited in it so far, as a dict."""
+        with self._lock:
+            return {
+                scope: {
+                    'rate': limit.rate,
+                    'burst': limit.burst,
+                    'allowed': self._allowed[scope],
+                    'limited': self._limited[scope]
+                }
+                for scope, limit in self.limits.items()
+            }
@@ -0,0 +1,260 @@
+"""Retention of the messages of the rooms.
+
+Every room may keep its messages for a number of days, and/or keep a number
+of its most recent messages, and defaults to the policy given by the
+RETENTION_DAYS and RETENTION_MESSAGES environment variables (0 keeping the
+messages forever). The messages expired by the policy of a room are moved
+out of the messages table into the archive of the room, see archive.py, by a
+RetentionJob, in batches of consecutive messages:
+    1. The expired messages of a batch are read in the order of their ids,
+       from the end of the archive of the room on, stopping at the first
+       message which isn't expired.
+    2. They are written into a new segment, which is listed in the
+       archive_segments table of the primary.
+    3. They are deleted from the messages table of the database holding the
+       messages of the room (its shard, or else the primary).
+If a run is interrupted between 2. and 3., the messages of the last segment
+of the room are deleted by the next run. A segment listed concurrently by
+another run fails to be listed on a unique index, in which case the run
+removes its file and leaves the room to the other run. Only the messages
+written to a segment are deleted, so a message committed with an id lower
+than the archived ones after they were read (e.g. by concurrent transactions
+taking ids from the auto-increment of the table) stays in the messages table.
+
+The job runs every interval seconds in a background thread of the processes
+serving the API, or once from the command line:
+
+    $ python retention.py run       # Archive the expired messages of all the rooms.
+    $ python retention.py status    # Print the policy and the archive of every room.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionJob:
+    """Archives the expired messages of the rooms into the given
+    MessageArchive, batch_size messages at a time.
+
+    rooms, messages and users are the tables of the primary, the rooms having
+    the nullable retention_days and retention_messages columns, which default
+    to default_days and default_messages. message_engine(room_id) returns the
+    engine of the database holding the messages of a room.
+    """
+
+    def __init__(self, app, db, archive, rooms, messages, users, message_engine, default_days=0,
+            default_messages=0, batch_size=1000, interval=0):
+        self.app = app
+        self.db = db
+        self.archive = archive
+        self.rooms = rooms
+        self.messages = messages
+        self.users = users
+        self.message_engine = message_engine
+        self.default_days = default_days
+        self.default_messages = default_messages
+        self.batch_size = batch_size
+        self.interval = interval
+        self._thread = None
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.archived = 0
+        self.segments = 0
+        self.failed = 0
+        self.last_run_at = None
+
+    def policy(self, room):
+        """Return the number of days and the number of messages kept by the
+        given row of a room, 0 keeping its messages forever."""
+        days = self.default_days if room.retention_days is None else room.retention_days
+        messages = self.default_messages if room.retention_messages is None else room.retention_messages
+        return days, messages
+
+    def start(self):
+        """Start running the job every interval seconds in a background
+        thread, unless it already runs or no interval is set."""
+        if self.interval <= 0 or self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='retention', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.run()
+            except Exception:
+                logger.exception('Failed to archive the expired messages.')
+                with self._lock:
+                    self.failed += 1
+
+    def run(self):
+        """Archive the expired messages of every room, and return the number
+        of archived messages."""
+        rooms = self.rooms
+        archived = 0
+        with self.app.app_context():
+            with self.db.engine.connect() as connection:
+                room_rows = connection.execute(
+                    select([rooms.c._id, rooms.c.retention_days, rooms.c.retention_messages]).order_by(rooms.c._id)
+                ).fetchall()
+
+            for room in room_rows:
+                days, messages = self.policy(room)
+                if days or messages:
+                    archived += self.archive_room(room._id, days, messages)
+
+        with self._lock:
+            self.runs += 1
+            self.last_run_at = time.time()
+
+        return archived
+
+    def archive_room(self, room_id, days=0, messages=0):
+        """Archive the messages of the room with the given id sent more than
+        days ago, or older than its most recent messages, and return the number
+        of archived messages."""
+        table = self.messages
+        with self.db.engine.connect() as primary:
+            archived_through = self.archive.last_archived_id(primary, room_id)
+            last_segments = self.archive.segments(primary, room_id, after_id=archived_through - 1) \
+                if archived_through else []
+
+        archived = 0
+        with self.message_engine(room_id).connect() as connection:
+            # Messages left behind by an interrupted run.
+            for segment in last_segments:
+                left_behind = connection.execute(
+                    select([table.c._id])
+                        .where(table.c.room_id == room_id)
+                        .where(table.c._id.between(segment.first_id, segment.last_id))
+                        .limit(1)
+                ).scalar()
+                if left_behind is not None:
+                    ids = [message._id for message in self.archive.read_segment(segment.path)]
+                    connection.execute(table.delete().where(table.c.room_id == room_id).where(table.c._id.in_(ids)))
+
+            cutoff_id = connection.execute(
+                select([table.c._id])
+                    .where(table.c.room_id == room_id)
+                    .order_by(table.c._id.desc())
+                    .offset(messages)
+                    .limit(1)
+            ).scalar() if messages else None
+            cutoff_time = datetime.utcnow() - timedelta(days=days) if days else None
+
+            while True:
+                rows = connection.execute(
+                    select([table.c._id, table.c.body, table.c.sender_id, table.c.created_at])
+                        .where(table.c.room_id == room_id)
+                        .where(table.c._id > archived_through)
+                        .order_by(table.c._id)
+                        .limit(self.batch_size)
+                ).fetchall()
+
+                expired = []
+                for row in rows:
+                    if not ((cutoff_id is not None and row._id <= cutoff_id)
+                            or (cutoff_time is not None and row.created_at is not None and row.created_at < cutoff_time)):
+                        break
+                    expired.append(row)
+                if not expired:
+                    break
+
+                if not self._archive_batch(connection, room_id, expired):
+                    break
+                archived += len(expired)
+                archived_through = expired[-1]._id
+
+                if len(expired) < self.batch_size:
+                    break
+
+        return archived
+
+    def _archive_batch(self, connection, room_id, rows):
+        """Write the given rows of messages of a room into a new segment, list
+        it, and delete them from the messages table. Return False if another
+        run archived them first."""
+        users, table = self.users, self.messages
+        with self.db.engine.connect() as primary:
+            sender_names = dict(primary.execute(
+                select([users.c._id, users.c.name]).where(users.c._id.in_({row.sender_id for row in rows}))
+            ).fetchall())
+
+        path = self.archive.write_segment(room_id, [{
+            '_id': row._id,
+            'body': row.body,
+            'sender_id': row.sender_id,
+            'sender_name': sender_names.get(row.sender_id),
+            'created_at': row.created_at.isoformat() if row.created_at is not None else None
+        } for row in rows])
+
+        first_id, last_id = rows[0]._id, rows[-1]._id
+        try:
+            with self.db.engine.begin() as primary:
+                primary.execute(self.archive.table.insert(), room_id=room_id, first_id=first_id, last_id=last_id,
+                    message_count=len(rows), path=path, archived_at=datetime.utcnow()
+                )
+        except IntegrityError:
+            self.archive.remove_segment(path)
+            return False
+
+        # Only the archived rows are deleted, not a row committed between
+        # them since they were read, which stays in the messages table.
+        connection.execute(table.delete()
+            .where(table.c.room_id == room_id)
+            .where(table.c._id.in_([row._id for row in rows]))
+        )
+        with self._lock:
+            self.archived += len(rows)
+            self.segments += 1
+
+        return True
+
+    def stats(self):
+        """Return the default policy, along with the number of runs, of
+        archived messages and segments, and of failed runs so far, as a dict."""
+        with self._lock:
+            return {
+                'default_days': self.default_days,
+                'default_messages': self.default_messages,
+                'interval': self.interval,
+                'runs': self.runs,
+                'archived': self.archived,
+                'segments': self.segments,
+                'failed': self.failed,
+                'last_run_at': self.last_run_at
+            }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from main import app, db, message_archive, retention_job, RoomModel
+
+    parser = argparse.ArgumentParser(description='Archive the expired messages of the TreeChat rooms.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('run', help='Archive the expired messages of all the rooms.')
+    subparsers.add_parser('status', help='Print the policy and the archive of every room.')
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        print(f'Archived {retention_job.run()} messages.')
+    elif args.command == 'status':
+        with app.app_context(), db.engine.connect() as connection:
+            rooms = RoomModel.__table__
+            for room in connection.execute(select([rooms.c._id, rooms.c.name, rooms.c.retention_days,
+                    rooms.c.retention_messages]).order_by(rooms.c._id)):
+                days, messages = retention_job.policy(room)
+                stats = message_archive.stats(connection, room._id)
+                print(f'{room.name}: keep {days or "all"} days, {messages or "all"} messages, '
+                    f'{stats["archived_messages"]} archived in {stats["segments"]} segments')
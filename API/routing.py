@@ -0,0 +1,182 @@
+"""Routing of the read-only requests to read replicas of the database.
+
+GET and HEAD requests are served by one of the replicas, unless their
+endpoint must read the primary (e.g. long-poll requests, which must see the
+messages as soon as they're committed). All other requests use the primary.
+
+The replication lag of every replica is measured by comparing watermarks:
+every check_interval seconds, the watermark of the primary (e.g. the largest
+id of every table) is sampled, and a replica is synced up to the time of the
+latest sample whose watermark it has reached. A replica is only used if it is
+synced up to at most max_lag seconds ago, so requests fall back to the
+primary when every replica lags, or can't be reached.
+
+Clients read their own writes: after a client makes a successful write
+request, its reads are only routed to the replicas synced up to the time of
+the write. Clients are identified by their X-Client-ID header, or else by
+their address.
+"""
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+from flask import g, has_app_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import orm
+
+from cache import LRUCache
+from pool import PooledSQLAlchemy, create_engine, pool_stats
+
+logger = logging.getLogger(__name__)
+
+# Methods of the requests which may be served by a replica.
+READ_METHODS = ('GET', 'HEAD')
+
+
+class RoutingSession(SignallingSession):
+    """Session executing its queries on the replica picked for the current
+    request, if any, and on the primary otherwise."""
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('_db_replica') if has_app_context() else None
+        if replica is not None:
+            return replica.engine
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(PooledSQLAlchemy):
+    """Flask-SQLAlchemy extension whose sessions are RoutingSessions."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class Replica:
+    """A read replica, along with the time up to which it is synced."""
+
+    def __init__(self, name, uri):
+        self.name = name
+        self.engine = create_engine(uri)
+        self.synced_at = None
+        self.error = None
+
+    def lag(self, now):
+        return None if self.synced_at is None else max(now - self.synced_at, 0.0)
+
+
+class ReplicaRouter:
+    """Flask extension picking the replica serving each request, if any.
+
+    watermark is a function returning a tuple of numbers that never decrease
+    as data is written, read with the connection it is given.
+    primary_endpoints are the endpoints whose requests are always served
+    by the primary.
+    """
+
+    def __init__(self, app=None, db=None, uris=(), watermark=None, max_lag=5.0, check_interval=1.0,
+            primary_endpoints=(), max_clients=10000):
+        self.db = db
+        self.replicas = [Replica(f'replica_{index}', uri) for index, uri in enumerate(uris, start=1)]
+        self.watermark = watermark
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.primary_endpoints = set(primary_endpoints)
+        # Time of the last write of each client, forgotten once any replica
+        # allowed to serve requests is synced past it.
+        self.last_writes = LRUCache(maxsize=max_clients, ttl=max_lag)
+        self._samples = deque(maxlen=int(max_lag / check_interval) + 2)
+        self._last_check = 0.0
+        self._check_lock = threading.Lock()
+        self._next_replica = itertools.count()
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        if self.replicas:
+            app.before_request(self._route_request)
+            app.after_request(self._record_write)
+
+    @staticmethod
+    def client_id():
+        return request.headers.get('X-Client-ID') or request.remote_addr
+
+    def _route_request(self):
+        if request.method in READ_METHODS and request.endpoint not in self.primary_endpoints:
+            g._db_replica = self.choose(self.last_writes.get(self.client_id(), 0.0))
+
+    def _record_write(self, response):
+        if request.method not in READ_METHODS and response.status_code < 400:
+            self.last_writes.set(self.client_id(), time.time())
+
+        return response
+
+    def choose(self, written_at=0.0):
+        """Return a replica synced up to at most max_lag seconds ago and after
+        written_at, or None if the request must be served by the primary."""
+        self.check()
+
+        now = time.time()
+        eligible = [
+            replica for replica in self.replicas
+            if replica.synced_at is not None and now - replica.synced_at <= self.max_lag
+                and replica.synced_at >= written_at
+        ]
+        if not eligible:
+            return None
+
+        return eligible[next(self._next_replica) % len(eligible)]
+
+    def check(self, force=False):
+        """Sample the watermark of the primary and measure the lag of every
+        replica, unless they were measured less than check_interval seconds
+        ago. Only one thread measures them at a time, while the others keep
+        using the previous measures."""
+        if not self.replicas or not force and time.time() - self._last_check < self.check_interval:
+            return
+        if not self._check_lock.acquire(blocking=False):
+            return
+
+        try:
+            sampled_at = time.time()
+            with self.db.engine.connect() as connection:
+                self._samples.append((sampled_at, tuple(self.watermark(connection))))
+
+            for replica in self.replicas:
+                try:
+                    with replica.engine.connect() as connection:
+                        replica_watermark = tuple(self.watermark(connection))
+                except Exception as error:
+                    logger.warning('Failed to read the watermark of %s: %s', replica.name, error)
+                    replica.synced_at, replica.error = None, str(getattr(error, 'orig', error))
+                    continue
+
+                replica.error = None
+                for sample_time, sample_watermark in reversed(self._samples):
+                    if all(r >= p for r, p in zip(replica_watermark, sample_watermark)):
+                        replica.synced_at = max(replica.synced_at or 0.0, sample_time)
+                        break
+        except Exception as error:
+            logger.warning('Failed to read the watermark of the primary: %s', error)
+        finally:
+            self._last_check = time.time()
+            self._check_lock.release()
+
+    def stats(self):
+        """Return the lag (in seconds) and the health of every replica as a dict."""
+        now = time.time()
+        return {
+            replica.name: {
+                'lag': None if replica.lag(now) is None else round(replica.lag(now), 3),
+                'healthy': replica.synced_at is not None and now - replica.synced_at <= self.max_lag,
+                'error': replica.error
+            }
+            for replica in self.replicas
+        }
+
+    def pool_stats(self):
+        """Return the statistics of the pools of connections of the replicas."""
+        return {replica.name: pool_stats(replica.engine) for replica in self.replicas}
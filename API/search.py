@@ -0,0 +1,342 @@
+"""Full-text search over the bodies of the messages.
+
+Searches are answered from an inverted index of the bodies, picked for each
+database holding messages (the primary, a replica or a shard) among:
+    fulltext - The full-text index of the database: a FULLTEXT index on
+               MySQL, or an FTS5 table kept in sync by triggers on SQLite.
+               Created by the migrations in migrations.py.
+    memory   - An inverted index held by the process, which is filled from
+               the messages table on first use, then incrementally with the
+               messages inserted after the last indexed id. Every process
+               holds a copy of the whole index, so it is meant for development
+               databases, e.g. SQLite without FTS5, not for production.
+By default (SEARCH_BACKEND=auto), the full-text index of the database is used
+if it exists. Otherwise, the index held by the process is used for SQLite
+databases, and other databases must have their full-text index created by
+the migrations, unless SEARCH_BACKEND is set to memory.
+
+A search matches the messages whose body holds every term of the query, and
+ranks them by relevance (BM25 on SQLite and in memory, the relevance of
+InnoDB on MySQL), the most recent first among equally relevant messages.
+Terms are the runs of letters and digits of the query, compared without case.
+MySQL ignores the terms shorter than innodb_ft_min_token_size and its
+stopwords.
+"""
+import heapq
+import math
+import re
+import threading
+from collections import defaultdict
+
+from sqlalchemy import Index, event, inspect, select, text
+from sqlalchemy.exc import OperationalError
+
+# Runs of letters and digits, which are the terms of the bodies and queries.
+TOKEN_PATTERN = re.compile(r'\w+')
+
+# Names of the full-text indexes created on the messages table.
+FULLTEXT_INDEX_NAME = 'ft_messages_body'
+FTS_TABLE_NAME = 'messages_fts'
+
+# Parameters of the BM25 ranking of the index held by the process, which are
+# the same as the ones of FTS5.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Number of messages read from the database at a time while filling the index
+# held by the process.
+INDEX_BATCH_SIZE = 10000
+
+
+def tokenize(text_value):
+    """Return the list of the terms of the given text."""
+    return TOKEN_PATTERN.findall(text_value.lower())
+
+
+def fts5_available(connection):
+    """Return True if the SQLite library of the connection has FTS5."""
+    try:
+        connection.execute('CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(body)')
+    except OperationalError:
+        return False
+
+    connection.execute('DROP TABLE temp.fts5_probe')
+    return True
+
+
+def create_fulltext_index(connection, table):
+    """Create the full-text index of the bodies of the given messages table,
+    unless it already exists or the database doesn't support one."""
+    dialect = connection.dialect.name
+
+    if dialect == 'mysql':
+        if FULLTEXT_INDEX_NAME not in {index['name'] for index in inspect(connection).get_indexes(table.name)}:
+            Index(FULLTEXT_INDEX_NAME, table.c.body, mysql_prefix='FULLTEXT').create(bind=connection)
+    elif dialect == 'sqlite' and fts5_available(connection) \
+            and FTS_TABLE_NAME not in inspect(connection).get_table_names():
+        # External content table, which indexes the bodies without storing
+        # them twice, kept in sync with the messages table by triggers.
+        connection.execute(f"CREATE VIRTUAL TABLE {FTS_TABLE_NAME} USING fts5("
+            f"body, content='{table.name}', content_rowid='_id')")
+        connection.execute(f"CREATE TRIGGER {FTS_TABLE_NAME}_insert AFTER INSERT ON {table.name} BEGIN "
+            f"INSERT INTO {FTS_TABLE_NAME} (rowid, body) VALUES (new._id, new.body); END")
+        connection.execute(f"CREATE TRIGGER {FTS_TABLE_NAME}_delete AFTER DELETE ON {table.name} BEGIN "
+            f"INSERT INTO {FTS_TABLE_NAME} ({FTS_TABLE_NAME}, rowid, body) VALUES ('delete', old._id, old.body); END")
+        connection.execute(f"CREATE TRIGGER {FTS_TABLE_NAME}_update AFTER UPDATE OF body ON {table.name} BEGIN "
+            f"INSERT INTO {FTS_TABLE_NAME} ({FTS_TABLE_NAME}, rowid, body) VALUES ('delete', old._id, old.body); "
+            f"INSERT INTO {FTS_TABLE_NAME} (rowid, body) VALUES (new._id, new.body); END")
+        connection.execute(f"INSERT INTO {FTS_TABLE_NAME} ({FTS_TABLE_NAME}) VALUES ('rebuild')")
+
+
+def drop_fulltext_index(connection, table):
+    """Drop the full-text index of the bodies of the given messages table, if
+    it exists, e.g. along with the table, or before loading many messages at
+    once, after which it is rebuilt by create_fulltext_index()."""
+    dialect = connection.dialect.name
+
+    if dialect == 'mysql':
+        if FULLTEXT_INDEX_NAME in {index['name'] for index in inspect(connection).get_indexes(table.name)}:
+            connection.execute(f'ALTER TABLE {table.name} DROP INDEX {FULLTEXT_INDEX_NAME}')
+    elif dialect == 'sqlite':
+        for trigger in ('insert', 'delete', 'update'):
+            connection.execute(f'DROP TRIGGER IF EXISTS {FTS_TABLE_NAME}_{trigger}')
+        connection.execute(f'DROP TABLE IF EXISTS {FTS_TABLE_NAME}')
+
+
+def maintain_fulltext_index(table):
+    """Create the full-text index of the given messages table along with it,
+    and drop it along with it, e.g. by db.create_all() and db.drop_all()."""
+    event.listen(table, 'after_create', lambda target, connection, **kwargs: create_fulltext_index(connection, target))
+    event.listen(table, 'before_drop', lambda target, connection, **kwargs: drop_fulltext_index(connection, target))
+
+
+def has_fulltext_index(connection, table):
+    """Return True if the full-text index of the given messages table exists."""
+    dialect = connection.dialect.name
+
+    if dialect == 'mysql':
+        return FULLTEXT_INDEX_NAME in {index['name'] for index in inspect(connection).get_indexes(table.name)}
+    if dialect == 'sqlite':
+        return FTS_TABLE_NAME in inspect(connection).get_table_names()
+    return False
+
+
+class InvertedIndex:
+    """Thread-safe inverted index of the bodies of the messages of a database,
+    held by the process, mapping every term to the number of times it appears
+    in each message holding it.
+
+    Messages are indexed in the order of their ids, so a message committed
+    with an id lower than the last indexed id (e.g. by concurrent transactions
+    taking ids from the auto-increment of the table) is only found once the
+    index is rebuilt. The hits of a search are checked against the messages
+    table, and the messages which were archived or deleted since they were
+    indexed are dropped from the index.
+
+    Only refreshing and updating the index is done under a lock, searches
+    score the messages without holding it.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.postings = defaultdict(dict)
+        self.lengths = {}
+        self.rooms = {}
+        self.total_length = 0
+        self.last_id = 0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def add(self, message_id, body, room_id):
+        terms = tokenize(body)
+        for term in terms:
+            postings = self.postings[term]
+            postings[message_id] = postings.get(message_id, 0) + 1
+        self.lengths[message_id] = len(terms)
+        self.rooms[message_id] = room_id
+        self.total_length += len(terms)
+        self.last_id = max(self.last_id, message_id)
+
+    def discard(self, message_ids, terms):
+        """Drop the messages with the given ids, which were found by a search
+        of the given terms, from the index. They are left in the postings of
+        the other terms, where they are skipped as they have no length."""
+        with self._lock:
+            for message_id in message_ids:
+                length = self.lengths.pop(message_id, None)
+                if length is not None:
+                    self.total_length -= length
+                self.rooms.pop(message_id, None)
+                for term in terms:
+                    self.postings.get(term, {}).pop(message_id, None)
+
+    def refresh(self, connection):
+        """Index the messages inserted after the last indexed message, unless
+        another thread is already refreshing the index."""
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+
+        table = self.table
+        try:
+            while True:
+                rows = connection.execute(
+                    select([table.c._id, table.c.body, table.c.room_id])
+                        .where(table.c._id > self.last_id)
+                        .order_by(table.c._id)
+                        .limit(INDEX_BATCH_SIZE)
+                ).fetchall()
+                with self._lock:
+                    for message_id, body, room_id in rows:
+                        self.add(message_id, body, room_id)
+
+                if len(rows) < INDEX_BATCH_SIZE:
+                    return
+        finally:
+            self._refresh_lock.release()
+
+    def live_ids(self, connection, message_ids):
+        """Return the set of the given ids of messages which are still in the
+        messages table."""
+        table = self.table
+        return {message_id for message_id, in connection.execute(
+            select([table.c._id]).where(table.c._id.in_(message_ids))
+        )}
+
+    def search(self, connection, terms, room_id=None, limit=20, offset=0):
+        self.refresh(connection)
+
+        terms = set(terms)
+        with self._lock:
+            postings = sorted((self.postings.get(term, {}) for term in terms), key=len)
+            if not postings or not postings[0]:
+                return []
+
+            # The postings of the other terms are only looked up, which is
+            # safe while they are updated, while the ones iterated are copied.
+            candidates = list(postings[0])
+            count = len(self.lengths)
+            total_length = self.total_length
+        if not count:
+            return []
+
+        average_length = total_length / count
+        weights = [math.log(1 + (count - len(term_postings) + 0.5) / (len(term_postings) + 0.5))
+            for term_postings in postings]
+
+        scores = []
+        for message_id in candidates:
+            length = self.lengths.get(message_id)
+            if length is None or (room_id is not None and self.rooms.get(message_id) != room_id):
+                continue
+            frequencies = [term_postings.get(message_id) for term_postings in postings]
+            if not all(frequencies):
+                continue
+
+            length_norm = BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            score = sum(
+                weight * frequency * (BM25_K1 + 1) / (frequency + length_norm)
+                for weight, frequency in zip(weights, frequencies)
+            )
+            scores.append((score, message_id))
+
+        # The most relevant messages are checked against the messages table,
+        # and the ones missing from it are replaced by the next most relevant.
+        checked, missing = set(), set()
+        while True:
+            top = heapq.nlargest(offset + limit + len(missing), scores)
+            unchecked = [message_id for _, message_id in top if message_id not in checked]
+            if unchecked:
+                missing.update(set(unchecked) - self.live_ids(connection, unchecked))
+                checked.update(unchecked)
+
+            hits = [(message_id, score) for score, message_id in top if message_id not in missing]
+            if len(hits) >= offset + limit or len(top) == len(scores):
+                break
+
+        if missing:
+            self.discard(missing, terms)
+
+        return hits[offset:]
+
+
+class MessageSearchIndex:
+    """Searches the messages of the databases holding them, with the backend
+    configured by SEARCH_BACKEND ('auto', 'fulltext' or 'memory').
+
+    The backend of each database is picked on its first search, and the
+    indexes held by the process are kept by database.
+    """
+
+    def __init__(self, table, backend='auto'):
+        if backend not in ('auto', 'fulltext', 'memory'):
+            raise ValueError(f'Unknown SEARCH_BACKEND: {backend}')
+
+        self.table = table
+        self.backend = backend
+        self._backends = {}
+        self._memory_indexes = {}
+        self._lock = threading.Lock()
+
+    def backend_of(self, connection):
+        """Return the backend used to search the database of the connection."""
+        key = str(connection.engine.url)
+        if key not in self._backends:
+            backend = self.backend
+            if backend == 'auto':
+                backend = 'fulltext' if has_fulltext_index(connection, self.table) \
+                    or connection.dialect.name != 'sqlite' else 'memory'
+            if backend == 'fulltext' and not has_fulltext_index(connection, self.table):
+                raise ValueError(f'The messages table of {connection.engine.url!r} has no full-text index, '
+                    'apply the migrations or set SEARCH_BACKEND to memory.')
+            self._backends[key] = backend
+
+        return self._backends[key]
+
+    def _memory_index(self, connection):
+        key = str(connection.engine.url)
+        with self._lock:
+            if key not in self._memory_indexes:
+                self._memory_indexes[key] = InvertedIndex(self.table)
+            return self._memory_indexes[key]
+
+    def search(self, connection, terms, room_id=None, limit=20, offset=0):
+        """Return the (id, score) tuples of the messages whose body holds all
+        the given terms, optionally only in the room with the given id, from
+        the most to the least relevant, skipping the first offset ones."""
+        if not terms:
+            return []
+
+        if self.backend_of(connection) == 'memory':
+            return self._memory_index(connection).search(connection, terms, room_id, limit, offset)
+        if connection.dialect.name == 'mysql':
+            return self._search_mysql(connection, terms, room_id, limit, offset)
+        return self._search_fts5(connection, terms, room_id, limit, offset)
+
+    def _search_mysql(self, connection, terms, room_id, limit, offset):
+        table = self.table
+        score = text('MATCH (body) AGAINST (:query IN BOOLEAN MODE)').bindparams(
+            query=' '.join(f'+{term}' for term in terms)
+        )
+        query = select([table.c._id, score.label('score')]).where(score > 0)
+        if room_id is not None:
+            query = query.where(table.c.room_id == room_id)
+
+        return [(row[0], float(row[1])) for row in connection.execute(
+            query.order_by(text('score DESC'), table.c._id.desc()).limit(limit).offset(offset)
+        )]
+
+    def _search_fts5(self, connection, terms, room_id, limit, offset):
+        # Terms are quoted so that they're never read as FTS5 operators.
+        match = ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+        room_filter = 'AND messages.room_id = :room_id' if room_id is not None else ''
+        statement = text(
+            f'SELECT {FTS_TABLE_NAME}.rowid AS _id, -bm25({FTS_TABLE_NAME}) AS score '
+            f'FROM {FTS_TABLE_NAME} JOIN {self.table.name} AS messages ON messages._id = {FTS_TABLE_NAME}.rowid '
+            f'WHERE {FTS_TABLE_NAME} MATCH :match {room_filter} '
+            f'ORDER BY score DESC, messages._id DESC LIMIT :limit OFFSET :offset'
+        )
+        parameters = {'match': match, 'limit': limit, 'offset': offset}
+        if room_id is not None:
+            parameters['room_id'] = room_id
+
+        return [(row[0], float(row[1])) for row in connection.execute(statement, parameters)]
@@ -0,0 +1,80 @@
+"""Signed session tokens, issued to the users when they log in.
+
+A token holds the id and the name of its user along with the session epoch
+of the user when it was issued, and is signed with HMAC-SHA256 and
+timestamped by itsdangerous, so it is verified without reading the database:
+    <base64 JSON payload>.<base64 timestamp>.<base64 signature>
+Tokens expire max_age seconds after they were issued.
+
+The tokens which were verified recently are held in an LRU cache, so that
+the requests of an active session skip decoding and checking the signature
+of their token. The user of a token is looked up in the name lookup cache of
+the users, and the token is only accepted if the user still has the session
+epoch it holds. Logging a user out increments their session epoch, which
+revokes all the tokens issued to the user so far: right away in the process
+serving the logout, and within the ttl of the name lookup cache of the users
+in the other processes.
+"""
+import calendar
+import hashlib
+import time
+from collections import namedtuple
+
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+
+from cache import LRUCache
+
+# Salt of the signatures, so that a token is never accepted where another
+# value signed with the same secret key is expected.
+SIGNATURE_SALT = 'treechat-session'
+
+# Payload of a verified token, along with the time (in seconds since the
+# epoch) at which it expires.
+Session = namedtuple('Session', ['user_id', 'name', 'epoch', 'expires_at'])
+
+
+class SessionTokens:
+    """Issues and verifies the session tokens signed with the given secret key.
+
+    max_age is the number of seconds a token is valid for, and cache_size and
+    cache_ttl are the capacity and the ttl (in seconds) of the cache of the
+    verified tokens.
+    """
+
+    def __init__(self, secret_key, max_age=86400, cache_size=10000, cache_ttl=300):
+        self.max_age = max_age
+        self.cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self._serializer = URLSafeTimedSerializer(secret_key, salt=SIGNATURE_SALT,
+            signer_kwargs={'digest_method': hashlib.sha256}
+        )
+
+    def issue(self, user_id, name, epoch):
+        """Return a new token of the session of the given user."""
+        return self._serializer.dumps([user_id, name, epoch])
+
+    def load(self, token):
+        """Return the Session held by the given token, or None if its signature
+        is invalid or it has expired."""
+        session = self.cache.get(token)
+        if session is None:
+            try:
+                payload, issued_at = self._serializer.loads(token, max_age=self.max_age, return_timestamp=True)
+                user_id, name, epoch = payload
+            except (BadSignature, TypeError, ValueError):
+                return None
+
+            # The timestamp is a naive datetime in UTC with itsdangerous 1.x, and
+            # an aware one with later versions.
+            expires_at = calendar.timegm(issued_at.utctimetuple()) + self.max_age
+            session = Session(user_id, name, epoch, expires_at)
+            self.cache.set(token, session)
+
+        if session.expires_at <= time.time():
+            self.cache.invalidate(token)
+            return None
+
+        return session
+
+    def stats(self):
+        """Return the statistics of the cache of the verified tokens as a dict."""
+        return self.cache.stats()
@@ -0,0 +1,160 @@
+"""Sharded storage of the messages, placed on database shards by room.
+
+Every room is placed on one of the shards by a jump consistent hash of its
+id, so all the messages of a room live on the same shard, and the history of
+a room is still read from a single (room_id, _id) index. Users, rooms and
+everything else stay on the primary database.
+
+The messages table of every shard hands out ids from its own range of
+2 ** SHARD_ID_BITS ids, by starting its auto-increment counter at the
+beginning of the range, so ids are unique across shards without any
+coordination, keep increasing within a room, and tell the shard holding a
+message. Ids of messages stored on the primary before sharding was enabled
+are below the ranges of all the shards.
+
+Adding shards moves rooms to other shards, whose messages must then be copied
+to their new shard. The jump consistent hash moves as few rooms as possible,
+i.e. only 1/n of the rooms when going from n - 1 to n shards.
+"""
+from flask import _app_ctx_stack
+from sqlalchemy import BigInteger, Column, Index, Integer, MetaData, Table, func, orm, select
+
+from pool import create_engine, pool_stats
+
+# Number of bits of the ids of the messages which are numbers of the shard-local
+# sequence, the shard index being stored in the bits above them. This allows
+# about 10 ** 12 messages per shard, with ids that are exact in a JavaScript
+# number (below 2 ** 53) for up to 8191 shards.
+SHARD_ID_BITS = 40
+
+# Type of the ids of the messages stored on the shards. SQLite only hands out
+# ids of AUTOINCREMENT columns declared as INTEGER, which are 64-bit anyway.
+SHARD_ID_TYPE = BigInteger().with_variant(Integer(), 'sqlite')
+
+
+def jump_hash(key, buckets):
+    """Return the bucket in [0, buckets) of the given integer key, following
+    the jump consistent hash of Lamping and Veach."""
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * (1 << 31) / ((key >> 33) + 1))
+
+    return bucket
+
+
+def shard_table(table):
+    """Return a copy of the given table, with its columns, their Python-side
+    defaults and its indexes but without its foreign keys, whose referenced
+    tables only exist on the primary. The ids of the copy are 64-bit integers,
+    which are never reused, even on SQLite."""
+    shard = Table(table.name, MetaData(),
+        *(Column(column.name, SHARD_ID_TYPE if column.primary_key else column.type,
+                primary_key=column.primary_key, nullable=column.nullable,
+                default=column.default.arg if column.default is not None else None)
+            for column in table.columns),
+        sqlite_autoincrement=True
+    )
+    for index in table.indexes:
+        Index(index.name, *(shard.c[column.name] for column in index.columns), unique=index.unique)
+
+    return shard
+
+
+class MessageShards:
+    """Flask extension holding the engines of the shards of the messages
+    table, along with a scoped session per shard, which is removed at the end
+    of every app context like the session of Flask-SQLAlchemy.
+
+    table is the table of the messages, as defined on the primary.
+    """
+
+    def __init__(self, app=None, uris=(), table=None, id_bits=SHARD_ID_BITS):
+        self.table = table
+        self.shard_table = shard_table(table)
+        self.id_bits = id_bits
+        self.engines = [create_engine(uri) for uri in uris]
+        self.sessions = [
+            orm.scoped_session(orm.sessionmaker(bind=engine), scopefunc=_app_ctx_stack.__ident_func__)
+            for engine in self.engines
+        ]
+
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.teardown_appcontext(self._remove_sessions)
+
+    def _remove_sessions(self, exception=None):
+        for session in self.sessions:
+            session.remove()
+
+    def close_sessions(self):
+        """Close the sessions of all the shards, returning their connections
+        to the pools."""
+        for session in self.sessions:
+            session.close()
+
+    def shard_index(self, room_id):
+        """Return the index of the shard holding the messages of the room."""
+        return jump_hash(room_id, len(self.engines))
+
+    def shard_of_id(self, message_id):
+        """Return the index of the shard holding the message with the given
+        id, or None if it was stored on the primary."""
+        index = (message_id >> self.id_bits) - 1
+        return index if 0 <= index < len(self.engines) else None
+
+    def first_id(self, index):
+        """Return the first id handed out by the shard with the given index."""
+        return (index + 1) << self.id_bits
+
+    def session(self, room_id):
+        """Return the session of the shard holding the messages of the room."""
+        return self.sessions[self.shard_index(room_id)]()
+
+    def insert(self, rows):
+        """Insert the given rows of messages into their shards, with one
+        multi-row insert and transaction per shard. Rows are only atomic
+        within a shard."""
+        rows_by_shard = {}
+        for row in rows:
+            rows_by_shard.setdefault(self.shard_index(row['room_id']), []).append(row)
+
+        for index, shard_rows in rows_by_shard.items():
+            with self.engines[index].begin() as connection:
+                connection.execute(self.shard_table.insert(), shard_rows)
+
+    def create_tables(self):
+        """Create the messages table on every shard that doesn't have it yet,
+        and start its ids at the beginning of the range of the shard."""
+        for index, engine in enumerate(self.engines):
+            with engine.begin() as connection:
+                self.shard_table.create(bind=connection, checkfirst=True)
+
+                max_id = connection.execute(select([func.max(self.shard_table.c._id)])).scalar()
+                if max_id is None or max_id < self.first_id(index):
+                    self._start_ids_at(connection, self.first_id(index))
+
+    def drop_tables(self):
+        """Drop the messages table of every shard."""
+        for engine in self.engines:
+            self.shard_table.drop(bind=engine, checkfirst=True)
+
+    def _start_ids_at(self, connection, first_id):
+        """Make the messages table of a shard hand out ids from first_id on."""
+        name = self.shard_table.name
+        dialect = connection.dialect.name
+
+        if dialect == 'sqlite':
+            connection.execute('DELETE FROM sqlite_sequence WHERE name = ?', (name,))
+            connection.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (name, first_id - 1))
+        elif dialect == 'mysql':
+            connection.execute(f'ALTER TABLE {name} AUTO_INCREMENT = {int(first_id)}')
+        else:
+            raise ValueError(f'Sharding the messages is not supported on {dialect} databases.')
+
+    def pool_stats(self):
+        """Return the statistics of the pools of connections of the shards."""
+        return {f'shard_{index}': pool_stats(engine) for index, engine in enumerate(self.engines)}
@@ -0,0 +1,425 @@
+"""Export and import of snapshots of the TreeChat database.
+
+A snapshot holds the users, rooms, memberships, change log and messages of
+a database, including the messages of all the shards and the archived ones,
+so that a production-scale dataset can be cloned into a local database:
+
+    $ python snapshot.py export chat.ndjson.gz
+    $ DATABASE_URI=sqlite:////tmp/chat.db python snapshot.py import chat.ndjson.gz
+
+Snapshots are newline delimited JSON, gzip compressed if the name of the
+file ends with '.gz'. A header line is followed by a section per table, made
+of a line naming the table and its columns, and a line per row holding the
+array of its values:
+    {"snapshot": "treechat", "version": 1, "schema": 10, "exported_at": "..."}
+    {"table": "users", "columns": ["_id", "name", "password", "email", "session_epoch"]}
+    [1,"User 1","scrypt$16384$8$1$...","user1@email.com",0]
+Rows are exported in batches, in the order of their primary key, and written
+as they are read, so exporting takes the same memory no matter how large
+the database is.
+
+Importing brings the schema of the database up to date with the migrations,
+then inserts the rows with their ids in batches, with an executemany() and a
+commit per batch. The rows are inserted with Core statements, rather than
+added to the session of the ORM, so they are never tracked nor flushed one at
+a time, and the indexes of the messages (other than the ones backing its
+foreign keys on MySQL) are built once all of them are inserted. The tables
+must be empty, unless --replace is passed, in which case their rows are
+deleted first. Archived messages are imported into the messages table, and
+archived again by the retention policies of their rooms.
+"""
+import argparse
+import gzip
+import json
+import sys
+import time
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+
+from sqlalchemy import DateTime, func, select, tuple_
+
+from main import (app, db, message_archive, message_shards, ArchiveSegmentModel, ChangeModel, MembershipModel,
+    MessageModel, RoomModel, UserModel)
+from migrations import MIGRATIONS, current_version, upgrade
+from search import create_fulltext_index, drop_fulltext_index, has_fulltext_index
+
+# Format and version of the snapshots.
+SNAPSHOT_FORMAT = 'treechat'
+SNAPSHOT_VERSION = 1
+
+# Number of rows read (or inserted) per statement.
+SNAPSHOT_BATCH_SIZE = 10000
+
+# Tables of a snapshot, in the order in which they are exported and imported,
+# so that the rows referenced by a foreign key are imported first.
+SNAPSHOT_TABLES = (UserModel.__table__, RoomModel.__table__, MembershipModel.__table__, ChangeModel.__table__,
+    MessageModel.__table__)
+
+
+class SnapshotError(Exception):
+    """Raised when a snapshot can't be imported into the database."""
+
+
+def open_snapshot(path, mode):
+    """Open the snapshot file with the given path as text, for reading ('r')
+    or writing ('w'), compressed with gzip if its name ends with '.gz'."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', compresslevel=6)
+    return open(path, mode, encoding='utf-8')
+
+
+def message_engines():
+    """Return the engines of the databases holding the messages: the ones of
+    the shards, or else the primary."""
+    return [db.engine] if message_shards is None else message_shards.engines
+
+
+class Progress:
+    """Reports the number of rows processed per table, and their rate, on the
+    standard error every report_every rows."""
+
+    def __init__(self, verb, report_every=SNAPSHOT_BATCH_SIZE * 10):
+        self.verb = verb
+        self.report_every = report_every
+        self.started_at = time.perf_counter()
+        self.table = None
+        self.table_started_at = None
+        self.count = 0
+        self.totals = {}
+
+    def start(self, table_name):
+        self.table = table_name
+        self.count = 0
+        self.table_started_at = time.perf_counter()
+
+    def add(self, count):
+        reported = self.count // self.report_every
+        self.count += count
+        if self.count // self.report_every > reported:
+            self._report('...')
+
+    def finish(self):
+        self.totals[self.table] = self.totals.get(self.table, 0) + self.count
+        self._report('.')
+
+    def _report(self, suffix):
+        elapsed = time.perf_counter() - self.table_started_at
+        print(f'{self.verb} {self.count} rows of the {self.table} table '
+            f'({self.count / elapsed if elapsed else 0:.0f} rows/s){suffix}', file=sys.stderr)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started_at
+        total = sum(self.totals.values())
+        return f'{self.verb} {total} rows in {elapsed:.1f}s ({total / elapsed if elapsed else 0:.0f} rows/s).'
+
+
+# Export
+# ------
+def iterate_rows(connection, table, batch_size=SNAPSHOT_BATCH_SIZE):
+    """Yield the rows of the given table, read in batches in the order of
+    its primary key, each batch resuming after the key of the previous one."""
+    key = list(table.primary_key.columns)
+    key_value = tuple_(*key) if len(key) > 1 else key[0]
+    last_key = None
+    while True:
+        query = select(list(table.columns))
+        if last_key is not None:
+            query = query.where(key_value > (tuple_(*last_key) if len(key) > 1 else last_key[0]))
+        batch = connection.execute(query.order_by(*key).limit(batch_size)).fetchall()
+        yield from batch
+
+        if len(batch) < batch_size:
+            return
+        last_key = tuple(batch[-1][column.name] for column in key)
+
+
+@contextmanager
+def snapshot_connection(engine):
+    """Yield a connection to the database of the given engine which reads all
+    the rows from a single snapshot of the database, taken when the connection
+    is opened, whatever is written to the database meanwhile: a REPEATABLE
+    READ transaction started with a consistent snapshot on MySQL, or a read
+    transaction on SQLite, whose writers wait for the end of the transaction
+    unless the database is in WAL mode."""
+    with engine.connect() as connection:
+        if connection.dialect.name == 'mysql':
+            connection = connection.execution_options(isolation_level='REPEATABLE READ')
+            connection.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+        else:
+            connection.execute('BEGIN')
+            # SQLite takes the snapshot on the first read of the transaction.
+            connection.execute('SELECT COUNT(*) FROM sqlite_master').scalar()
+
+        try:
+            yield connection
+        finally:
+            # Rolled back with the DB-API, which does nothing if the
+            # transaction was already rolled back on an error.
+            connection.connection.rollback()
+
+
+def archived_message_rows(connection, message_connections):
+    """Yield the archived messages as rows of the messages table, read with
+    the given connection to the primary, skipping the ones which were exported
+    from the messages tables read with the given connections to the databases
+    holding the messages, e.g. left behind by an interrupted run of the
+    retention job, or archived since the messages were read."""
+    segments, messages = ArchiveSegmentModel.__table__, MessageModel.__table__
+    rooms = connection.execute(
+        select([segments.c.room_id, func.max(segments.c.last_id)]).group_by(segments.c.room_id)
+    ).fetchall()
+
+    for room_id, last_archived_id in rooms:
+        message_connection = message_connections[0 if message_shards is None else message_shards.shard_index(room_id)]
+        hot_ids = {message_id for message_id, in message_connection.execute(
+            select([messages.c._id]).where(messages.c.room_id == room_id).where(messages.c._id <= last_archived_id)
+        )}
+
+        for segment in message_archive.segments(connection, room_id):
+            for message in message_archive.read_segment(segment.path):
+                if message._id not in hot_ids:
+                    row = {'_id': message._id, 'body': message.body, 'sender_id': message.sender_id,
+                        'room_id': room_id, 'created_at': message.created_at}
+                    yield [row[column.name] for column in messages.columns]
+
+
+def export_snapshot(path, include_archive=True, batch_size=SNAPSHOT_BATCH_SIZE):
+    """Write a snapshot of the database to the file with the given path.
+
+    Raise a SnapshotError if the migrations weren't all applied to the
+    database.
+
+    Every database is read from a single snapshot of it, so the snapshot is
+    consistent even if the database is written meanwhile. The snapshots of the
+    shards are taken before the one of the primary, so the messages of the
+    shards only refer to users and rooms of the snapshot of the primary, and a
+    message archived in between is exported from its shard, and skipped in
+    the archive.
+    """
+    progress = Progress('Exported')
+
+    with app.app_context():
+        with db.engine.begin() as connection:
+            schema = current_version(connection)
+    if schema < MIGRATIONS[-1][0]:
+        raise SnapshotError(f'The schema of the database is at version {schema}, apply the migrations first.')
+
+    with app.app_context(), open_snapshot(path, 'w') as snapshot, ExitStack() as connections:
+        message_connections = [connections.enter_context(snapshot_connection(engine))
+            for engine in message_engines()] if message_shards is not None else None
+        connection = connections.enter_context(snapshot_connection(db.engine))
+        if message_connections is None:
+            message_connections = [connection]
+
+        def write(value):
+            snapshot.write(json.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str))
+            snapshot.write('\n')
+
+        write({'snapshot': SNAPSHOT_FORMAT, 'version': SNAPSHOT_VERSION, 'schema': schema,
+            'exported_at': datetime.utcnow().isoformat()})
+
+        def write_rows(rows):
+            count = 0
+            for row in rows:
+                write(list(row))
+                count += 1
+                if count == batch_size:
+                    progress.add(count)
+                    count = 0
+            progress.add(count)
+
+        for table in SNAPSHOT_TABLES:
+            write({'table': table.name, 'columns': [column.name for column in table.columns]})
+            progress.start(table.name)
+
+            for source in (message_connections if table is MessageModel.__table__ else [connection]):
+                write_rows(iterate_rows(source, table, batch_size=batch_size))
+            if table is MessageModel.__table__ and include_archive:
+                write_rows(archived_message_rows(connection, message_connections))
+
+            progress.finish()
+
+    print(progress.summary(), file=sys.stderr)
+# ------
+
+
+# Import
+# ------
+def delete_rows():
+    """Delete the rows of the tables of a snapshot, and the archive segments
+    of the deleted rooms, in the reverse order of their foreign keys."""
+    for engine in message_engines():
+        with engine.begin() as connection:
+            connection.execute(MessageModel.__table__.delete())
+
+    with db.engine.begin() as connection:
+        connection.execute(ArchiveSegmentModel.__table__.delete())
+        for table in reversed(SNAPSHOT_TABLES):
+            if table is not MessageModel.__table__:
+                connection.execute(table.delete())
+
+
+def check_empty():
+    """Raise a SnapshotError if any table of a snapshot holds rows."""
+    for table in SNAPSHOT_TABLES:
+        engines = message_engines() if table is MessageModel.__table__ else [db.engine]
+        for engine in engines:
+            with engine.connect() as connection:
+                if connection.execute(select([func.count()]).select_from(table)).scalar():
+                    raise SnapshotError(f'The {table.name} table is not empty, pass --replace to delete its rows first.')
+
+
+def deferrable_indexes(connection, table):
+    """Return the secondary indexes of the given messages table which can be
+    dropped while loading messages. On MySQL, the indexes starting with the
+    column of a foreign key are the ones InnoDB requires to check it, and
+    refuses to drop, so they are kept."""
+    if connection.dialect.name != 'mysql':
+        return list(table.indexes)
+
+    foreign_key_columns = {foreign_key.parent.name for foreign_key in table.foreign_keys}
+    return [index for index in table.indexes if list(index.columns)[0].name not in foreign_key_columns]
+
+
+@contextmanager
+def deferred_message_indexes():
+    """Drop the secondary indexes and the full-text index of the messages
+    tables while the block loads messages into them, and build them back from
+    all the loaded messages at once afterwards, which is much faster than
+    updating them with every inserted row."""
+    tables = []
+    for engine in message_engines():
+        table = MessageModel.__table__ if message_shards is None else message_shards.shard_table
+        with engine.begin() as connection:
+            fulltext = has_fulltext_index(connection, table)
+            if fulltext:
+                drop_fulltext_index(connection, table)
+            indexes = deferrable_indexes(connection, table)
+            for index in indexes:
+                index.drop(bind=connection)
+        tables.append((engine, table, indexes, fulltext))
+
+    try:
+        yield
+    finally:
+        for engine, table, indexes, fulltext in tables:
+            print(f'Indexing the {table.name} table of {engine.url.database}...', file=sys.stderr)
+            with engine.begin() as connection:
+                for index in indexes:
+                    index.create(bind=connection)
+                if fulltext:
+                    create_fulltext_index(connection, table)
+
+
+def insert_batch(table, rows):
+    """Insert a batch of rows into a table, with a single executemany() and
+    commit, into their shards if the rows are sharded messages."""
+    if table is MessageModel.__table__ and message_shards is not None:
+        message_shards.insert(rows)
+    else:
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), rows)
+
+
+def import_snapshot(path, replace=False, batch_size=SNAPSHOT_BATCH_SIZE):
+    """Import the snapshot in the file with the given path into the database,
+    after applying the pending migrations.
+
+    Raise a SnapshotError if the snapshot isn't a snapshot of a supported
+    version or schema, or if the tables aren't empty and replace is false.
+    """
+    tables = {table.name: table for table in SNAPSHOT_TABLES}
+
+    with open_snapshot(path, 'r') as snapshot:
+        header = json.loads(snapshot.readline() or 'null')
+        if not isinstance(header, dict) or header.get('snapshot') != SNAPSHOT_FORMAT:
+            raise SnapshotError(f'{path} is not a TreeChat snapshot.')
+        if header.get('version') != SNAPSHOT_VERSION:
+            raise SnapshotError(f'Snapshots of version {header.get("version")} are not supported.')
+
+        upgrade()
+        with app.app_context():
+            with db.engine.connect() as connection:
+                if header['schema'] > current_version(connection):
+                    raise SnapshotError(f'The snapshot was exported from a schema of version {header["schema"]}, '
+                        f'which is newer than the one of the database.')
+
+            if replace:
+                delete_rows()
+            else:
+                check_empty()
+
+            progress = Progress('Imported')
+            table = columns = None
+            datetime_indexes = ()
+            batch = []
+            with ExitStack() as deferred:
+                for line in snapshot:
+                    if not line.startswith('{'):
+                        values = json.loads(line)
+                        for index in datetime_indexes:
+                            if values[index] is not None:
+                                values[index] = datetime.fromisoformat(values[index])
+                        batch.append(dict(zip(columns, values)))
+                        if len(batch) == batch_size:
+                            insert_batch(table, batch)
+                            progress.add(len(batch))
+                            batch = []
+                        continue
+
+                    if batch:
+                        insert_batch(table, batch)
+                        progress.add(len(batch))
+                        batch = []
+                    if table is not None:
+                        progress.finish()
+
+                    section = json.loads(line)
+                    table = tables.get(section['table'])
+                    if table is None:
+                        raise SnapshotError(f'Unknown table in the snapshot: {section["table"]}')
+                    columns = section['columns']
+                    unknown = [name for name in columns if name not in table.c]
+                    if unknown:
+                        raise SnapshotError(f'Unknown columns of the {table.name} table: {", ".join(unknown)}')
+                    # Values of the DateTime columns are exported as strings.
+                    datetime_indexes = [index for index, name in enumerate(columns)
+                        if isinstance(table.c[name].type, DateTime)]
+                    if table is MessageModel.__table__:
+                        deferred.enter_context(deferred_message_indexes())
+                    progress.start(table.name)
+
+                if batch:
+                    insert_batch(table, batch)
+                    progress.add(len(batch))
+                if table is not None:
+                    progress.finish()
+
+    print(progress.summary(), file=sys.stderr)
+# ------
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export and import snapshots of the TreeChat database.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export_parser = subparsers.add_parser('export', help='Write a snapshot of the database to a file.')
+    export_parser.add_argument('path', help='File to write the snapshot to, compressed if it ends with .gz.')
+    export_parser.add_argument('--no-archive', action='store_true', help='Leave the archived messages out.')
+    export_parser.add_argument('--batch-size', type=int, default=SNAPSHOT_BATCH_SIZE,
+        help='Number of rows read per query.')
+
+    import_parser = subparsers.add_parser('import', help='Import a snapshot into the database.')
+    import_parser.add_argument('path', help='File to read the snapshot from, compressed if it ends with .gz.')
+    import_parser.add_argument('--replace', action='store_true', help='Delete the rows of the tables first.')
+    import_parser.add_argument('--batch-size', type=int, default=SNAPSHOT_BATCH_SIZE,
+        help='Number of rows inserted per statement.')
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'export':
+            export_snapshot(args.path, include_archive=not args.no_archive, batch_size=args.batch_size)
+        elif args.command == 'import':
+            import_snapshot(args.path, replace=args.replace, batch_size=args.batch_size)
+    except SnapshotError as error:
+        sys.exit(f'error: {error}')
@@ -4,7 +4,7 @@ from sqlalchemy import exc
 
 import requests
 
-from main import db, UserModel as User, RoomModel as Room, MessageModel as Message
+from main import app, db, count_queries, password_hasher, UserModel as User, RoomModel as Room, MessageModel as Message
 
 LOCAL_DEV_SERVER = 'http://127.0.0.1:5000/'
 
@@ -36,7 +36,7 @@ def load_database():
 
     print('Inserting mock data to the user table in the database...')
     for user in users_data:
-        new_user = User(name=user['name'], email=user['email'], password=user['password'])
+        new_user = User(name=user['name'], email=user['email'], password=password_hasher.hash(user['password']))
         db.session.add(new_user)
         db.session.commit()
         print(f'Added {new_user.name} into the database.')
@@ -316,12 +316,34 @@ def test_create_room(base_url, room_name, expected_success_code=201, expected_fa
     input('Press any key to continue...\n')
 
 
-def test_get_all_msgs_of_a_room(base_url, room_name, expected_success_code=200, expected_fail_code=404):
+def test_get_all_msgs_of_a_room(base_url, room_name, params=None, expected_success_code=200, expected_fail_code=404):
     """An unit test to ensure that the endpoint to get all messages by
     the given room name is working properly.
+
+    The optional params are passed in the query string to select a page
+    of the history of the room, e.g. {'after_id': 1, 'limit': 1}.
     """
     ENDPOINT = f'messages/{room_name}'
-    response = requests.get(f'{base_url}{ENDPOINT}')
+    response = requests.get(f'{base_url}{ENDPOINT}', params=params)
+
+    if response.status_code == expected_success_code:
+        print(f'Result: SUCCESS.\nJSON:\n{prettify_json(response.json())}')
+    elif response.status_code == expected_fail_code:
+        print(f'Result: FAILED.\nJSON:\n{prettify_json(response.json())}')
+    else:
+        print(
+            f'Some unexpected error has occurred. '
+            f'Returned response code: {response.status_code}'
+        )
+    input('Press any key to continue...\n')
+
+
+def test_poll_new_msgs_of_a_room(base_url, room_name, since_id, timeout=1, expected_success_code=200, expected_fail_code=404):
+    """An unit test to ensure that the endpoint to wait for the messages
+    sent to the given room after a given message is working properly.
+    """
+    ENDPOINT = f'messages/{room_name}/poll'
+    response = requests.get(f'{base_url}{ENDPOINT}', params={'since_id': since_id, 'timeout': timeout})
 
     if response.status_code == expected_success_code:
         print(f'Result: SUCCESS.\nJSON:\n{prettify_json(response.json())}')
@@ -412,6 +434,89 @@ def test_create_message(base_url, sender_name, room_name, expected_success_code=
     input('Press any key to continue...\n')
 
 
+def test_create_msgs_in_bulk(base_url, sender_names, room_name, expected_success_code=201, expected_fail_code=409):
+    """An unit test to ensure that the endpoint to create a batch of new
+    messages from the given senders for a specified room, is working properly.
+    """
+    ENDPOINT = 'messages/bulk'
+
+    request_body = {
+        'messages': [
+            {
+                'body': f'This is a message sent in bulk from {sender_name} to {room_name}',
+                'sender_name': sender_name,
+                'room_name': room_name
+            }
+            for sender_name in sender_names
+        ]
+    }
+
+    response = requests.post(f'{base_url}{ENDPOINT}', json=request_body)
+    if response.status_code == expected_success_code:
+        print(f'Result: SUCCESS.\nJSON:\n{prettify_json(response.json())}')
+    elif response.status_code == expected_fail_code:
+        print(f'Result: FAILED.\nJSON:\n{prettify_json(response.json())}')
+    else:
+        print(
+            f'Some unexpected error has occurred. '
+            f'Returned response code: {response.status_code}'
+        )
+    print()
+    input('Press any key to continue...\n')
+
+
+def test_conditional_get(base_url, endpoint, expected_success_code=304, expected_fail_code=200):
+    """An unit test to ensure that the given endpoint returns an ETag, and
+    doesn't send the response again when it is passed in If-None-Match.
+    """
+    response = requests.get(f'{base_url}{endpoint}')
+    etag = response.headers.get('ETag')
+    print(f'ETag of {endpoint}: {etag}')
+
+    response = requests.get(f'{base_url}{endpoint}', headers={'If-None-Match': etag})
+    if response.status_code == expected_success_code:
+        print('Result: SUCCESS.\nThe response was not sent again.')
+    elif response.status_code == expected_fail_code:
+        print(f'Result: FAILED.\nJSON:\n{prettify_json(response.json())}')
+    else:
+        print(
+            f'Some unexpected error has occurred. '
+            f'Returned response code: {response.status_code}'
+        )
+    input('Press any key to continue...\n')
+
+
+def test_query_counts(room_name):
+    """An unit test to ensure that the endpoints issue a constant number of
+    queries to the database, no matter how many records they return, i.e.
+    that no relationship is lazy loaded once per serialized record.
+
+    Runs the requests against the app in-process, so that the queries
+    can be counted on the same thread. Names served from the name lookup
+    caches need no query, so the counts are upper bounds.
+    """
+    max_query_counts = {
+        'users/all': 2,
+        'rooms/all': 2,
+        f'messages/{room_name}': 3
+    }
+
+    client = app.test_client()
+    for endpoint, expected_count in max_query_counts.items():
+        with count_queries() as counter:
+            client.get(f'/{endpoint}')
+
+        if counter.count <= expected_count:
+            print(f'Result: SUCCESS.\n{endpoint} issued {counter.count} queries.')
+        else:
+            print(
+                f'Result: FAILED.\n{endpoint} issued {counter.count} queries, '
+                f'expected at most {expected_count}.\nQueries:\n' + '\n'.join(counter.statements)
+            )
+        print()
+    input('Press any key to continue...\n')
+
+
 def clean_database():
     """A helper method to delete all existing data stored in the local
     database.
@@ -473,10 +578,26 @@ if __name__ == '__main__':
     test_create_room(LOCAL_DEV_SERVER, 'Room 3')
     # Testing /messages/{room_name}
     test_get_all_msgs_of_a_room(LOCAL_DEV_SERVER, 'Room 1')
+    test_get_all_msgs_of_a_room(LOCAL_DEV_SERVER, 'Room 1', params={'limit': 1})
+    test_get_all_msgs_of_a_room(LOCAL_DEV_SERVER, 'Room 1', params={'after_id': 1, 'limit': 1})
+    test_get_all_msgs_of_a_room(LOCAL_DEV_SERVER, 'Room 1', params={'limit': 0}, expected_success_code=400, expected_fail_code=200)
     test_get_all_msgs_of_a_room(LOCAL_DEV_SERVER, 'Non-Existent Room', expected_success_code=404, expected_fail_code=200)
     test_get_all_msgs_of_a_room(LOCAL_DEV_SERVER, 'Room 3', expected_success_code=404, expected_fail_code=200)
+    # Testing /messages/{room_name}/poll
+    test_poll_new_msgs_of_a_room(LOCAL_DEV_SERVER, 'Room 1', since_id=0)
+    test_poll_new_msgs_of_a_room(LOCAL_DEV_SERVER, 'Room 1', since_id=1000)
+    test_poll_new_msgs_of_a_room(LOCAL_DEV_SERVER, 'Non-Existent Room', since_id=0, expected_success_code=404, expected_fail_code=200)
     # Testing /messages/new
     test_create_message(LOCAL_DEV_SERVER, 'User 4', 'Room 3')
+    # Testing /messages/bulk
+    test_create_msgs_in_bulk(LOCAL_DEV_SERVER, ['User 1', 'User 2', 'Unknown Sender'], 'Room 3')
+    test_create_msgs_in_bulk(LOCAL_DEV_SERVER, ['Unknown Sender'], 'Room 3', expected_success_code=409, expected_fail_code=201)
+    # Testing conditional requests
+    test_conditional_get(LOCAL_DEV_SERVER, 'users/all')
+    test_conditional_get(LOCAL_DEV_SERVER, 'rooms/Room 1')
+    test_conditional_get(LOCAL_DEV_SERVER, 'messages/Room 1')
+    # Testing the number of queries issued by the endpoints
+    test_query_counts('Room 1')
     # ----------------
     
     # Deleting all existing in the database
@@ -0,0 +1,234 @@
+"""Write-behind insertion of messages with group commits.
+
+Instead of committing a transaction per message, accepted messages are put
+into a bounded in-process queue, without an id. A background writer takes
+them off the queue and inserts them in batches, one transaction per batch,
+flushing a batch every flush_interval seconds or as soon as it holds
+flush_batch messages, whichever comes first.
+
+The durability of an accepted message depends on the ack mode:
+    enqueue - The request is acknowledged once the message is queued. Messages
+              still queued are lost if the process dies.
+    flush   - The request is acknowledged once the batch holding the message
+              is committed.
+When the queue is full, new messages are rejected, and the client is asked
+to retry later.
+
+Ids are handed out by an IdAllocator from a sequence shared by all the
+processes, within the transaction inserting the batch, so the messages are
+committed in the order of their ids by all the processes. In the 'enqueue'
+ack mode, a message is acknowledged before its id is known. Messages are
+only published to the subscribers of their room once committed.
+
+If a batch fails to be inserted, e.g. because one of its rows violates a
+constraint of the table, its rows are inserted again one at a time, and the
+ones which still fail are logged along with their values and dropped.
+"""
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+logger = logging.getLogger(__name__)
+
+# Ack modes of the write-behind queue.
+ACK_ENQUEUE = 'enqueue'
+ACK_FLUSH = 'flush'
+
+
+class QueueFullError(Exception):
+    """Raised when a message is written while the write-behind queue is full."""
+
+
+class IdAllocator:
+    """Allocator of the ids of a table, which hands them out from a single
+    sequence shared by all the processes, stored in the table of id blocks.
+
+    Ids are reserved within the transaction inserting the rows, which holds
+    the lock on the row of the sequence until it ends. Transactions reserving
+    ids are therefore committed in the order of their ids, and a reader which
+    sees a row also sees all the rows with a lower id, so the readers resuming
+    after the last id they read (the pages of the history, the long-polls,
+    the syncs, the search index and the archive) never skip a row.
+
+    A reservation always starts past the largest id stored in the table, so
+    ids inserted without the allocator are never handed out again.
+    """
+
+    def __init__(self, db, blocks_table, id_column):
+        self.db = db
+        self.blocks_table = blocks_table
+        self.id_column = id_column
+        self._created = False
+
+    def _create_sequence(self):
+        """Insert the row of the sequence, unless it already exists, in its own
+        transaction, so that concurrent reservations always lock an existing row."""
+        blocks = self.blocks_table
+        name = self.id_column.table.name
+        try:
+            with self.db.engine.begin() as connection:
+                if connection.execute(select([blocks.c.name]).where(blocks.c.name == name)).first() is None:
+                    connection.execute(blocks.insert(), name=name, next_id=1)
+        except IntegrityError:
+            # Inserted concurrently by another process.
+            pass
+        self._created = True
+
+    def reserve(self, connection, count=1):
+        """Reserve count consecutive ids within the transaction of the given
+        connection, and return the first one. The sequence stays locked until
+        the transaction is committed or rolled back, in which case the ids are
+        handed out again."""
+        if not self._created:
+            self._create_sequence()
+
+        blocks = self.blocks_table
+        name = self.id_column.table.name
+        # The row of the sequence is locked by the update before it is read,
+        # so the ids read can't be reserved by another transaction meanwhile.
+        connection.execute(blocks.update().where(blocks.c.name == name).values(next_id=blocks.c.next_id + count))
+        next_id = connection.execute(select([blocks.c.next_id]).where(blocks.c.name == name)).scalar()
+        max_id = connection.execute(func.coalesce(func.max(self.id_column), 0).select()).scalar()
+
+        start_id = next_id - count
+        if start_id <= max_id:
+            start_id = max_id + 1
+            connection.execute(blocks.update().where(blocks.c.name == name), next_id=start_id + count)
+
+        return start_id
+
+
+class WriteBehindQueue:
+    """Bounded queue of rows to be inserted into a table by a background
+    writer thread, in group commits.
+
+    on_flushed is called by the writer with a list of (row, payload) tuples
+    for every batch after it is committed, e.g. to publish the rows to the
+    subscribers along with the payloads they were queued with.
+    """
+
+    def __init__(self, app, db, table, allocator, on_flushed=None, max_size=10000,
+            flush_interval=0.05, flush_batch=500):
+        self.app = app
+        self.db = db
+        self.table = table
+        self.allocator = allocator
+        self.on_flushed = on_flushed
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._queue = queue.Queue(maxsize=max_size)
+        self._writer = None
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failed = 0
+
+    def put(self, row, payload=None):
+        """Queue the row to be inserted along with the given payload, and
+        return a Future resolved with the id of the row once it is committed.
+
+        Raise QueueFullError if the queue is full.
+        """
+        self._start_writer()
+
+        future = Future()
+        try:
+            self._queue.put_nowait((row, payload, future))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise QueueFullError()
+
+        return future
+
+    def _start_writer(self):
+        if self._writer is None:
+            with self._lock:
+                if self._writer is None:
+                    self._writer = threading.Thread(target=self._run, name='write-behind', daemon=True)
+                    self._writer.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.flush_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _insert(self, rows):
+        """Insert the given rows in a single transaction, which reserves their
+        ids, and return them along with their ids."""
+        with self.app.app_context():
+            with self.db.engine.begin() as connection:
+                first_id = self.allocator.reserve(connection, len(rows))
+                rows = [dict(row, _id=first_id + offset) for offset, row in enumerate(rows)]
+                connection.execute(self.table.insert(), rows)
+
+        return rows
+
+    def _flush(self, batch):
+        """Insert a batch of queued rows in a single transaction, and resolve
+        the futures of the rows with their ids. If the batch fails, insert its
+        rows one at a time, so that a single failing row doesn't drop the
+        others, and log the rows which still fail."""
+        try:
+            rows = self._insert([row for row, _, _ in batch])
+            flushed = [(row, payload, future) for row, (_, payload, future) in zip(rows, batch)]
+        except Exception:
+            logger.exception('Failed to write a batch of %d rows into %s, writing them one at a time.',
+                len(batch), self.table.name)
+            flushed = []
+            for row, payload, future in batch:
+                try:
+                    flushed.append((self._insert([row])[0], payload, future))
+                except Exception as error:
+                    logger.error('Dropped a row which could not be written into %s: %r', self.table.name, row,
+                        exc_info=True)
+                    with self._lock:
+                        self.failed += 1
+                    future.set_exception(error)
+
+        with self._lock:
+            self.flushed += len(flushed)
+            self.batches += 1
+        for row, _, future in flushed:
+            future.set_result(row['_id'])
+
+        if self.on_flushed is not None and flushed:
+            try:
+                self.on_flushed([(row, payload) for row, payload, _ in flushed])
+            except Exception:
+                logger.exception('Failed to handle a flushed batch of %s.', self.table.name)
+
+    def join(self):
+        """Block until all the queued rows are written."""
+        self._queue.join()
+
+    def stats(self):
+        """Return the length of the queue and the number of written, failed
+        and rejected rows as a dict."""
+        with self._lock:
+            return {
+                'queued': self._queue.qsize(),
+                'max_size': self._queue.maxsize,
+                'flushed': self.flushed,
+                'batches': self.batches,
+                'failed': self.failed,
+                'rejected': self.rejected
+            }